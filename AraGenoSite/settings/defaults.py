@@ -185,6 +185,114 @@ LOGGING = {
 
 ACCESSION_REST_INFO_URL = 'https://arapheno.1001genomes.org/rest/accession/{0}.json'
 ACCESSION_REST_MAP_URL = 'https://arapheno.1001genomes.org/rest/accession/list.json'
+# Local snapshot of the accession list. ACCESSION_MAP_FILE replaces the download from AraPheno (offline runs)
+ACCESSION_MAP_SNAPSHOT = os.environ.get('ACCESSION_MAP_SNAPSHOT', os.path.join(BASE_DIR, 'db', 'accessions'))
+ACCESSION_MAP_FILE = os.environ.get('ACCESSION_MAP_FILE', None)
+ACCESSION_MAP_REFRESH_INTERVAL = int(os.environ.get('ACCESSION_MAP_REFRESH_INTERVAL', 86400))
+ACCESSION_MAP_TIMEOUT = int(os.environ.get('ACCESSION_MAP_TIMEOUT', 10))
 HPC_USER = os.environ['HPC_USER']
 HPC_HOST = os.environ.get('HPC_HOST','cbe')
 SSH_KEY_FILENAME = os.environ.get('SSH_KEY_FILENAME', None)
+# HPC clusters: login node, scheduler dialect (slurm or pbs), folder of the submit script templates,
+# working directory and folder of the snpmatch datasets on the cluster
+HPC_CLUSTERS = {
+    'cbe': {
+        'host': HPC_HOST,
+        'scheduler': 'slurm',
+        'templates': 'CBE',
+        'base_dir': os.environ.get('CBE_BASE_DIR', '/scratch-cbe/users/%s/AraGeno/' % HPC_USER),
+        'datasets': os.environ.get('CBE_DATASETS', '/scratch-cbe/shared/matrices_for_snpmatch'),
+    },
+    'mendel': {
+        'host': os.environ.get('MENDEL_HOST', 'mendel'),
+        'scheduler': 'pbs',
+        'templates': 'MENDEL',
+        'base_dir': os.environ.get('MENDEL_BASE_DIR', '/lustre/scratch/users/%s/GENOTYPER/' % HPC_USER),
+        'datasets': os.environ.get('MENDEL_DATASETS', '$DATASET_MATRICES_FOR_SNPMATCH'),
+        'project': os.environ.get('MENDEL_PROJECT', ''),
+    },
+}
+# Clusters new submissions are routed to (the one with the shortest queue relative to its recent throughput)
+HPC_ACTIVE_CLUSTERS = os.environ.get('HPC_ACTIVE_CLUSTERS', 'cbe').split(',')
+# Jobs that started or finished within the last HPC_ROUTING_WINDOW seconds count as the throughput of a cluster
+HPC_ROUTING_WINDOW = int(os.environ.get('HPC_ROUTING_WINDOW', 3600))
+# SSH connections per process and cluster (opened on demand). Every request thread that talks to the HPC needs one,
+# so it defaults to the threads of a gunicorn worker (GUNICORN_THREADS). A thread waits HPC_CONNECT_TIMEOUT seconds
+# for a free connection before it fails with "No free HPC connection"
+HPC_POOL_SIZE = int(os.environ.get('HPC_POOL_SIZE', os.environ.get('GUNICORN_THREADS', 4)))
+HPC_CONNECT_TIMEOUT = int(os.environ.get('HPC_CONNECT_TIMEOUT', 10))
+HPC_COMMAND_TIMEOUT = int(os.environ.get('HPC_COMMAND_TIMEOUT', 60))
+HPC_KEEPALIVE = int(os.environ.get('HPC_KEEPALIVE', 30))
+# Execute the commands on the login node with a persistent agent (one round trip per batch of commands)
+HPC_AGENT = os.environ.get('HPC_AGENT', 'True').lower() in ('1', 'true', 'yes')
+HPC_AGENT_PYTHON = os.environ.get('HPC_AGENT_PYTHON', 'python3')
+# Detect finished jobs by the sentinels the jobs write into the spool folder of the cluster. The scheduler is
+# only asked for failed jobs and every HPC_SCHEDULER_CHECK_INTERVAL seconds for the jobs without sentinel
+HPC_SENTINELS = os.environ.get('HPC_SENTINELS', 'True').lower() in ('1', 'true', 'yes')
+HPC_SCHEDULER_CHECK_INTERVAL = int(os.environ.get('HPC_SCHEDULER_CHECK_INTERVAL', 300))
+# sentinels older than HPC_SENTINEL_MAX_AGE days are removed
+HPC_SENTINEL_MAX_AGE = int(os.environ.get('HPC_SENTINEL_MAX_AGE', 7))
+# Fail fast for HPC_CIRCUIT_BREAKER_RESET seconds after HPC_CIRCUIT_BREAKER_THRESHOLD consecutive connection failures
+HPC_CIRCUIT_BREAKER_THRESHOLD = int(os.environ.get('HPC_CIRCUIT_BREAKER_THRESHOLD', 3))
+HPC_CIRCUIT_BREAKER_RESET = int(os.environ.get('HPC_CIRCUIT_BREAKER_RESET', 60))
+# Refresh the HPC job status from the poll_hpc_jobs management command instead of the API requests
+HPC_BACKGROUND_POLLING = os.environ.get('HPC_BACKGROUND_POLLING', 'False').lower() in ('1', 'true', 'yes')
+HPC_POLL_INTERVAL = int(os.environ.get('HPC_POLL_INTERVAL', 30))
+# Seconds the polynominals of the settings are cached per process. They are changed by other processes
+# (loaddata, calibrate_resources), so cached entries expire
+POLYNOMINAL_CACHE_TTL = int(os.environ.get('POLYNOMINAL_CACHE_TTL', 300))
+# Padding of the walltime and memory predicted by the polynominals. Can be lowered once they are calibrated
+HPC_WALLTIME_MULTIPLIER = float(os.environ.get('HPC_WALLTIME_MULTIPLIER', 2))
+HPC_MEMORY_MULTIPLIER = float(os.environ.get('HPC_MEMORY_MULTIPLIER', 5))
+# Jobs killed by the cluster (TIMEOUT, OUT_OF_MEMORY, NODE_FAIL, PREEMPTED) are resubmitted with escalated resources
+# until they were attempted HPC_RESUBMIT_MAX_ATTEMPTS times, including the first submission
+HPC_RESUBMIT_MAX_ATTEMPTS = int(os.environ.get('HPC_RESUBMIT_MAX_ATTEMPTS', 3))
+HPC_RESUBMIT_ESCALATION = float(os.environ.get('HPC_RESUBMIT_ESCALATION', 2))
+# Upper limits of the requested walltime (seconds) and memory (kb)
+HPC_MAX_WALLTIME = int(os.environ.get('HPC_MAX_WALLTIME', 2 * 24 * 3600))
+HPC_MAX_MEMORY = int(os.environ.get('HPC_MAX_MEMORY', 256 * 1024 * 1024))
+# Collect the identify jobs of the submissions that arrive within IDENTIFY_BATCH_WINDOW seconds and score them
+# with one batch job per dataset (0 disables batching)
+IDENTIFY_BATCH_WINDOW = int(os.environ.get('IDENTIFY_BATCH_WINDOW', 0))
+IDENTIFY_BATCH_MAX_SIZE = int(os.environ.get('IDENTIFY_BATCH_MAX_SIZE', 20))
+# Submissions whose jobs are predicted to finish within LOCAL_EXECUTOR_MAX_WALLTIME seconds are run
+# in a local process pool instead of the HPC (0 disables the local executor)
+LOCAL_EXECUTOR_MAX_WALLTIME = int(os.environ.get('LOCAL_EXECUTOR_MAX_WALLTIME', 0))
+LOCAL_EXECUTOR_PROCESSES = int(os.environ.get('LOCAL_EXECUTOR_PROCESSES', 2))
+LOCAL_EXECUTOR_TIMEOUT = int(os.environ.get('LOCAL_EXECUTOR_TIMEOUT', 600))
+LOCAL_EXECUTOR_FOLDER = os.environ.get('LOCAL_EXECUTOR_FOLDER', os.path.join(BASE_DIR, 'db', 'local_jobs'))
+# folder with the <dataset>/<dataset>.hdf5 and <dataset>/<dataset>.acc.hdf5 files of the datasets
+LOCAL_EXECUTOR_DATASETS = os.environ.get('LOCAL_EXECUTOR_DATASETS', '/srv/datasets')
+LOCAL_EXECUTOR_SNPMATCH = os.environ.get('LOCAL_EXECUTOR_SNPMATCH', 'snpmatch')
+# sacct accounting of jobs that ended within the last HPC_ACCOUNTING_MAX_AGE days is collected
+HPC_ACCOUNTING_MAX_AGE = int(os.environ.get('HPC_ACCOUNTING_MAX_AGE', 7))
+# seconds until the scheduler is asked again for the accounting of a job it did not report
+HPC_ACCOUNTING_RETRY_INTERVAL = int(os.environ.get('HPC_ACCOUNTING_RETRY_INTERVAL', 900))
+# Share of the observed jobs that must fit into the calibrated walltime and memory
+HPC_CALIBRATION_QUANTILE = float(os.environ.get('HPC_CALIBRATION_QUANTILE', 0.95))
+# Seconds during which a submission's stored status is served without asking the HPC again
+HPC_STATUS_TTL = int(os.environ.get('HPC_STATUS_TTL', 15))
+# Refresh locks older than this are considered abandoned by a dead process
+HPC_REFRESH_LOCK_TIMEOUT = int(os.environ.get('HPC_REFRESH_LOCK_TIMEOUT', 600))
+# Long-poll status endpoint: maximum time a request is held open and how often the database is checked
+STATUS_LONGPOLL_TIMEOUT = int(os.environ.get('STATUS_LONGPOLL_TIMEOUT', 25))
+STATUS_LONGPOLL_INTERVAL = float(os.environ.get('STATUS_LONGPOLL_INTERVAL', 1))
+# Long-polls held open per process (keep it below GUNICORN_THREADS). The others are answered at once
+# and told to poll again after STATUS_LONGPOLL_RETRY seconds
+STATUS_LONGPOLL_MAX_WAITERS = int(os.environ.get('STATUS_LONGPOLL_MAX_WAITERS', 8))
+STATUS_LONGPOLL_RETRY = int(os.environ.get('STATUS_LONGPOLL_RETRY', 3))
+# Background tasks executed by the run_tasks workers
+TASK_POLL_INTERVAL = int(os.environ.get('TASK_POLL_INTERVAL', 2))
+TASK_MAX_ATTEMPTS = int(os.environ.get('TASK_MAX_ATTEMPTS', 5))
+TASK_RETRY_DELAY = int(os.environ.get('TASK_RETRY_DELAY', 30))
+TASK_MAX_RETRY_DELAY = int(os.environ.get('TASK_MAX_RETRY_DELAY', 3600))
+# Tasks locked for longer than this are considered abandoned by a dead worker
+TASK_LOCK_TIMEOUT = int(os.environ.get('TASK_LOCK_TIMEOUT', 3600))
+# Process pool that renders the crosses plots
+PLOT_RENDER_PROCESSES = int(os.environ.get('PLOT_RENDER_PROCESSES', 2))
+PLOT_RENDER_TIMEOUT = int(os.environ.get('PLOT_RENDER_TIMEOUT', 120))
+# Upper limit for the bins per chromosome a client can request from the crosses windows endpoint
+CROSSES_WINDOWS_MAX_BINS = int(os.environ.get('CROSSES_WINDOWS_MAX_BINS', 2000))
+# Hand the download bundles over to nginx. DOWNLOAD_ACCEL_LOCATION must be an internal location aliased to MEDIA_ROOT
+DOWNLOAD_ACCEL_REDIRECT = os.environ.get('DOWNLOAD_ACCEL_REDIRECT', 'False').lower() in ('1', 'true', 'yes')
+DOWNLOAD_ACCEL_LOCATION = os.environ.get('DOWNLOAD_ACCEL_LOCATION', '/protected-uploads/')
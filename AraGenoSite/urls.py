@@ -35,12 +35,15 @@ urlpatterns = [
     url(r'^identify/$', views.upload_genotype, name="upload_genotype"),
     url(r'^identify/(?P<pk>%s)/$' % UUID_REGEX, views.GenotypeSubmissionInfo.as_view(), name="genotype_submission_result"),
     url(r'^identify/(?P<pk>%s)/delete/$' % UUID_REGEX, views.GenotypeSubmissionDeleteView.as_view(), name="delete_submission"),
+    url(r'^accessions/(?P<fingerprint>[0-9a-f]+)\.json$', views.accession_bundle, name="accession_bundle"),
     url(r'^api-auth/', include('rest_framework.urls')),
     url(r'^api/', include(router.urls))
 ]
 
 restpatterns = [
     url(r'^api/identify/(?P<pk>%s)/jobs/(?P<job_id>(\d+))/plot/$' % UUID_REGEX, rest.plot_crosses_windows, name="crosses_plot"),
+    url(r'^api/identify/(?P<pk>%s)/jobs/(?P<job_id>(\d+))/windows/$' % UUID_REGEX, rest.crosses_windows, name="crosses_windows"),
+    url(r'^api/identify/(?P<pk>%s)/jobs/(?P<job_id>(\d+))/scores/$' % UUID_REGEX, rest.identify_scores, name="identify_scores"),
     url(r'^api/identify/(?P<pk>%s)/jobs/(?P<job_id>(\d+))/download/$' % UUID_REGEX, rest.download, name="download"),
 ]
 
@@ -0,0 +1,235 @@
+"""
+Local snapshot of the accession infos from AraPheno.
+The accession list is stored on disk as one JSON record per line (sorted by id) together with
+memory-mapped id and offset arrays, so that all workers share the same pages and only the
+requested records are decoded. Every refresh writes a new version folder and ACCESSION_MAP_SNAPSHOT is a
+symlink to the current one. The snapshot is created on startup and refreshed in the background.
+Each snapshot also contains a fingerprinted JSON bundle of all accessions for the browser
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from functools import lru_cache
+import numpy as np
+import requests
+from django.conf import settings
+from djangorestframework_camel_case.util import camelize
+
+logger = logging.getLogger(__name__)
+
+RECORDS_FILE = 'records.jsonl'
+IDS_FILE = 'ids.npy'
+OFFSETS_FILE = 'offsets.npy'
+META_FILE = 'meta.json'
+BUNDLE_FILE = 'bundle.json'
+
+# seconds between the checks whether the snapshot is outdated
+CHECK_INTERVAL = 60
+
+_refresh_lock = threading.Lock()
+_last_check = 0
+
+
+class AccessionMap(object):
+    """Read-only mapping from accession id to the accession infos"""
+
+    def __init__(self, folder=None):
+        self.folder = folder
+        self.fingerprint = None
+        if folder is None:
+            self.ids = np.empty(0, dtype=np.int64)
+            self.offsets = np.zeros(1, dtype=np.int64)
+            self.records = b''
+            return
+        self.fingerprint = _get_meta(folder).get('fingerprint')
+        self.ids = np.load(os.path.join(folder, IDS_FILE), mmap_mode='r')
+        self.offsets = np.load(os.path.join(folder, OFFSETS_FILE), mmap_mode='r')
+        self.records = np.memmap(os.path.join(folder, RECORDS_FILE), dtype=np.uint8, mode='r') if len(self.ids) else b''
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, acc_id):
+        try:
+            self[acc_id]
+        except KeyError:
+            return False
+        return True
+
+    def __getitem__(self, acc_id):
+        acc_id = int(acc_id)
+        ix = int(np.searchsorted(self.ids, acc_id))
+        if ix >= len(self.ids) or self.ids[ix] != acc_id:
+            raise KeyError(acc_id)
+        return _add_links(json.loads(bytes(self.records[self.offsets[ix]:self.offsets[ix + 1]]).decode()))
+
+    def get(self, acc_id, default=None):
+        try:
+            return self[acc_id]
+        except (KeyError, ValueError):
+            return default
+
+    @property
+    def bundle_path(self):
+        if self.folder is None:
+            return None
+        return os.path.join(self.folder, BUNDLE_FILE)
+
+
+def _add_links(acc):
+    acc['url'] = 'https://arapheno.1001genomes.org/accession/{0}'.format(acc['pk'])
+    acc['picture_url'] = '/plants/{0}.png'.format(acc['pk'])
+    return acc
+
+
+def _get_meta(folder):
+    try:
+        with open(os.path.join(folder, META_FILE)) as fh:
+            return json.load(fh)
+    except (IOError, ValueError):
+        return {}
+
+
+def _get_versions_folder(folder):
+    return folder.rstrip(os.sep) + '.versions'
+
+
+def _switch_snapshot(folder, version_folder):
+    """Points the snapshot symlink to the new version with a single rename"""
+    if os.path.isdir(folder) and not os.path.islink(folder):
+        # snapshot of an older release that is a plain folder. Replaced only once
+        os.rename(folder, tempfile.mkdtemp(dir=_get_versions_folder(folder), prefix='legacy-'))
+    tmp_link = os.path.join(os.path.dirname(version_folder), '.current-%s' % os.getpid())
+    if os.path.lexists(tmp_link):
+        os.remove(tmp_link)
+    os.symlink(os.path.relpath(version_folder, os.path.dirname(os.path.abspath(folder))), tmp_link)
+    os.replace(tmp_link, folder)
+
+
+def _remove_old_versions(folder):
+    """
+    Removes the snapshot versions except the current and the previous one.
+    The previous version is kept for readers that resolved the link just before the switch
+    """
+    current = os.path.realpath(folder)
+    versions_folder = _get_versions_folder(folder)
+    versions = [os.path.join(versions_folder, name) for name in os.listdir(versions_folder)
+                if not name.startswith('.') and os.path.join(versions_folder, name) != current]
+    versions = sorted((version for version in versions if os.path.isdir(version)), key=os.path.getmtime, reverse=True)
+    for version in versions[1:]:
+        shutil.rmtree(version, ignore_errors=True)
+
+
+def write_snapshot(accessions, folder, meta):
+    """
+    Writes the accession list to a new version folder and switches the snapshot symlink to it.
+    Readers either see the old or the new version, never a mix of both
+    """
+    accessions = sorted(accessions, key=lambda acc: int(acc['pk']))
+    versions_folder = _get_versions_folder(os.path.abspath(folder))
+    os.makedirs(versions_folder, exist_ok=True)
+    version_folder = tempfile.mkdtemp(dir=versions_folder, prefix=time.strftime('%Y%m%d%H%M%S-'))
+    offsets = [0]
+    with open(os.path.join(version_folder, RECORDS_FILE), 'wb') as fh:
+        for acc in accessions:
+            record = json.dumps(acc, separators=(',', ':')).encode() + b'\n'
+            fh.write(record)
+            offsets.append(offsets[-1] + len(record))
+    np.save(os.path.join(version_folder, IDS_FILE), np.array([int(acc['pk']) for acc in accessions], dtype=np.int64))
+    np.save(os.path.join(version_folder, OFFSETS_FILE), np.array(offsets, dtype=np.int64))
+    # same representation as the accession infos of the (camelCase) API
+    bundle = json.dumps(camelize({str(acc['pk']): _add_links(dict(acc)) for acc in accessions}), separators=(',', ':')).encode()
+    with open(os.path.join(version_folder, BUNDLE_FILE), 'wb') as fh:
+        fh.write(bundle)
+    meta = dict(meta, count=len(accessions), refreshed=time.time(), fingerprint=hashlib.md5(bundle).hexdigest()[:16])
+    with open(os.path.join(version_folder, META_FILE), 'w') as fh:
+        json.dump(meta, fh)
+    _switch_snapshot(os.path.abspath(folder), version_folder)
+    _remove_old_versions(os.path.abspath(folder))
+
+
+def _touch_snapshot(folder, meta):
+    meta = dict(meta, refreshed=time.time())
+    folder = os.path.realpath(folder)
+    tmp_file = os.path.join(folder, META_FILE + '.tmp')
+    with open(tmp_file, 'w') as fh:
+        json.dump(meta, fh)
+    os.replace(tmp_file, os.path.join(folder, META_FILE))
+
+
+def refresh_accession_map(force=False):
+    """
+    Refreshes the snapshot from ACCESSION_MAP_FILE or from AraPheno.
+    AraPheno is asked with the ETag of the snapshot so that an unchanged list is not downloaded again.
+    Returns True if the snapshot was replaced
+    """
+    folder = settings.ACCESSION_MAP_SNAPSHOT
+    meta = _get_meta(folder) if os.path.exists(os.path.join(folder, IDS_FILE)) else {}
+    if 'fingerprint' not in meta:
+        # snapshot without the browser bundle
+        force = True
+    if settings.ACCESSION_MAP_FILE:
+        version = str(os.stat(settings.ACCESSION_MAP_FILE).st_mtime)
+        if not force and meta.get('version') == version:
+            _touch_snapshot(folder, meta)
+            return False
+        with open(settings.ACCESSION_MAP_FILE) as fh:
+            accessions = json.load(fh)
+        write_snapshot(accessions, folder, {'source': settings.ACCESSION_MAP_FILE, 'version': version})
+        return True
+    headers = {}
+    if not force and meta.get('etag'):
+        headers['If-None-Match'] = meta['etag']
+    ret = requests.get(settings.ACCESSION_REST_MAP_URL, headers=headers, timeout=settings.ACCESSION_MAP_TIMEOUT)
+    if ret.status_code == 304:
+        _touch_snapshot(folder, meta)
+        return False
+    ret.raise_for_status()
+    write_snapshot(ret.json(), folder, {'source': settings.ACCESSION_REST_MAP_URL, 'version': ret.headers.get('ETag'),
+                                        'etag': ret.headers.get('ETag')})
+    return True
+
+
+def _refresh_in_background():
+    if not _refresh_lock.acquire(blocking=False):
+        return
+
+    def refresh():
+        try:
+            refresh_accession_map()
+        except Exception as err:
+            logger.warning('Could not refresh the accession map: %s', repr(err))
+        finally:
+            _refresh_lock.release()
+    threading.Thread(target=refresh, name='refresh-accession-map', daemon=True).start()
+
+
+@lru_cache(maxsize=2)
+def _open_accession_map(version_folder):
+    return AccessionMap(version_folder)
+
+
+def get_accession_map():
+    """
+    Returns the accession map of the current snapshot.
+    Without a snapshot an empty map is returned at once, the snapshot is never fetched on the request thread.
+    It is created by `refresh_accessions` on startup and refreshed in the background when it is missing or outdated
+    """
+    global _last_check
+    folder = settings.ACCESSION_MAP_SNAPSHOT
+    # resolve the link once, so that all files are read from the same version
+    version_folder = os.path.realpath(folder)
+    now = time.time()
+    if now - _last_check > CHECK_INTERVAL:
+        _last_check = now
+        meta = _get_meta(version_folder)
+        if now - meta.get('refreshed', 0) > settings.ACCESSION_MAP_REFRESH_INTERVAL or 'fingerprint' not in meta:
+            _refresh_in_background()
+    if not os.path.exists(os.path.join(version_folder, IDS_FILE)):
+        return AccessionMap()
+    return _open_accession_map(version_folder)
@@ -0,0 +1,252 @@
+"""
+Load benchmark of the submission pipeline against the simulated cluster (see simulator.py).
+Concurrent submitters upload genotype files through the REST API and pollers follow the submissions
+like the browser does (long-poll the status and fetch the details when it changed) while task workers
+and optionally the background poller run in threads of the same process.
+The runs use a throw-away test database and media folder
+"""
+import json
+import logging
+import os
+import queue
+import random
+import shutil
+import tempfile
+import threading
+import time
+from collections import defaultdict
+import numpy as np
+from django.core.management import call_command
+from django.db import connection, connections
+from django.test import Client, override_settings
+from django.test.utils import setup_test_environment, teardown_test_environment
+from . import hpc
+from .models import ERROR, FINISHED
+from .simulator import SimulatedCluster
+
+logger = logging.getLogger(__name__)
+
+FINAL_STATUSES = (FINISHED, ERROR)
+CHROMOSOMES = ('1', '2', '3', '4', '5')
+
+
+def write_genotype_file(path, rnd, num_of_snps):
+    """Writes a synthetic VCF file with num_of_snps homozygous calls"""
+    with open(path, 'w') as fh:
+        fh.write('##fileformat=VCFv4.2\n')
+        fh.write('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tSAMPLE\n')
+        for position in sorted(rnd.sample(range(1, 30000000), num_of_snps)):
+            ref, alt = rnd.sample('ACGT', 2)
+            fh.write('%s\t%s\t.\t%s\t%s\t.\tPASS\t.\tGT\t%s\n' % (rnd.choice(CHROMOSOMES), position, ref, alt,
+                                                                 rnd.choice(('0/0', '1/1'))))
+
+
+def _is_done(data):
+    """Returns True if the submission and all its jobs reached a final state (status response)"""
+    if data['status'] == ERROR:
+        return True
+    if data['status'] != FINISHED:
+        return False
+    for job in data['jobs']:
+        if job['status'] not in FINAL_STATUSES:
+            return False
+        crosses_job = job.get('crossesjob')
+        if crosses_job and crosses_job['status'] not in FINAL_STATUSES:
+            return False
+    return True
+
+
+def _percentiles(values):
+    if not values:
+        return {'count': 0}
+    values = np.array(values) * 1000
+    return {'count': len(values), 'p50': float(np.percentile(values, 50)), 'p99': float(np.percentile(values, 99)),
+            'max': float(values.max())}
+
+
+class Benchmark(object):
+    """
+    Runs the benchmark. The latencies of the requests are recorded per endpoint (in ms),
+    the SSH calls of the simulated cluster per command
+    """
+
+    def __init__(self, submissions=20, submitters=4, pollers=4, workers=2, background_polling=False,
+                 poll_interval=2, longpoll_timeout=2, num_of_snps=5000, timeout=600, seed=None,
+                 scheduler_check_interval=10, **cluster_options):
+        self.submissions = submissions
+        self.submitters = submitters
+        self.pollers = pollers
+        self.workers = workers
+        self.background_polling = background_polling
+        self.poll_interval = poll_interval
+        self.longpoll_timeout = longpoll_timeout
+        self.scheduler_check_interval = scheduler_check_interval
+        self.num_of_snps = num_of_snps
+        self.timeout = timeout
+        self.seed = seed
+        self.cluster_options = cluster_options
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.results = defaultdict(int)
+        self.durations = []
+        self._lock = threading.Lock()
+        self._submitted = queue.Queue()
+        self._stop = threading.Event()
+
+    def _record(self, endpoint, started, response=None, error=None):
+        with self._lock:
+            self.latencies[endpoint].append(time.time() - started)
+            if error is not None or response.status_code >= 400:
+                self.errors[endpoint] += 1
+                logger.warning('%s failed: %s', endpoint, error or response.status_code)
+
+    def _request(self, client, endpoint, method, path, **kwargs):
+        started = time.time()
+        try:
+            response = getattr(client, method)(path, **kwargs)
+        except Exception as err:
+            self._record(endpoint, started, error=err)
+            return None
+        self._record(endpoint, started, response)
+        return response
+
+    def _submitter(self, index, folder):
+        rnd = random.Random('%s-submitter-%s' % (self.seed, index))
+        client = Client()
+        try:
+            for number in range(index, self.submissions, self.submitters):
+                path = os.path.join(folder, 'genotype-%s.vcf' % number)
+                write_genotype_file(path, rnd, self.num_of_snps)
+                with open(path) as fh:
+                    response = self._request(client, 'create', 'post', '/api/identify/', data={
+                        'genotype': fh, 'firstname': 'Bench', 'lastname': 'Mark %s' % number,
+                        'email': 'benchmark@example.org'})
+                if response is not None and response.status_code == 201:
+                    self._submitted.put((response.json()['id'], time.time(), None, None))
+                else:
+                    with self._lock:
+                        self.results['rejected'] += 1
+        finally:
+            connection.close()
+
+    def _poller(self):
+        client = Client()
+        try:
+            while not self._stop.is_set():
+                try:
+                    pk, submitted, status_etag, detail_etag = self._submitted.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                headers = {'HTTP_IF_NONE_MATCH': status_etag} if status_etag else {}
+                response = self._request(client, 'status', 'get', '/api/identify/%s/status/' % pk, **headers)
+                if response is None or response.status_code >= 400:
+                    self._submitted.put((pk, submitted, status_etag, detail_etag))
+                    continue
+                if response.status_code == 200:
+                    status_etag = response['ETag']
+                    data = response.json()
+                    headers = {'HTTP_IF_NONE_MATCH': detail_etag} if detail_etag else {}
+                    detail = self._request(client, 'detail', 'get', '/api/identify/%s/' % pk, **headers)
+                    if detail is not None and detail.has_header('ETag'):
+                        detail_etag = detail['ETag']
+                    if _is_done(data):
+                        with self._lock:
+                            self.durations.append(time.time() - submitted)
+                            self.results['error' if data['status'] == ERROR else 'finished'] += 1
+                        continue
+                self._submitted.put((pk, submitted, status_etag, detail_etag))
+        finally:
+            connection.close()
+
+    def _worker(self):
+        from . import services  # registers the tasks
+        from .tasks import claim_task, run_task, get_worker_name
+        worker = '%s-%s' % (get_worker_name(), threading.get_ident())
+        try:
+            while not self._stop.is_set():
+                task = claim_task(worker)
+                if task is None:
+                    self._stop.wait(0.2)
+                    continue
+                started = time.time()
+                run_task(task)
+                with self._lock:
+                    self.latencies['task:%s' % task.name].append(time.time() - started)
+        finally:
+            connection.close()
+
+    def _background_poller(self):
+        from .services import update_unfinished_submissions, collect_job_accounting
+        try:
+            while not self._stop.wait(self.poll_interval):
+                started = time.time()
+                update_unfinished_submissions()
+                try:
+                    collect_job_accounting()
+                except hpc.HPCUnavailableError as err:
+                    logger.warning('Could not collect accounting data: %s', err)
+                with self._lock:
+                    self.latencies['poll_hpc_jobs'].append(time.time() - started)
+        finally:
+            connection.close()
+
+    @staticmethod
+    def _start(target, args_list):
+        threads = [threading.Thread(target=target, args=args, daemon=True) for args in args_list]
+        for thread in threads:
+            thread.start()
+        return threads
+
+    def run(self):
+        """Runs the benchmark and returns the report"""
+        folder = tempfile.mkdtemp(prefix='arageno-benchmark-')
+        cluster = SimulatedCluster(root=os.path.join(folder, 'cluster'), seed=self.seed, **self.cluster_options)
+        accession_file = os.path.join(folder, 'accessions.json')
+        with open(accession_file, 'w') as fh:
+            json.dump([], fh)
+        overrides = override_settings(
+            MEDIA_ROOT=os.path.join(folder, 'media'), FILE_UPLOAD_MAX_MEMORY_SIZE=0,
+            ACCESSION_MAP_FILE=accession_file, ACCESSION_MAP_SNAPSHOT=os.path.join(folder, 'accessions'),
+            HPC_BACKGROUND_POLLING=self.background_polling, STATUS_LONGPOLL_TIMEOUT=self.longpoll_timeout,
+            STATUS_LONGPOLL_INTERVAL=min(1, self.longpoll_timeout), LOCAL_EXECUTOR_MAX_WALLTIME=0,
+            HPC_SCHEDULER_CHECK_INTERVAL=self.scheduler_check_interval)
+        # a database file instead of the in-memory database so that all threads see the same data
+        connection.settings_dict['TEST']['NAME'] = os.path.join(folder, 'benchmark.sqlite3')
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        overrides.enable()
+        hpc.set_connection_factory(cluster.connect)
+        try:
+            call_command('loaddata', 'initial', verbosity=0)
+            started = time.time()
+            threads = self._start(self._worker, [()] * self.workers) + self._start(self._poller, [()] * self.pollers)
+            if self.background_polling:
+                threads += self._start(self._background_poller, [()])
+            upload_folder = os.path.join(folder, 'uploads')
+            os.makedirs(upload_folder)
+            for thread in self._start(self._submitter, [(index, upload_folder) for index in range(self.submitters)]):
+                thread.join()
+            deadline = started + self.timeout
+            while sum(self.results.values()) < self.submissions and time.time() < deadline:
+                time.sleep(0.2)
+            wall_time = time.time() - started
+            self._stop.set()
+            for thread in threads:
+                thread.join()
+        finally:
+            hpc.set_connection_factory(None)
+            overrides.disable()
+            connections.close_all()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+            cluster.close()
+            shutil.rmtree(folder, ignore_errors=True)
+        self.results['unfinished'] = self.submissions - sum(self.results.values())
+        return {
+            'wall_time': wall_time,
+            'submissions': dict(self.results),
+            'end_to_end': _percentiles(self.durations),
+            'latencies': {endpoint: _percentiles(values) for endpoint, values in sorted(self.latencies.items())},
+            'errors': dict(self.errors),
+            'ssh_calls': dict(sorted(cluster.calls.items())),
+        }
@@ -0,0 +1,153 @@
+"""
+Execution backends for the parse, identify and crosses jobs.
+The HPC clusters (SLURM and PBS) are implemented in hpc.py. Small submissions are run by the LocalExecutor
+in a local process pool instead of waiting in the cluster queue
+"""
+import json
+import os
+import shutil
+import tempfile
+import logging
+from django.conf import settings
+from .models import FINISHED, PROCESSING, QUEUED, ERROR, LOCAL, GenotypeSubmission, IdentifyJob, CrossesJob
+from . import local_jobs
+
+logger = logging.getLogger(__name__)
+
+
+class Executor(object):
+    """
+    Interface of the backends that run the jobs of a submission.
+    The job ids are returned as Job.hpc_job_id
+    """
+    name = None
+    # identify jobs of several submissions can be submitted together (see services.submit_pending_identify_jobs)
+    supports_batch = False
+    # the jobs run in the process that submits them, so they are only submitted by the task workers
+    runs_in_process = False
+
+    def stage_in(self, genotype):
+        """Copies the genotype file of a submission to the backend"""
+        raise NotImplementedError
+
+    def submit_parse_job(self, genotype, on_hold=True):
+        """Submits the parse job of a submission"""
+        raise NotImplementedError
+
+    def submit_identify_jobs(self, jobs):
+        """Submits identify jobs. They wait for the parse job if it is not finished yet"""
+        raise NotImplementedError
+
+    def submit_crosses_job(self, job):
+        raise NotImplementedError
+
+    def get_jobs_status(self, job_ids):
+        """Returns the status of several jobs keyed by their job id"""
+        raise NotImplementedError
+
+    def stage_out(self, job):
+        """
+        Returns the results of a finished job.
+        For identify jobs the local path of the scores file is returned as well
+        """
+        raise NotImplementedError
+
+    def cleanup(self, genotype):
+        """Removes the files of a submission from the backend"""
+        raise NotImplementedError
+
+
+LOCAL_STATUS_DICT = {local_jobs.PENDING: QUEUED, local_jobs.RUNNING: PROCESSING,
+                     local_jobs.COMPLETED: FINISHED, local_jobs.FAILED: ERROR}
+
+
+class LocalExecutor(Executor):
+    """
+    Runs the snpmatch commands in a process pool of the process that submits them.
+    The jobs are only submitted by the task workers (the crosses jobs by services.submit_crosses_job_task),
+    never by a web server process. The state of the jobs is stored in LOCAL_EXECUTOR_FOLDER
+    """
+    name = LOCAL
+    runs_in_process = True
+
+    @staticmethod
+    def _get_workdir(genotype_id):
+        return os.path.join(settings.LOCAL_EXECUTOR_FOLDER, str(genotype_id))
+
+    @staticmethod
+    def _get_dataset_files(dataset):
+        name = dataset.name.lower()
+        dataset_folder = os.path.join(settings.LOCAL_EXECUTOR_DATASETS, name)
+        return os.path.join(dataset_folder, f'{name}.hdf5'), os.path.join(dataset_folder, f'{name}.acc.hdf5')
+
+    def _submit(self, genotype_id, command, after=None):
+        return local_jobs.submit_job(settings.LOCAL_EXECUTOR_FOLDER, self._get_workdir(genotype_id),
+                                     [[settings.LOCAL_EXECUTOR_SNPMATCH] + command],
+                                     max_workers=settings.LOCAL_EXECUTOR_PROCESSES,
+                                     timeout=settings.LOCAL_EXECUTOR_TIMEOUT, after=after)
+
+    def _read_json(self, genotype_id, filename):
+        with open(os.path.join(self._get_workdir(genotype_id), filename)) as fh:
+            return json.load(fh)
+
+    def stage_in(self, genotype):
+        workdir = self._get_workdir(genotype.id)
+        os.makedirs(workdir, exist_ok=True)
+        shutil.copyfile(genotype.genotype_file.path, os.path.join(workdir, f'{genotype.id}{genotype.get_file_ext()}'))
+
+    def submit_parse_job(self, genotype, on_hold=True):
+        # the identify jobs are started by the pool once the parse job finished, so it is never held
+        input_file = f'{genotype.id}{genotype.get_file_ext()}'
+        genotype.jobid = self._submit(genotype.id, ['parser', '-i', input_file, '-o', str(genotype.id)])
+        genotype.save()
+        logger.info('Parse job sucessfully submitted to the local pool (%s)' % genotype.jobid)
+        return genotype.jobid
+
+    def submit_identify_jobs(self, jobs):
+        job_ids = []
+        for job in jobs:
+            genotype = job.genotype
+            after = genotype.jobid if genotype.status != FINISHED else None
+            hdf5_file, hdf5_acc_file = self._get_dataset_files(job.dataset)
+            job.jobid = self._submit(genotype.id, ['inbred', '-v', '-i', f'{genotype.id}.npz', '-o', str(job.id),
+                                                   '-d', hdf5_file, '-e', hdf5_acc_file], after=after)
+            job.array_task_id = None
+            job.save()
+            job_ids.append(job.hpc_job_id)
+            logger.info('Identify job sucessfully submitted to the local pool (%s)' % job.jobid)
+        return job_ids
+
+    def submit_crosses_job(self, job):
+        genotype_id = job.identifyjob.genotype_id
+        hdf5_file, hdf5_acc_file = self._get_dataset_files(job.identifyjob.dataset)
+        job.jobid = self._submit(genotype_id, ['cross', '-i', f'{genotype_id}.npz', '-d', hdf5_file,
+                                               '-e', hdf5_acc_file, '-o', f'{job.pk}_crosses'])
+        job.save()
+        logger.info('Crosses job sucessfully submitted to the local pool (%s)' % job.jobid)
+
+    def get_jobs_status(self, job_ids):
+        statuses = {}
+        for job_id in job_ids:
+            state = local_jobs.read_state(settings.LOCAL_EXECUTOR_FOLDER, job_id.split(':', 1)[1])
+            statuses[job_id] = LOCAL_STATUS_DICT.get(state, ERROR)
+        return statuses
+
+    def stage_out(self, job):
+        if isinstance(job, GenotypeSubmission):
+            return self._read_json(job.id, f'{job.id}.stats.json')
+        if isinstance(job, CrossesJob):
+            return self._read_json(job.identifyjob.genotype_id, f'{job.pk}_crosses.matches.json')
+        if isinstance(job, IdentifyJob):
+            output_path = os.path.join(tempfile.gettempdir(), f"{job.id}.tsv")
+            shutil.copyfile(os.path.join(self._get_workdir(job.genotype_id), f'{job.id}.scores.txt'), output_path)
+            return self._read_json(job.genotype_id, f'{job.id}.matches.json'), output_path
+        raise ValueError(f'Object {job} not supported')
+
+    def cleanup(self, genotype):
+        job_ids = [genotype.jobid]
+        for identify_job in genotype.identifyjob_set.all():
+            job_ids.append(identify_job.jobid)
+            if hasattr(identify_job, 'crossesjob'):
+                job_ids.append(identify_job.crossesjob.jobid)
+        local_jobs.remove_states(settings.LOCAL_EXECUTOR_FOLDER, [job_id for job_id in job_ids if job_id])
+        shutil.rmtree(self._get_workdir(genotype.id), ignore_errors=True)
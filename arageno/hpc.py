@@ -3,39 +3,342 @@ Utility functions for interacting with HPC backend
 """
 import os
 from fabric import Connection
+from invoke.exceptions import UnexpectedExit
+from invoke.runners import Result
 from .models import GenotypeSubmission, IdentifyJob, CrossesJob
 from .models import get_identify_result_path, STATUS_CHOICES, CREATED, FINISHED, PROCESSING, FINISHED, QUEUED, ERROR
-from patchwork.files import exists
+from .models import LOCAL
+from .executors import Executor, LocalExecutor
+from .scores import convert_scores
+from .tasks import enqueue, is_pending
 from django.utils import timezone
 from django.core.files import File
+from django.db.models import Q
 import tempfile
 from datetime import datetime
+import hashlib
 import json
 import re
 import datetime, math
 from django.conf import settings
 import logging
+import queue
+import threading
+import time
+import uuid
 from collections import OrderedDict
+from contextlib import contextmanager
 
 logger = logging.getLogger(__name__)
 
 SBATCH_PATTERN = re.compile(r"Submitted batch job ([0-9]*)")
+# qsub prints <job id>.<server>
+QSUB_PATTERN = re.compile(r"([0-9]+)(\.\S*)?$")
+
+# Terminal states caused by the cluster. The job is resubmitted instead of failing
+RESUBMIT_TIMEOUT = -2
+RESUBMIT_OUT_OF_MEMORY = -3
+RESUBMIT_NODE_FAIL = -4
+RESUBMIT_PREEMPTED = -5
+RESUBMIT_STATUSES = {RESUBMIT_TIMEOUT: 'TIMEOUT', RESUBMIT_OUT_OF_MEMORY: 'OUT_OF_MEMORY',
+                     RESUBMIT_NODE_FAIL: 'NODE_FAIL', RESUBMIT_PREEMPTED: 'PREEMPTED'}
 
 SLURM_STATUS_DICT = {'COMPLETED': FINISHED, 'RUNNING': PROCESSING, 'COMPLETING': PROCESSING, '': FINISHED, 'PENDING': QUEUED }
-#FIXME make it configurable
-BASE_DIR = '/scratch-cbe/users/%s/AraGeno/' % settings.HPC_USER
-SUBMIT_SCRIPT_FOLDER = os.path.join(os.path.dirname(__file__),'submit_script_templates/CBE/')
+SLURM_STATUS_DICT.update({state: status for status, state in RESUBMIT_STATUSES.items()})
+# PBS job states (qstat job_state) as SLURM states. Finished jobs (F) are mapped by their exit status
+PBS_STATE_DICT = {'Q': 'PENDING', 'H': 'PENDING', 'W': 'PENDING', 'T': 'PENDING', 'S': 'PENDING',
+                  'R': 'RUNNING', 'E': 'COMPLETING', 'B': 'RUNNING'}
+# exit status of jobs killed by PBS (JOB_EXEC_KILL_WALLTIME, JOB_EXEC_KILL_MEM)
+PBS_EXIT_STATES = {0: 'COMPLETED', -29: 'TIMEOUT', -27: 'OUT_OF_MEMORY'}
+SUBMIT_SCRIPT_TEMPLATES = os.path.join(os.path.dirname(__file__), 'submit_script_templates')
+# scores several samples against one dataset in a single process
+BATCH_DRIVER = 'identify_batch.py'
+# Inserted into the submit scripts (%(sentinel)s). The job touches <job id>.started in the spool folder when it starts
+# and writes <job id>.done with its exit code, start and end time and the md5 checksums of the result files when it exits.
+# Jobs that are killed (SIGKILL) or never start do not write a sentinel
+SENTINEL_SCRIPT = r'''# completion sentinel for the server
+SENTINEL=%(spool_folder)s/%(job_id)s
+STARTED=$(date +%%s)
+mkdir -p %(spool_folder)s && touch $SENTINEL.started || true
+write_sentinel() {
+    EXIT_CODE=$?
+    CHECKSUMS=$(md5sum %(files)s 2>/dev/null | awk '{printf "%%s\"%%s\": \"%%s\"", (NR > 1 ? ", " : ""), $2, $1}')
+    echo "{\"exit_code\": $EXIT_CODE, \"started\": $STARTED, \"finished\": $(date +%%s), \"checksums\": {$CHECKSUMS}}" > $SENTINEL.tmp
+    mv $SENTINEL.tmp $SENTINEL.done
+}
+trap write_sentinel EXIT
+# jobs killed by the time limit are terminated (SIGTERM) and must not report success
+trap 'exit 143' TERM'''
 
 connect_kwargs=None
 
 if settings.SSH_KEY_FILENAME:
     connect_kwargs = { "key_filename": settings.SSH_KEY_FILENAME}
 
-c = Connection(settings.HPC_HOST, user=settings.HPC_USER, connect_kwargs=connect_kwargs)
 
+class HPCUnavailableError(Exception):
+    """Raised when the HPC can not be reached"""
+
+
+class HPCJobFailedError(Exception):
+    """Raised when the sample of a job failed although the job itself succeeded (identify batch jobs)"""
+
+
+class CircuitBreaker(object):
+    """
+    Stops calling the HPC after a number of consecutive failures
+    and only lets a single trial call through after the reset timeout
+    """
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self._opened_at is not None
+
+    @property
+    def is_available(self):
+        """False while the circuit is open and the reset timeout did not pass yet"""
+        opened_at = self._opened_at
+        return opened_at is None or time.time() - opened_at >= self.reset_timeout
+
+    def check(self):
+        """Raises HPCUnavailableError if the circuit is open"""
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if time.time() - self._opened_at < self.reset_timeout:
+                raise HPCUnavailableError('HPC is unavailable (%s consecutive failures)' % self._failures)
+            # half-open: let the next call through and re-open the circuit if it fails
+            self._opened_at = time.time()
+
+    def record_success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                logger.info('HPC connection recovered')
+            self._failures = 0
+            self._opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.failure_threshold:
+                if self._opened_at is None:
+                    logger.error('HPC unavailable after %s failures. Opening circuit', self._failures)
+                self._opened_at = time.time()
+
+
+class ConnectionPool(object):
+    """
+    Bounded pool of SSH connections. Each thread checks out its own connection
+    """
+
+    def __init__(self, factory, size, keepalive=None, checkout_timeout=None):
+        self._factory = factory
+        self._keepalive = keepalive
+        self._checkout_timeout = checkout_timeout
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def _connect(self):
+        conn = self._factory()
+        conn.open()
+        if self._keepalive and getattr(conn, 'transport', None):
+            conn.transport.set_keepalive(self._keepalive)
+        return conn
+
+    @staticmethod
+    def _is_healthy(conn):
+        return conn.is_connected
+
+    def _checkout(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                return self._connect()
+            if self._is_healthy(conn):
+                return conn
+            logger.info('Discarding stale HPC connection')
+            conn.close()
+
+    @contextmanager
+    def connection(self):
+        """Checks out a connection and returns it to the pool when it is still usable"""
+        if not self._slots.acquire(timeout=self._checkout_timeout):
+            raise HPCUnavailableError('No free HPC connection')
+        conn = None
+        try:
+            conn = self._checkout()
+            yield conn
+        finally:
+            if conn is not None:
+                if self._is_healthy(conn):
+                    self._idle.put(conn)
+                else:
+                    conn.close()
+            self._slots.release()
+
+    def close(self):
+        """Closes all idle connections"""
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class HPCCommandError(Exception):
+    """Raised when a command of a batch failed on the cluster"""
+
+
+# shell commands of the agent operations for connections without agent
+DIRECT_COMMANDS = {'run': '%(cmd)s', 'exists': 'test -e %(path)s', 'mkdir': 'mkdir -p %(path)s',
+                   'read': 'cat %(path)s', 'remove': 'rm -fr %(path)s',
+                   'list': "find %(path)s -maxdepth 1 -type f -printf '%%f %%T@\\n'"}
+
+
+def _execute_directly(conn, command):
+    """Executes one agent command (see submit_script_templates/hpc_agent.py) with a single SSH call"""
+    op = command['op']
+    if op == 'write':
+        with tempfile.NamedTemporaryFile(delete=False) as fp:
+            fp.write(command['content'].encode())
+        try:
+            conn.put(fp.name, command['path'])
+        finally:
+            os.unlink(fp.name)
+        return {'ok': True}
+    if op == 'ping':
+        return {'ok': True, 'value': None}
+    if op not in DIRECT_COMMANDS:
+        return {'ok': False, 'error': 'Unknown operation'}
+    output = conn.run(DIRECT_COMMANDS[op] % command, warn=True, hide=True, timeout=settings.HPC_COMMAND_TIMEOUT)
+    if op == 'exists':
+        return {'ok': True, 'value': not output.failed}
+    if op == 'list':
+        # the folder does not exist if find fails
+        files = dict(line.rsplit(' ', 1) for line in output.stdout.splitlines() if ' ' in line)
+        return {'ok': True, 'value': {name: float(mtime) for name, mtime in files.items()}}
+    result = {'ok': not output.failed, 'exited': output.exited, 'stdout': output.stdout, 'stderr': output.stderr}
+    if op == 'read':
+        result['value'] = output.stdout
+    return result
+
+
+def _call_directly(conn, commands, stop_on_error=False):
+    """Executes a batch of agent commands on a connection without agent (one SSH call per command)"""
+    results = []
+    for command in commands:
+        if stop_on_error and results and not results[-1]['ok']:
+            results.append({'ok': False, 'error': 'Skipped'})
+            continue
+        results.append(_execute_directly(conn, command))
+    return results
+
+
+class AgentConnection(object):
+    """
+    SSH connection that executes the commands with the agent (submit_script_templates/hpc_agent.py)
+    on the login node. The agent runs in one long-lived SSH channel and executes a batch of commands
+    per request, so a batch costs a single round trip. The agent is uploaded to agent_dir once.
+    If it can not be started, the batches are executed with one SSH call per command.
+    Files are still transferred with SFTP
+    """
+    script = os.path.join(os.path.dirname(__file__), 'submit_script_templates', 'hpc_agent.py')
+
+    def __init__(self, connection, agent_dir, python='python3'):
+        self.connection = connection
+        self.agent_dir = agent_dir
+        self.python = python
+        self._stdin = self._stdout = self._channel = None
+        self._request_id = 0
+
+    @property
+    def transport(self):
+        return self.connection.transport
+
+    @property
+    def is_connected(self):
+        if not self.connection.is_connected:
+            return False
+        return self._channel is None or not (self._channel.closed or self._channel.exit_status_ready())
+
+    def _deploy(self):
+        """Uploads the agent unless the current version is already on the login node"""
+        with open(self.script, 'rb') as fh:
+            version = hashlib.md5(fh.read()).hexdigest()[:12]
+        path = os.path.join(self.agent_dir, 'hpc_agent-%s.py' % version)
+        if self.connection.run('test -e %s' % path, warn=True, hide=True).failed:
+            self.connection.run('mkdir -p %s' % self.agent_dir, hide=True)
+            self.connection.put(self.script, path)
+        return path
+
+    def open(self):
+        self.connection.open()
+        try:
+            path = self._deploy()
+            stdin, stdout, _ = self.connection.client.exec_command('%s -u %s' % (self.python, path))
+            self._stdin, self._stdout, self._channel = stdin, stdout, stdout.channel
+            self.call([{'op': 'ping'}])
+        except Exception as err:
+            logger.warning('Failed to start the HPC agent, falling back to single commands: %r', err)
+            self._close_channel()
+
+    def _close_channel(self):
+        if self._channel is not None:
+            self._channel.close()
+        self._stdin = self._stdout = self._channel = None
 
-WALLTIME_MULTIPLIER = 2
-MEMORY_MULTIPLIER = 5
+    def close(self):
+        self._close_channel()
+        self.connection.close()
+
+    def call(self, commands, stop_on_error=False, timeout=None):
+        """Executes a batch of commands and returns one result per command"""
+        if self._channel is None:
+            return _call_directly(self.connection, commands, stop_on_error)
+        self._request_id += 1
+        request = {'id': self._request_id, 'commands': commands, 'stop_on_error': stop_on_error}
+        try:
+            self._channel.settimeout(timeout or settings.HPC_COMMAND_TIMEOUT)
+            self._stdin.write(json.dumps(request) + '\n')
+            self._stdin.flush()
+            line = self._stdout.readline()
+            if not line:
+                raise EOFError('HPC agent exited')
+            response = json.loads(line)
+            if response.get('id') != self._request_id:
+                raise ValueError('Unexpected response of the HPC agent: %s' % response.get('error', line[:200]))
+        except Exception:
+            # the channel is out of sync; the pool discards the connection
+            self._channel.close()
+            raise
+        return response['results']
+
+    def run(self, cmd, warn=False, hide=None, timeout=None, **kwargs):
+        result = self.call([{'op': 'run', 'cmd': cmd}], timeout=timeout)[0]
+        if 'exited' not in result:
+            raise HPCCommandError(result.get('error'))
+        output = Result(stdout=result['stdout'], stderr=result['stderr'], command=cmd, exited=result['exited'])
+        if output.failed and not warn:
+            raise UnexpectedExit(output)
+        return output
+
+    def put(self, local, remote):
+        return self.connection.put(local, remote)
+
+    def get(self, remote, local):
+        return self.connection.get(remote, local)
+
+
+WALLTIME_MULTIPLIER = settings.HPC_WALLTIME_MULTIPLIER
+MEMORY_MULTIPLIER = settings.HPC_MEMORY_MULTIPLIER
 DEFAULT_MEMORY = (1024*1024* 4)
 MIN_MEMORY=1024*1024*4
 DEFAULT_WALLTIME = 1200
@@ -48,242 +351,924 @@ def sizeof_fmt(num, suffix='b'):
         num /= 1024.0
     return "%.0f%s%s" % (num, 'y', suffix)
 
-def _get_memory(memory):
-    # convert to bytes
+def _get_memory_kb(memory, factor=1):
     if not memory:
         memory = DEFAULT_MEMORY
-    memory = math.ceil(max(memory * MEMORY_MULTIPLIER,MIN_MEMORY) )
-    return sizeof_fmt(memory)
+    return min(math.ceil(max(memory * MEMORY_MULTIPLIER,MIN_MEMORY) * factor), settings.HPC_MAX_MEMORY)
 
-def _get_walltime(walltime):
+def _get_memory(memory, factor=1):
+    return sizeof_fmt(_get_memory_kb(memory, factor))
+
+def _get_walltime_seconds(walltime, factor=1):
     if not walltime:
         walltime = DEFAULT_WALLTIME
-    return str(datetime.timedelta(seconds=math.ceil(max(walltime * WALLTIME_MULTIPLIER,MIN_WALLTIME) )))
-
-def _read_file(id, filename):
-    target_folder = _get_target_folder(id)
-    return c.run(f"cd {target_folder} && cat {filename}" ,pty=True, hide=True)
-
+    return min(math.ceil(max(walltime * WALLTIME_MULTIPLIER,MIN_WALLTIME) * factor), settings.HPC_MAX_WALLTIME)
 
+def _get_walltime(walltime, factor=1):
+    return str(datetime.timedelta(seconds=_get_walltime_seconds(walltime, factor)))
 
-def _get_target_folder(id):
-    return os.path.join(BASE_DIR, str(id))
 
 def _get_genotype(id):
     return GenotypeSubmission.objects.get(pk=id)
 
-def _get_rendered_submit_script(submit_script, ctx):
-    with open(os.path.join(SUBMIT_SCRIPT_FOLDER, submit_script)) as fh:
-        content = fh.read()
-        return content % ctx
 
+def _parse_slurm_duration(value):
+    """Converts a sacct duration ([D-][HH:]MM:SS[.mmm]) to seconds"""
+    if not value:
+        return None
+    days = 0
+    if '-' in value:
+        days, value = value.split('-', 1)
+    seconds = 0.0
+    for part in value.split(':'):
+        seconds = seconds * 60 + float(part)
+    return int(days) * 86400 + seconds
+
+
+def _parse_slurm_memory(value):
+    """Converts a sacct memory value (e.g. 1024K, 12.5M) to kilobytes"""
+    if not value:
+        return None
+    units = {'K': 1, 'M': 1024, 'G': 1024 ** 2, 'T': 1024 ** 3}
+    if value[-1].upper() in units:
+        return float(value[:-1]) * units[value[-1].upper()]
+    return float(value) / 1024
 
 
-def stagein_identify_job(id, force=False):
+def _parse_pbs_memory(value):
+    """Converts a PBS memory value (e.g. 1024kb, 12mb) to kilobytes"""
+    if not value:
+        return None
+    units = {'b': 1 / 1024, 'kb': 1, 'mb': 1024, 'gb': 1024 ** 2, 'tb': 1024 ** 3}
+    match = re.match(r'([0-9.]+)([a-z]*)$', value.lower())
+    if not match or match.group(2) not in units:
+        return None
+    return float(match.group(1)) * units[match.group(2) or 'b']
+
+
+class Scheduler(object):
     """
-    Function to stagein the genotype files
+    Commands of a batch scheduler dialect. The job ids are the ids of the scheduler
+    (without the cluster prefix of Job.hpc_job_id)
     """
-    target_folder = _get_target_folder(id)
-    if not force and exists(c, path=os.path.join(target_folder, str(id))):
-        return
-    genotype = _get_genotype(id)
-    ext = genotype.get_file_ext()
-    c.run(f'mkdir -p  {target_folder}')
-    c.put(genotype.genotype_file.path, f"{target_folder}/{id}{ext}")
+    name = None
+    # identify jobs are submitted as job arrays (and batch jobs) instead of one job per identify job
+    supports_arrays = False
+    # shell expressions of the job id (as returned by parse_job_id) within a running job or array task
+    job_id_variable = None
+    array_task_id_variable = None
 
+    def get_submit_command(self, script_path, on_hold=False, after=()):
+        """Returns the command that submits a script, optionally held or waiting for other jobs to complete"""
+        raise NotImplementedError
 
-def upload_submit_script(script, target_folder, filename):
-    with tempfile.NamedTemporaryFile(delete=False) as fp:
-        fp.write(script.encode())
-    c.put(fp.name, os.path.join(target_folder,filename))
-    os.unlink(fp.name)
+    def parse_job_id(self, output):
+        raise NotImplementedError
 
+    def get_release_command(self, job_ids):
+        raise NotImplementedError
 
+    def get_jobs_status(self, cluster, job_ids):
+        """Returns the status of several jobs keyed by their job id"""
+        raise NotImplementedError
 
-def submit_parse_job(id, on_hold=True):
-    """
-    Submit job to parse genotype
-    """
-    genotype = _get_genotype(id)
-    ext = genotype.get_file_ext()
-    target_folder = _get_target_folder(id)
-    job_script = 'parse_job.sh'
-    ctx = {
-        "walltime": _get_walltime(genotype.walltime),
-        "memory": _get_memory(genotype.memory),
-        "id": id,
-        "input_file": '%s%s' % (id, ext),
-        "workdir": target_folder
-    }
-    rendered_script = _get_rendered_submit_script(job_script, ctx)
-    upload_submit_script(rendered_script, target_folder, job_script)
-    on_hold_flag = "-H" if on_hold else ""
-    sbatch_cmd = f"sbatch {on_hold_flag} {target_folder}/{job_script}"
-    logger.info("SBATCH call: %s" % sbatch_cmd)
-    sbatch_output = c.run(sbatch_cmd)
-    if sbatch_output.failed:
-      raise Exception("Failed to submit Job: %s" % sbatch_output.stderr)
-    match = SBATCH_PATTERN.match(sbatch_output.stdout)
-    if not match:
-        raise Exception('Failed to get jobid' % sbatch_output.stdout )
-    job_id = match.group(1)
-    genotype.jobid = job_id
-    genotype.save()
-    logger.info('Parse job sucessfully submitted (%s)' % job_id)
-    return job_id
-
-def get_parse_job_result(job):
+    def get_jobs_accounting(self, cluster, job_ids):
+        """Returns state (SLURM state names), elapsed time, total CPU time and peak memory (kb) of finished jobs"""
+        raise NotImplementedError
+
+
+class SlurmScheduler(Scheduler):
+    name = 'slurm'
+    supports_arrays = True
+    job_id_variable = '$SLURM_JOB_ID'
+    array_task_id_variable = '${SLURM_ARRAY_JOB_ID}_${SLURM_ARRAY_TASK_ID}'
+
+    def get_submit_command(self, script_path, on_hold=False, after=()):
+        on_hold_flag = "-H" if on_hold else ""
+        depends = '-d afterok:%s' % ':'.join(after) if after else ''
+        return f"sbatch {on_hold_flag} {depends} {script_path}"
+
+    def parse_job_id(self, output):
+        match = SBATCH_PATTERN.match(output)
+        return match.group(1) if match else None
+
+    def get_release_command(self, job_ids):
+        return 'scontrol release %s' % ','.join(job_ids)
+
+    def get_jobs_status(self, cluster, job_ids):
+        """
+        Returns the status of several SLURM jobs using one squeue call. sacct is only asked for the jobs
+        that dropped out of the queue. Array tasks are queried as <array job id>_<task id>.
+        Jobs that neither squeue nor sacct know are left out (unknown)
+        """
+        job_ids = sorted(set(str(job_id) for job_id in job_ids if job_id))
+        if not job_ids:
+            return {}
+        slurm_states = {}
+        squeue_cmd = "squeue -r -j %s -o '%%i %%T' -h" % ','.join(job_ids)
+        squeue_output = cluster.call([{'op': 'run', 'cmd': squeue_cmd}])[0]
+        if squeue_output['ok']:
+            for line in squeue_output['stdout'].splitlines():
+                fields = line.split()
+                if len(fields) == 2:
+                    slurm_states[fields[0]] = fields[1]
+        missing_job_ids = [job_id for job_id in job_ids if job_id not in slurm_states]
+        if missing_job_ids:
+            sacct_cmd = "sacct -j %s -o jobid,state -pn" % ','.join(missing_job_ids)
+            sacct_output = cluster.call([{'op': 'run', 'cmd': sacct_cmd}])[0]
+            # Prefer the state of the batch step over the allocation
+            batch_states = {}
+            for line in sacct_output.get('stdout', '').splitlines():
+                fields = line.split('|')
+                if len(fields) < 2:
+                    continue
+                sacct_job_id, state = fields[0], fields[1].split(' ')[0]
+                if sacct_job_id.endswith('.batch') and sacct_job_id[:-len('.batch')] in missing_job_ids:
+                    batch_states[sacct_job_id[:-len('.batch')]] = state
+                elif sacct_job_id in missing_job_ids:
+                    slurm_states[sacct_job_id] = state
+            for job_id, state in batch_states.items():
+                # the batch step is only CANCELLED when the allocation ran into its time limit or lost its node
+                if SLURM_STATUS_DICT.get(slurm_states.get(job_id)) not in RESUBMIT_STATUSES:
+                    slurm_states[job_id] = state
+        statuses = {}
+        for job_id in job_ids:
+            if job_id not in slurm_states:
+                logger.warning('SLURM job %s is unknown to squeue and sacct' % job_id)
+                continue
+            statuses[job_id] = SLURM_STATUS_DICT.get(slurm_states[job_id], ERROR)
+        return statuses
+
+    def get_jobs_accounting(self, cluster, job_ids):
+        """Uses one sacct call. MaxRSS is only reported for the job steps, so the largest step is used"""
+        job_ids = sorted(set(str(job_id) for job_id in job_ids if job_id))
+        if not job_ids:
+            return {}
+        check_cmd = "sacct -j %s -o jobid,state,elapsed,totalcpu,maxrss -pn --units=K" % ','.join(job_ids)
+        check_output = cluster.call([{'op': 'run', 'cmd': check_cmd}])[0]
+        accounting = {}
+        for line in check_output.get('stdout', '').splitlines():
+            fields = line.split('|')
+            if len(fields) < 5:
+                continue
+            sacct_job_id = fields[0].split('.')[0]
+            if sacct_job_id not in job_ids:
+                continue
+            data = accounting.setdefault(sacct_job_id, {'max_rss': None})
+            max_rss = _parse_slurm_memory(fields[4])
+            if max_rss is not None:
+                data['max_rss'] = max(data['max_rss'] or 0, max_rss)
+            if sacct_job_id == fields[0]:
+                data['state'] = fields[1].split(' ')[0]
+                data['elapsed'] = _parse_slurm_duration(fields[2])
+                data['total_cpu'] = _parse_slurm_duration(fields[3])
+        return {job_id: data for job_id, data in accounting.items() if 'state' in data}
+
+
+class PBSScheduler(Scheduler):
+    name = 'pbs'
+    job_id_variable = '$(echo $PBS_JOBID | cut -d. -f1)'
+
+    def get_submit_command(self, script_path, on_hold=False, after=()):
+        on_hold_flag = "-h" if on_hold else ""
+        depends = '-W depend=afterok:%s' % ':'.join(after) if after else ''
+        return f"qsub {on_hold_flag} {depends} {script_path}"
+
+    def parse_job_id(self, output):
+        match = QSUB_PATTERN.match(output.strip())
+        return match.group(1) if match else None
+
+    def get_release_command(self, job_ids):
+        return 'qrls %s' % ' '.join(job_ids)
+
+    @staticmethod
+    def _qstat(cluster, job_ids):
+        """Returns the attributes of several (also finished) jobs using one qstat call"""
+        check_output = cluster.call([{'op': 'run', 'cmd': 'qstat -x -f %s' % ' '.join(job_ids)}])[0]
+        jobs = {}
+        attributes = None
+        for line in check_output.get('stdout', '').splitlines():
+            if line.startswith('Job Id:'):
+                attributes = jobs.setdefault(line.split(':', 1)[1].strip().split('.')[0], {})
+            elif attributes is not None and ' = ' in line:
+                key, value = line.strip().split(' = ', 1)
+                attributes[key] = value
+        return jobs
+
+    @staticmethod
+    def _get_state(attributes):
+        state = attributes.get('job_state')
+        if state in PBS_STATE_DICT:
+            return PBS_STATE_DICT[state]
+        try:
+            return PBS_EXIT_STATES.get(int(attributes['Exit_status']), 'FAILED')
+        except (KeyError, ValueError):
+            # deleted before it ran
+            return 'CANCELLED'
+
+    def get_jobs_status(self, cluster, job_ids):
+        job_ids = sorted(set(str(job_id) for job_id in job_ids if job_id))
+        if not job_ids:
+            return {}
+        jobs = self._qstat(cluster, job_ids)
+        statuses = {}
+        for job_id in job_ids:
+            state = self._get_state(jobs[job_id]) if job_id in jobs else None
+            statuses[job_id] = SLURM_STATUS_DICT.get(state, ERROR)
+        return statuses
+
+    def get_jobs_accounting(self, cluster, job_ids):
+        job_ids = sorted(set(str(job_id) for job_id in job_ids if job_id))
+        if not job_ids:
+            return {}
+        accounting = {}
+        for job_id, attributes in self._qstat(cluster, job_ids).items():
+            if attributes.get('job_state') != 'F':
+                continue
+            accounting[job_id] = {'state': self._get_state(attributes),
+                                  'elapsed': _parse_slurm_duration(attributes.get('resources_used.walltime')),
+                                  'total_cpu': _parse_slurm_duration(attributes.get('resources_used.cput')),
+                                  'max_rss': _parse_pbs_memory(attributes.get('resources_used.mem'))}
+        return accounting
+
+
+SCHEDULERS = {scheduler.name: scheduler for scheduler in (SlurmScheduler(), PBSScheduler())}
+
+
+class HPCExecutor(Executor):
     """
-    Stage out the statistics from the parse job
+    Runs the jobs on an HPC cluster of HPC_CLUSTERS. Every cluster has its own
+    connection pool and circuit breaker, so an unreachable cluster does not block the others
     """
-    output_result = _read_file(job.id, f"{job.id}.stats.json")
-    return json.loads(output_result.stdout)
 
-def get_crosses_job_result(job):
-    """Returns the results from the crosses_check"""
-    output_result = _read_file(job.identifyjob.genotype.id, f'{job.pk}_crosses.matches.json')
-    return json.loads(output_result.stdout)
+    def __init__(self, name, host, scheduler, templates, base_dir, datasets, project='', user=None, python=None):
+        self.name = name
+        self.host = host
+        self.user = user or settings.HPC_USER
+        self.scheduler = SCHEDULERS[scheduler]
+        self.template_folder = os.path.join(SUBMIT_SCRIPT_TEMPLATES, templates)
+        self.base_dir = base_dir
+        # driver of the identify batch jobs. The scripts, index files and logs of the job arrays and batch jobs
+        # are stored in the folder of their first submission and removed with it (see cleanup)
+        self.array_folder = os.path.join(base_dir, 'arrays')
+        # sentinels of the finished jobs
+        self.spool_folder = os.path.join(base_dir, 'spool')
+        self.dataset_folder = datasets
+        self.project = project
+        # python of the login node that runs the agent
+        self.python = python or settings.HPC_AGENT_PYTHON
+        self._pool = None
+        self.set_connection_factory(None)
+
+    def __repr__(self):
+        return 'HPCExecutor(%s, %s@%s)' % (self.name, self.scheduler.name, self.host)
+
+    def _create_connection(self):
+        connection = Connection(self.host, user=self.user, connect_kwargs=connect_kwargs,
+                                connect_timeout=settings.HPC_CONNECT_TIMEOUT)
+        if settings.HPC_AGENT:
+            return AgentConnection(connection, os.path.join(self.base_dir, '.agent'), self.python)
+        return connection
+
+    def set_connection_factory(self, factory=None):
+        """
+        Replaces the connection pool with one that opens its connections with factory
+        (e.g. simulator.SimulatedCluster.connect). Without a factory the SSH connections are restored
+        """
+        if self._pool is not None:
+            self._pool.close()
+        self._pool = ConnectionPool(factory or self._create_connection, settings.HPC_POOL_SIZE,
+                                    settings.HPC_KEEPALIVE, settings.HPC_CONNECT_TIMEOUT)
+        self._breaker = CircuitBreaker(settings.HPC_CIRCUIT_BREAKER_THRESHOLD, settings.HPC_CIRCUIT_BREAKER_RESET)
+        # sentinels of the finished jobs and the last time the scheduler was asked for the jobs without sentinel
+        self._sentinels = {}
+        self._scheduler_checks = {}
+
+    @property
+    def is_available(self):
+        return self._breaker.is_available
 
+    @property
+    def supports_batch(self):
+        return self.scheduler.supports_arrays and os.path.exists(os.path.join(self.template_folder, 'identify_batch_job.sh'))
 
-def get_identify_job_result(job):
+    @contextmanager
+    def connection(self):
+        """
+        Checks out a pooled connection and records the outcome in the circuit breaker.
+        Failing commands (UnexpectedExit) do not count as an outage, any other error
+        is raised as HPCUnavailableError
+        """
+        self._breaker.check()
+        try:
+            with self._pool.connection() as conn:
+                yield conn
+        except UnexpectedExit:
+            self._breaker.record_success()
+            raise
+        except HPCUnavailableError:
+            raise
+        except Exception as err:
+            self._breaker.record_failure()
+            raise HPCUnavailableError('HPC call to %s failed: %r' % (self.name, err)) from err
+        else:
+            self._breaker.record_success()
+
+    def run(self, cmd, **kwargs):
+        kwargs.setdefault('timeout', settings.HPC_COMMAND_TIMEOUT)
+        with self.connection() as conn:
+            return conn.run(cmd, **kwargs)
+
+    def put(self, local, remote):
+        with self.connection() as conn:
+            return conn.put(local, remote)
+
+    def get(self, remote, local):
+        with self.connection() as conn:
+            return conn.get(remote, local)
+
+    def call(self, commands, stop_on_error=False):
+        """
+        Executes a batch of commands (see submit_script_templates/hpc_agent.py) and returns one result per command.
+        With the agent the batch costs one round trip, otherwise one SSH call per command
+        """
+        if not commands:
+            return []
+        with self.connection() as conn:
+            if callable(getattr(conn, 'call', None)):
+                return conn.call(commands, stop_on_error)
+            return _call_directly(conn, commands, stop_on_error)
+
+    @staticmethod
+    def _check(results):
+        """Raises HPCCommandError for the first failed command of a batch"""
+        for result in results:
+            if not result['ok']:
+                raise HPCCommandError(result.get('error') or result.get('stderr'))
+
+    def _read_files(self, paths, job_id=None, failure_marker=None):
+        """
+        Returns the content of several files using one batch. The files are verified with the sentinel of the job.
+        Raises HPCJobFailedError if the failure_marker file exists
+        """
+        commands = [{'op': 'read', 'path': path} for path in paths]
+        if failure_marker:
+            marker_result, *results = self.call([{'op': 'exists', 'path': failure_marker}] + commands)
+            if marker_result.get('value'):
+                raise HPCJobFailedError('%s exists' % failure_marker)
+        else:
+            results = self.call(commands)
+        self._check(results)
+        checksums = self._sentinels.get(job_id, {}).get('checksums', {})
+        for path, result in zip(paths, results):
+            if path in checksums and hashlib.md5(result['value'].encode()).hexdigest() != checksums[path]:
+                raise HPCCommandError('%s does not match the checksum of the sentinel' % path)
+        return [result['value'] for result in results]
+
+    def get_target_folder(self, id):
+        return os.path.join(self.base_dir, str(id))
+
+    def _get_sentinel_script(self, files, array=False):
+        """Returns the part of a submit script that writes the sentinel of the job (see SENTINEL_SCRIPT)"""
+        if not settings.HPC_SENTINELS:
+            return ''
+        job_id = self.scheduler.array_task_id_variable if array else self.scheduler.job_id_variable
+        return SENTINEL_SCRIPT % {'spool_folder': self.spool_folder, 'job_id': job_id, 'files': files}
+
+    def _get_rendered_submit_script(self, submit_script, ctx):
+        ctx = dict(ctx, dataset_folder=self.dataset_folder, project=self.project)
+        with open(os.path.join(self.template_folder, submit_script)) as fh:
+            content = fh.read()
+            return content % ctx
+
+    def _get_submit_commands(self, script_path, script, on_hold=False, after=()):
+        """Returns the commands that upload and submit a script"""
+        submit_cmd = self.scheduler.get_submit_command(script_path, on_hold, after)
+        logger.info("Submit call (%s): %s" % (self.name, submit_cmd))
+        return [{'op': 'write', 'path': script_path, 'content': script}, {'op': 'run', 'cmd': submit_cmd}]
+
+    def _get_job_id(self, results):
+        """Returns the job id of the results of the commands that end with a submission"""
+        self._check(results[:-1])
+        submit_output = results[-1]
+        if not submit_output['ok']:
+            raise Exception("Failed to submit Job: %s" % (submit_output.get('stderr') or submit_output.get('error')))
+        job_id = self.scheduler.parse_job_id(submit_output['stdout'])
+        if not job_id:
+            raise Exception('Failed to get jobid: %s' % submit_output['stdout'])
+        return job_id
+
+    def _get_release_commands(self, parse_job_ids):
+        # parse jobs of batched submissions are not held
+        if not parse_job_ids:
+            return []
+        return [{'op': 'run', 'cmd': self.scheduler.get_release_command(parse_job_ids)}]
+
+    @staticmethod
+    def _get_parse_job_ids(jobs):
+        """Returns the parse jobs the identify jobs have to wait for"""
+        # resubmitted jobs do not wait for the parse job anymore
+        return sorted(set(str(job.genotype.jobid) for job in jobs
+                          if job.genotype.status != FINISHED and job.genotype.jobid is not None))
+
+    def stage_in(self, genotype, force=False):
+        """Copies the genotype file to the working directory of the submission on the cluster"""
+        id = genotype.id
+        target_folder = self.get_target_folder(id)
+        target_file = f"{target_folder}/{id}{genotype.get_file_ext()}"
+        mkdir, exists = self.call([{'op': 'mkdir', 'path': target_folder}, {'op': 'exists', 'path': target_file}])
+        self._check([mkdir])
+        if force or not exists['value']:
+            self.put(genotype.genotype_file.path, target_file)
+
+    def submit_parse_job(self, genotype, on_hold=True):
+        id = genotype.id
+        ext = genotype.get_file_ext()
+        target_folder = self.get_target_folder(id)
+        job_script = 'parse_job.sh'
+        ctx = {
+            "walltime": _get_walltime(genotype.walltime),
+            "memory": _get_memory(genotype.memory),
+            "id": id,
+            "input_file": '%s%s' % (id, ext),
+            "workdir": target_folder,
+            "sentinel": self._get_sentinel_script(f"{target_folder}/{id}.stats.json")
+        }
+        rendered_script = self._get_rendered_submit_script(job_script, ctx)
+        commands = self._get_submit_commands(f"{target_folder}/{job_script}", rendered_script, on_hold=on_hold)
+        job_id = self._get_job_id(self.call(commands, stop_on_error=True))
+        genotype.jobid = job_id
+        genotype.save()
+        logger.info('Parse job sucessfully submitted to %s (%s)' % (self.name, job_id))
+        return job_id
+
+    def _write_array_index(self, jobs):
+        """Returns the index file of an identify job array (one line per task)"""
+        lines = []
+        for task_id, job in enumerate(jobs):
+            lines.append('%s\t%s\t%s\t%s\t%s' % (task_id, job.genotype_id, job.id, job.dataset.name.lower(),
+                                                   self.get_target_folder(job.genotype_id)))
+        return '\n'.join(lines) + '\n'
+
+    def submit_identify_jobs(self, jobs):
+        """Submits the identify jobs as one job array or, without array support, as one job per identify job"""
+        jobs = list(jobs)
+        if self.scheduler.supports_arrays:
+            return self.submit_identify_array(jobs)
+        commands = []
+        for job in jobs:
+            target_folder = self.get_target_folder(job.genotype_id)
+            job_script = f'identify_job_{job.id}.sh'
+            ctx = {
+                "walltime": _get_walltime(job.walltime, job.walltime_factor),
+                "memory": _get_memory(job.memory, job.memory_factor),
+                "id": job.genotype_id,
+                "identify_job_id": job.id,
+                "dataset": job.dataset.name.lower(),
+                "workdir": target_folder,
+                "sentinel": self._get_sentinel_script(f"{target_folder}/{job.id}.matches.json {target_folder}/{job.id}.scores.txt")
+            }
+            commands.extend(self._get_submit_commands(f"{target_folder}/{job_script}",
+                                                      self._get_rendered_submit_script('identify_job.sh', ctx),
+                                                      after=self._get_parse_job_ids([job])))
+        results = self.call(commands + self._get_release_commands(self._get_parse_job_ids(jobs)), stop_on_error=True)
+        job_ids = []
+        for i, job in enumerate(jobs):
+            job.jobid = self._get_job_id(results[2 * i:2 * i + 2])
+            job.array_task_id = None
+            job.save()
+            job_ids.append(job.hpc_job_id)
+            logger.info('Identify job sucessfully submitted to %s (%s)' % (self.name, job.jobid))
+        return job_ids
+
+    def submit_identify_array(self, jobs):
+        """
+        Submits identify jobs of one submission as a single job array.
+        The dataset and the submission of each array task are read from an index file.
+        A job array has one resource request, so the largest walltime and memory of the jobs are requested.
+        The array waits for the parse jobs that did not finish yet and releases them afterwards
+        """
+        jobs = list(jobs)
+        if not jobs:
+            return []
+        job_script = 'identify_job.sh'
+        name = uuid.uuid4().hex[:12]
+        # removed with the submission
+        target_folder = self.get_target_folder(jobs[0].genotype_id)
+        index_file = os.path.join(target_folder, f'{name}.index')
+        ctx = {
+            "walltime": str(datetime.timedelta(seconds=max(_get_walltime_seconds(job.walltime, job.walltime_factor) for job in jobs))),
+            "memory": sizeof_fmt(max(_get_memory_kb(job.memory, job.memory_factor) for job in jobs)),
+            "name": name,
+            "last_task_id": len(jobs) - 1,
+            "index_file": index_file,
+            "workdir": target_folder,
+            "sentinel": self._get_sentinel_script('$WORKDIR/$JOB_ID.matches.json $WORKDIR/$JOB_ID.scores.txt', array=True)
+        }
+        parse_job_ids = self._get_parse_job_ids(jobs)
+        rendered_script = self._get_rendered_submit_script(job_script, ctx)
+        commands = [{'op': 'write', 'path': index_file, 'content': self._write_array_index(jobs)}]
+        commands += self._get_submit_commands(f"{target_folder}/{name}-{job_script}", rendered_script, after=parse_job_ids)
+        # the parse jobs are only released when the array was submitted
+        results = self.call(commands + self._get_release_commands(parse_job_ids), stop_on_error=True)
+        array_job_id = self._get_job_id(results[:len(commands)])
+        for task_id, job in enumerate(jobs):
+            job.jobid = array_job_id
+            job.array_task_id = task_id
+            job.save()
+        logger.info('Identify job array sucessfully submitted to %s (%s, %s tasks)' % (self.name, array_job_id, len(jobs)))
+        return [job.hpc_job_id for job in jobs]
+
+    def submit_identify_batch(self, jobs):
+        """
+        Submits the identify jobs of several submissions as one batch job per dataset.
+        A batch job scores all samples in one process so that the dataset is only loaded once.
+        The jobs of a batch share the job id. Datasets with a single job are submitted as a job array
+        """
+        jobs = list(jobs)
+        if not self.supports_batch:
+            # the files of a job array are stored in the folder of its submission
+            submissions = OrderedDict()
+            for job in jobs:
+                submissions.setdefault(job.genotype_id, []).append(job)
+            return [job_id for submission_jobs in submissions.values()
+                    for job_id in self.submit_identify_jobs(submission_jobs)]
+        datasets = OrderedDict()
+        for job in jobs:
+            datasets.setdefault(job.dataset.name.lower(), []).append(job)
+        job_ids = []
+        batches = []
+        commands = []
+        for dataset, dataset_jobs in datasets.items():
+            if len(dataset_jobs) == 1:
+                job_ids.extend(self.submit_identify_array(dataset_jobs))
+                continue
+            job_script = 'identify_batch_job.sh'
+            name = uuid.uuid4().hex[:12]
+            # the first submission is only removed after the batch job ended, as its sample is part of it
+            target_folder = self.get_target_folder(dataset_jobs[0].genotype_id)
+            # the samples are scored one after the other
+            walltime = sum(_get_walltime_seconds(job.walltime, job.walltime_factor) for job in dataset_jobs)
+            ctx = {
+                "walltime": str(datetime.timedelta(seconds=min(walltime, settings.HPC_MAX_WALLTIME))),
+                "memory": sizeof_fmt(max(_get_memory_kb(job.memory, job.memory_factor) for job in dataset_jobs)),
+                "name": name,
+                "dataset": dataset,
+                "driver": os.path.join(self.array_folder, BATCH_DRIVER),
+                "index_file": os.path.join(target_folder, f'{name}.index'),
+                "workdir": target_folder,
+                # the result files of all samples of the index file
+                "sentinel": self._get_sentinel_script('$(awk \'{print $5 "/" $3 ".matches.json", $5 "/" $3 ".scores.txt"}\' $INDEX_FILE)')
+            }
+            batches.append(dataset_jobs)
+            commands.append({'op': 'write', 'path': ctx['index_file'], 'content': self._write_array_index(dataset_jobs)})
+            commands.extend(self._get_submit_commands(f"{target_folder}/{name}-{job_script}",
+                                                      self._get_rendered_submit_script(job_script, ctx),
+                                                      after=self._get_parse_job_ids(dataset_jobs)))
+        if not batches:
+            return job_ids
+        # all batch jobs are submitted with one batch of commands
+        with open(os.path.join(self.template_folder, BATCH_DRIVER)) as fh:
+            commands = [{'op': 'mkdir', 'path': self.array_folder},
+                        {'op': 'write', 'path': os.path.join(self.array_folder, BATCH_DRIVER), 'content': fh.read()}] + commands
+        parse_job_ids = self._get_parse_job_ids([job for dataset_jobs in batches for job in dataset_jobs])
+        results = self.call(commands + self._get_release_commands(parse_job_ids), stop_on_error=True)
+        self._check(results[:2])
+        for i, dataset_jobs in enumerate(batches):
+            batch_job_id = self._get_job_id(results[2 + 3 * i:5 + 3 * i])
+            for job in dataset_jobs:
+                job.jobid = batch_job_id
+                job.array_task_id = None
+                job.save()
+                job_ids.append(job.hpc_job_id)
+            logger.info('Identify batch job sucessfully submitted to %s (%s, %s samples)' % (self.name, batch_job_id, len(dataset_jobs)))
+        return job_ids
+
+    def submit_crosses_job(self, job):
+        id = job.identifyjob.genotype.id
+        target_folder = self.get_target_folder(id)
+        job_script = 'crosses_job.sh'
+        ctx = {
+            "walltime": _get_walltime(job.walltime, job.walltime_factor),
+            "memory": _get_memory(job.memory, job.memory_factor),
+            "id": id,
+            "crosses_job_id": job.pk,
+            "dataset": job.identifyjob.dataset.name.lower(),
+            "workdir": target_folder,
+            "sentinel": self._get_sentinel_script(f"{target_folder}/{job.pk}_crosses.matches.json")
+        }
+        rendered_script = self._get_rendered_submit_script(job_script, ctx)
+        job_id = self._get_job_id(self.call(self._get_submit_commands(f"{target_folder}/{job_script}", rendered_script),
+                                            stop_on_error=True))
+        job.jobid = job_id
+        job.save()
+        logger.info('Crosses job sucessfully submitted to %s (%s)' % (self.name, job_id))
+
+    def _get_scheduler_job_ids(self, job_ids):
+        return OrderedDict((job_id.split(':', 1)[1], job_id) for job_id in job_ids)
+
+    @staticmethod
+    def _get_scheduler_job_id(job):
+        return job.hpc_job_id.split(':', 1)[1] if job.hpc_job_id else None
+
+    def _get_sentinel_statuses(self, job_ids):
+        """
+        Returns the status of the jobs that is known from the sentinels and the jobs the scheduler has to be asked for.
+        One listing of the spool folder detects the finished jobs and only the new sentinels of the jobs are read.
+        The scheduler is asked for the failed jobs (to tell TIMEOUT and OUT_OF_MEMORY from other failures) and,
+        every HPC_SCHEDULER_CHECK_INTERVAL seconds, for the jobs without sentinel (e.g. killed or cancelled jobs)
+        """
+        files = self.call([{'op': 'list', 'path': self.spool_folder}])[0].get('value') or {}
+        now = time.time()
+        done = [job_id for job_id in job_ids if f'{job_id}.done' in files]
+        max_age = now - settings.HPC_SENTINEL_MAX_AGE * 24 * 3600
+        expired = [name for name, mtime in files.items() if mtime < max_age]
+        results = self.call([{'op': 'read', 'path': os.path.join(self.spool_folder, f'{job_id}.done')} for job_id in done] +
+                            [{'op': 'remove', 'path': os.path.join(self.spool_folder, name)} for name in expired])
+        self._sentinels = {job_id: sentinel for job_id, sentinel in self._sentinels.items() if f'{job_id}.done' in files}
+        statuses, unresolved = {}, []
+        for job_id, result in zip(done, results):
+            try:
+                sentinel = json.loads(result['value'])
+            except (KeyError, ValueError):
+                sentinel = {}
+            if sentinel.get('exit_code') == 0:
+                statuses[job_id] = FINISHED
+                self._sentinels[job_id] = sentinel
+            else:
+                unresolved.append(job_id)
+        self._scheduler_checks = {job_id: checked for job_id, checked in self._scheduler_checks.items()
+                                  if now - checked < settings.HPC_SCHEDULER_CHECK_INTERVAL}
+        for job_id in job_ids:
+            if job_id in statuses or job_id in unresolved:
+                continue
+            if job_id not in self._scheduler_checks:
+                unresolved.append(job_id)
+                self._scheduler_checks[job_id] = now
+            elif f'{job_id}.started' in files:
+                statuses[job_id] = PROCESSING
+        return statuses, unresolved
+
+    def get_jobs_status(self, job_ids):
+        """
+        Returns the status of several jobs. With HPC_SENTINELS the finished jobs are detected with the sentinels
+        and the scheduler is only asked for the remaining jobs. Jobs whose status is unknown are left out
+        """
+        scheduler_job_ids = self._get_scheduler_job_ids(job_ids)
+        statuses, unresolved = {}, list(scheduler_job_ids)
+        if settings.HPC_SENTINELS:
+            statuses, unresolved = self._get_sentinel_statuses(unresolved)
+        if unresolved:
+            statuses.update(self.scheduler.get_jobs_status(self, unresolved))
+        logger.info('Job states (%s): %s' % (self.name, statuses))
+        return {scheduler_job_ids[job_id]: status for job_id, status in statuses.items() if job_id in scheduler_job_ids}
+
+    def get_jobs_accounting(self, job_ids):
+        scheduler_job_ids = self._get_scheduler_job_ids(job_ids)
+        accounting = self.scheduler.get_jobs_accounting(self, list(scheduler_job_ids))
+        return {scheduler_job_ids[job_id]: data for job_id, data in accounting.items() if job_id in scheduler_job_ids}
+
+    def stage_out(self, job):
+        if isinstance(job, IdentifyJob):
+            target_folder = self.get_target_folder(job.genotype_id)
+            output_path = os.path.join(tempfile.gettempdir(), f"{job.id}.tsv")
+            # the samples of a batch job fail on their own (see identify_batch.py)
+            failure_marker = os.path.join(target_folder, f'{job.id}.failed') if self.supports_batch else None
+            matches, scores = self._read_files([os.path.join(target_folder, f'{job.id}.matches.json'),
+                                                os.path.join(target_folder, f'{job.id}.scores.txt')],
+                                               self._get_scheduler_job_id(job), failure_marker)
+            with open(output_path, 'w') as fh:
+                fh.write(scores)
+            return json.loads(matches), output_path
+        if isinstance(job, GenotypeSubmission):
+            return json.loads(self._read_files([os.path.join(self.get_target_folder(job.id), f"{job.id}.stats.json")],
+                                               self._get_scheduler_job_id(job))[0])
+        if isinstance(job, CrossesJob):
+            target_folder = self.get_target_folder(job.identifyjob.genotype_id)
+            return json.loads(self._read_files([os.path.join(target_folder, f'{job.pk}_crosses.matches.json')],
+                                               self._get_scheduler_job_id(job))[0])
+        raise ValueError(f'Object {job} not supported')
+
+    def cleanup(self, genotype):
+        self._check(self.call([{'op': 'remove', 'path': self.get_target_folder(genotype.id)}]))
+
+
+EXECUTORS = {name: HPCExecutor(name, **cluster) for name, cluster in settings.HPC_CLUSTERS.items()}
+EXECUTORS[LOCAL] = LocalExecutor()
+
+
+def get_executor(job):
+    """Returns the executor that runs a job"""
+    return EXECUTORS[job.executor]
+
+
+def get_hpc_executors():
+    """Returns the executors of all configured HPC clusters"""
+    return [executor for executor in EXECUTORS.values() if isinstance(executor, HPCExecutor)]
+
+
+def set_connection_factory(factory=None):
+    """Replaces the connections of all HPC clusters (see HPCExecutor.set_connection_factory)"""
+    for executor in get_hpc_executors():
+        executor.set_connection_factory(factory)
+
+
+def get_cluster_load(executor, since):
     """
-    Function to stage-out result files and cleanup
+    Returns the number of jobs waiting in the queue of a cluster
+    and the number of jobs that started or finished on it since the date
     """
-    target_folder = _get_target_folder(job.genotype.id)
-    output_path = os.path.join(tempfile.gettempdir(),f"{job.id}.tsv")
-    c.get(os.path.join(target_folder,f'{job.id}.scores.txt'), output_path)
-    output_result = _read_file(job.genotype.id, f'{job.id}.matches.json')
-    data = json.loads(output_result.stdout)
-    return data, output_path
-
-def cleanup_files(id):
+    waiting = throughput = 0
+    for model in (GenotypeSubmission, IdentifyJob, CrossesJob):
+        jobs = model.objects.filter(executor=executor.name)
+        waiting += jobs.filter(status__in=(CREATED, QUEUED), jobid__isnull=False).count()
+        throughput += jobs.filter(Q(started__gte=since) | Q(finished__gte=since)).count()
+    return waiting, throughput
+
+
+def choose_cluster():
     """
-    Clean up files
+    Returns the active cluster with the shortest queue relative to its recent throughput.
+    Clusters whose circuit breaker is open are skipped
     """
-    target_folder = _get_target_folder(id)
-    c.run('rm -fr %s' % target_folder)
+    since = timezone.now() - datetime.timedelta(seconds=settings.HPC_ROUTING_WINDOW)
+    best, best_score = settings.HPC_ACTIVE_CLUSTERS[0], None
+    for name in settings.HPC_ACTIVE_CLUSTERS:
+        executor = EXECUTORS[name]
+        if not executor.is_available:
+            continue
+        waiting, throughput = get_cluster_load(executor, since)
+        score = (waiting + 1) / (throughput + 1)
+        logger.debug('Cluster %s: %s waiting, %s recently started or finished jobs', name, waiting, throughput)
+        if best_score is None or score < best_score:
+            best, best_score = name, score
+    return best
 
-def submit_identify_jobs(id, job_id=None):
+
+def choose_executor(genotype):
     """
-    Submit job to identify job
+    Returns the executor for a submission. Submissions whose parse and identify jobs are predicted
+    to finish within LOCAL_EXECUTOR_MAX_WALLTIME seconds are run in the local process pool,
+    the others on the least loaded cluster
     """
-    # Find out if stagejob exists
-    genotype = _get_genotype(id)
-    target_folder = _get_target_folder(id)
-    job_script = 'identify_job.sh'
-    ctx = {
-        "walltime": '01:00:00',
-        "memory": '4G',
-        "id": id,
-        "identify_job_id": None,
-        "dataset": None,
-        "workdir": target_folder
-    }
-    depends = ''
-    parse_job_id = genotype.jobid
-    if parse_job_id is not None:
-        depends = '-d afterok:%s' % parse_job_id
-    jobs = genotype.identifyjob_set.filter(pk=job_id) if job_id else genotype.identifyjob_set.all()
-    jobids = []
+    if settings.LOCAL_EXECUTOR_MAX_WALLTIME <= 0:
+        return choose_cluster()
+    walltimes = [job.walltime for job in [genotype] + list(genotype.identifyjob_set.all())]
+    if any(walltime is None for walltime in walltimes) or max(walltimes) >= settings.LOCAL_EXECUTOR_MAX_WALLTIME:
+        return choose_cluster()
+    return LOCAL
+
+
+def _group_by_executor(job_ids):
+    executor_job_ids = OrderedDict()
+    for job_id in job_ids:
+        if not job_id:
+            continue
+        job_id = str(job_id)
+        name = job_id.split(':', 1)[0]
+        if name not in EXECUTORS:
+            logger.warning('Unknown executor of job %s', job_id)
+            continue
+        executor_job_ids.setdefault(name, []).append(job_id)
+    return executor_job_ids
+
+
+def get_jobs_status(job_ids):
+    """Returns the status of several jobs keyed by their job id. Each executor is asked once for all its jobs"""
+    statuses = {}
+    for name, executor_ids in _group_by_executor(job_ids).items():
+        statuses.update(EXECUTORS[name].get_jobs_status(executor_ids))
+    return statuses
+
+
+def get_job_status(job_id):
+    return get_jobs_status([job_id]).get(str(job_id), ERROR)
+
+
+def get_jobs_accounting(job_ids):
+    """Returns the resource usage of finished HPC jobs keyed by their job id. Each cluster is asked once"""
+    accounting = {}
+    for name, executor_ids in _group_by_executor(job_ids).items():
+        if isinstance(EXECUTORS[name], HPCExecutor):
+            accounting.update(EXECUTORS[name].get_jobs_accounting(executor_ids))
+    return accounting
+
+
+def submit_identify_batch(jobs):
+    """Submits the identify jobs of several submissions as batch jobs on the cluster of each submission"""
+    executor_jobs = OrderedDict()
     for job in jobs:
-        ctx['identify_job_id'] = job.id
-        ctx['dataset'] = job.dataset.name.lower()
-        ctx['walltime'] = _get_walltime(job.walltime)
-        ctx['memory'] = _get_memory(job.memory)
-        rendered_script = _get_rendered_submit_script(job_script, ctx)
-        job_script_final = f"{ctx['dataset']}-{job_script}"
-        upload_submit_script(rendered_script, target_folder, job_script_final)
-        sbatch_cmd = f"sbatch {depends} {target_folder}/{job_script_final}"
-        logger.info("SBATCH call: %s" % sbatch_cmd)
-        sbatch_output = c.run(sbatch_cmd)
-        if sbatch_output.failed:
-            raise Exception("Failed to submit Job: %s" % sbatch_output.stderr)
-        match = SBATCH_PATTERN.match(sbatch_output.stdout)
-        if not match:
-            raise Exception('Failed to get jobid' % sbatch_output.stdout )
-        job_id = match.group(1)
-        job.jobid = job_id
-        job.save()
-        jobids.append(job_id)
-        logger.info('Identify job sucessfully submitted (%s)' % job_id)
-    if parse_job_id is not None:
-        c.run('scontrol release %s' % parse_job_id)
-    return jobids
+        executor_jobs.setdefault(job.executor, []).append(job)
+    job_ids = []
+    for name, jobs in executor_jobs.items():
+        job_ids.extend(EXECUTORS[name].submit_identify_batch(jobs))
+    return job_ids
 
 
-def submit_crosses_job(job):
+def submit_identify_jobs(id, job_id=None):
     """
-    Submit job to crosses job
+    Submit job to identify job
     """
-    # Find out if stagejob exists
-    id = job.identifyjob.genotype.id
-    target_folder = _get_target_folder(id)
-    job_script = 'crosses_job.sh'
-    submit_script = '%s/%s' % (SUBMIT_SCRIPT_FOLDER, job_script)
-    ctx = {
-        "walltime": _get_walltime(job.walltime),
-        "memory": _get_memory(job.memory),
-        "id": id,
-        "crosses_job_id": job.pk,
-        "dataset": job.identifyjob.dataset.name.lower(),
-        "workdir": target_folder
-    }
-    rendered_script = _get_rendered_submit_script(job_script, ctx)
-    upload_submit_script(rendered_script, target_folder, job_script)
-    sbatch_cmd = f"sbatch {target_folder}/{job_script}"
-    logger.info("SBATCH call: %s" % sbatch_cmd)
-    sbatch_output = c.run(sbatch_cmd)
-    if sbatch_output.failed:
-        raise Exception("Failed to submit Job: %s" % sbatch_output.stderr)
-    match = SBATCH_PATTERN.match(sbatch_output.stdout)
-    if not match:
-        raise Exception('Failed to get jobid' % sbatch_output.stdout )
-    job_id = match.group(1)
-    job.jobid = job_id
-    job.save()
-    logger.info('Crosses job sucessfully submitted (%s)' % job_id)
+    genotype = _get_genotype(id)
+    # only jobs that were not submitted yet so that a retried pipeline does not submit them twice
+    jobs = genotype.identifyjob_set.filter(pk=job_id) if job_id else genotype.identifyjob_set.filter(jobid__isnull=True)
+    return get_executor(genotype).submit_identify_jobs(jobs.select_related('genotype', 'dataset').order_by('pk'))
 
 
-def get_job_status(job_id):
-    # TODO check for pending state
-    check_cmd = f"squeue -j {job_id} -o %T -h"
-    check_output = c.run(check_cmd, warn=True)
-    if check_output.failed or check_output.stdout == "":
-        check_cmd = "sacct -j %s.batch -o state -pn" % job_id
-        check_output = c.run(check_cmd)
-        status = check_output.stdout[:-1]
-    slurm_status = check_output.stdout.strip().replace("|","")
-    status = SLURM_STATUS_DICT.get(slurm_status, ERROR)
-    logger.info('Job state is %s' % status)
-    return status
+def get_active_job_ids(genotype):
+    """Returns the job ids of all jobs of a submission that are still running"""
+    RUNNING = (CREATED, QUEUED, PROCESSING)
+    job_ids = []
+    if genotype.status in RUNNING:
+        job_ids.append(genotype.hpc_job_id)
+    for identify_job in genotype.identifyjob_set.all():
+        if identify_job.status in RUNNING:
+            job_ids.append(identify_job.hpc_job_id)
+        if hasattr(identify_job, 'crossesjob') and identify_job.crossesjob.status in RUNNING:
+            job_ids.append(identify_job.crossesjob.hpc_job_id)
+    return [job_id for job_id in job_ids if job_id]
 
 def update_job_results(job):
     if isinstance(job, IdentifyJob):
-        data, output_path = get_identify_job_result(job)
+        data, output_path = get_executor(job).stage_out(job)
         django_file = File(open(output_path,'rb'))
         job.identify_file.save(f'{job.id}.tsv', django_file)
         os.unlink(output_path)
+        try:
+            convert_scores(job.identify_file.path, job.scores_folder)
+        except Exception as err:
+            # the scores endpoint enqueues the conversion again on first access
+            logger.exception('Failed to convert scores of %s: %s', job, repr(err))
     elif isinstance(job, GenotypeSubmission):
-        data = get_parse_job_result(job)
+        data = get_executor(job).stage_out(job)
         data = OrderedDict(
             sorted(data.items(), key=lambda t: t[0], reverse=True))
     elif isinstance(job,CrossesJob):
-        data = get_crosses_job_result(job)
+        data = get_executor(job).stage_out(job)
     else:
         raise ValueError(f'Object {job} not supported')
     return data
 
 
-def update_job_status(job):
-    data = json.loads(job.statistics) if job.statistics else None
-    if job.status in (CREATED, QUEUED, PROCESSING):
-        new_status = get_job_status(job.jobid)
-        job.status = new_status
-        if new_status == FINISHED:
-            if not job.statistics:
+def resubmit_job(job, slurm_state):
+    """
+    Resubmits an identify or crosses job that was killed by the cluster.
+    Walltime (TIMEOUT) or memory (OUT_OF_MEMORY) are escalated geometrically up to HPC_MAX_WALLTIME/HPC_MAX_MEMORY.
+    Returns False if the job ran out of attempts or the resources can not be escalated anymore
+    """
+    if not isinstance(job, (IdentifyJob, CrossesJob)) or not isinstance(get_executor(job), HPCExecutor):
+        return False
+    history = job.previous_attempts
+    if len(history) + 1 >= settings.HPC_RESUBMIT_MAX_ATTEMPTS:
+        return False
+    walltime = _get_walltime_seconds(job.walltime, job.walltime_factor)
+    memory = _get_memory_kb(job.memory, job.memory_factor)
+    if slurm_state == 'TIMEOUT':
+        if walltime >= settings.HPC_MAX_WALLTIME:
+            return False
+        job.walltime_factor *= settings.HPC_RESUBMIT_ESCALATION
+    elif slurm_state == 'OUT_OF_MEMORY':
+        if memory >= settings.HPC_MAX_MEMORY:
+            return False
+        job.memory_factor *= settings.HPC_RESUBMIT_ESCALATION
+    history.append({'jobid': job.hpc_job_id, 'state': slurm_state, 'walltime': walltime, 'memory': memory,
+                    'started': job.started.isoformat() if job.started else None, 'ended': timezone.now().isoformat()})
+    logger.warning('%s ended with %s. Resubmitting (attempt %s)', job, slurm_state, len(history) + 1)
+    job.attempt_history = json.dumps(history)
+    job.jobid = None
+    if isinstance(job, IdentifyJob):
+        job.array_task_id = None
+    job.status = QUEUED
+    job.started = None
+    job.estimated_finish = None
+    job.progress = 0
+    job.save()
+    if isinstance(job, IdentifyJob):
+        get_executor(job).submit_identify_jobs([job])
+    else:
+        get_executor(job).submit_crosses_job(job)
+    return True
+
+
+def update_job_status(job, new_status):
+    """Updates the job with the status retrieved from the HPC (None if unknown)"""
+    data = job.stats
+    # only save state changes so that 'updated' can be used for conditional requests
+    if job.status in (CREATED, QUEUED, PROCESSING) and new_status is not None and new_status != job.status:
+        if new_status in RESUBMIT_STATUSES:
+            if resubmit_job(job, RESUBMIT_STATUSES[new_status]):
+                return data
+            new_status = ERROR
+        if new_status == FINISHED and not job.statistics:
+            # retrieve result
+            try:
                 data = update_job_results(job)
                 job.statistics = json.dumps(data)
-            # retrieve result
+            except HPCJobFailedError as err:
+                logger.warning('%s failed: %s', job, err)
+                new_status = ERROR
+        job.status = new_status
+        if new_status == FINISHED:
             job.finished = timezone.now()
             job.progress = 100
         elif new_status == PROCESSING:
@@ -293,24 +1278,50 @@ def update_job_status(job):
     return data
 
 
-def update_genotype_status(genotype):
+def update_genotype_status(genotype, statuses=None):
     """Check if job is finished"""
-    update_job_status(genotype)
+    if statuses is None:
+        statuses = get_jobs_status(get_active_job_ids(genotype))
+    update_job_status(genotype, statuses.get(genotype.hpc_job_id))
     if genotype.status == FINISHED:
         for identify_job in genotype.identifyjob_set.all():
-            data = update_job_status(identify_job)
-            if data is not None and data['interpretation']['case'] == 3:
+            update_job_status(identify_job, statuses.get(identify_job.hpc_job_id))
+            if identify_job.status == FINISHED and identify_job.interpretation_case == 3:
                 crosses_job, created = CrossesJob.objects.get_or_create(identifyjob=identify_job, defaults={'status': CREATED})
+                identify_job.crossesjob = crosses_job
                 if created or not crosses_job.jobid:
-                    submit_crosses_job(crosses_job)
+                    # the crosses job needs the files of the identify job
+                    crosses_job.executor = identify_job.executor
+                    if get_executor(crosses_job).runs_in_process:
+                        crosses_job.save(update_fields=['executor'])
+                        if not is_pending('submit_crosses_job_task', crossesjob_id=crosses_job.pk):
+                            enqueue('submit_crosses_job_task', crossesjob_id=crosses_job.pk)
+                    else:
+                        get_executor(crosses_job).submit_crosses_job(crosses_job)
             if hasattr(identify_job, 'crossesjob'):
-                update_job_status(identify_job.crossesjob)
+                update_job_status(identify_job.crossesjob, statuses.get(identify_job.crossesjob.hpc_job_id))
 
     if genotype.identify_finished:
-        cleanup_files(genotype.id)
+        get_executor(genotype).cleanup(genotype)
 
 
-def identify_pipeline(id):
-    stagein_identify_job(id)
-    submit_parse_job(id, True)
-    submit_identify_jobs(id)
\ No newline at end of file
+def identify_pipeline(id, batch=False):
+    """
+    Stages in the genotype and submits the parse and identify jobs to the executor of the submission.
+    The executor (cluster or local process pool) is chosen when the submission is started.
+    In batch mode the identify jobs are submitted later together with other submissions if the cluster supports it
+    """
+    genotype = _get_genotype(id)
+    if genotype.jobid is None:
+        genotype.executor = choose_executor(genotype)
+        GenotypeSubmission.objects.filter(pk=id).update(executor=genotype.executor)
+        genotype.identifyjob_set.update(executor=genotype.executor)
+    executor = get_executor(genotype)
+    batch = batch and executor.supports_batch
+    executor.stage_in(genotype)
+    if genotype.jobid is None:
+        # the parse job does not have to wait for the batch
+        executor.submit_parse_job(genotype, not batch)
+    if not batch:
+        jobs = genotype.identifyjob_set.filter(jobid__isnull=True).select_related('genotype', 'dataset').order_by('pk')
+        executor.submit_identify_jobs(jobs)
@@ -0,0 +1,144 @@
+"""
+Runs the snpmatch commands of small jobs in a local process pool.
+The state of every job is kept in a JSON file (with the SLURM state names), so that
+other processes (web workers, poll_hpc_jobs) can look it up.
+This module does not depend on django so that the jobs can be run in a separate process pool
+"""
+import fcntl
+import json
+import multiprocessing
+import os
+import socket
+import subprocess
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+JOBS_FOLDER = 'jobs'
+JOB_ID_FILE = 'next_job_id'
+
+PENDING = 'PENDING'
+RUNNING = 'RUNNING'
+COMPLETED = 'COMPLETED'
+FAILED = 'FAILED'
+
+_executor = None
+
+
+def next_job_id(folder):
+    """Returns a new job id. The counter file is locked so that concurrent processes get different ids"""
+    os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(folder, JOB_ID_FILE), 'a+') as fh:
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        fh.seek(0)
+        job_id = int(fh.read() or 1)
+        fh.seek(0)
+        fh.truncate()
+        fh.write(str(job_id + 1))
+    return job_id
+
+
+def get_state_file(folder, job_id):
+    return os.path.join(folder, JOBS_FOLDER, '%s.json' % job_id)
+
+
+def write_state(folder, job_id, state, **kwargs):
+    """Atomically writes the state of a job"""
+    state_file = get_state_file(folder, job_id)
+    os.makedirs(os.path.dirname(state_file), exist_ok=True)
+    data = dict(kwargs, state=state, host=socket.gethostname(), pid=os.getpid(), updated=time.time())
+    with open(state_file + '.tmp', 'w') as fh:
+        json.dump(data, fh)
+    os.replace(state_file + '.tmp', state_file)
+
+
+def read_state(folder, job_id):
+    """Returns the state of a job. Jobs whose process died are FAILED"""
+    try:
+        with open(get_state_file(folder, job_id)) as fh:
+            data = json.load(fh)
+    except (IOError, ValueError):
+        return None
+    if data['state'] in (PENDING, RUNNING) and data.get('host') == socket.gethostname() and not _is_alive(data['pid']):
+        return FAILED
+    return data['state']
+
+
+def remove_states(folder, job_ids):
+    for job_id in job_ids:
+        try:
+            os.unlink(get_state_file(folder, job_id))
+        except FileNotFoundError:
+            pass
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def run_job(folder, job_id, workdir, commands, timeout=None):
+    """Runs the commands of a job one after the other in the working directory"""
+    write_state(folder, job_id, RUNNING, started=time.time())
+    returncode = 0
+    with open(os.path.join(workdir, 'local-%s.out' % job_id), 'ab') as log:
+        try:
+            for command in commands:
+                returncode = subprocess.run(command, cwd=workdir, stdout=log, stderr=subprocess.STDOUT,
+                                            timeout=timeout).returncode
+                if returncode != 0:
+                    break
+        except (OSError, subprocess.TimeoutExpired) as err:
+            log.write(('%r\n' % err).encode())
+            returncode = -1
+    write_state(folder, job_id, COMPLETED if returncode == 0 else FAILED, returncode=returncode, finished=time.time())
+    return returncode
+
+
+def _get_executor(max_workers=None):
+    global _executor
+    if _executor is None:
+        # spawn instead of fork because the web workers are multi-threaded
+        _executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'))
+    return _executor
+
+
+def submit_job(folder, workdir, commands, max_workers=None, timeout=None, after=None):
+    """
+    Submits the commands of a job to the local process pool and returns its job id.
+    A job that depends on another one (after) only starts once the other job completed
+    """
+    job_id = next_job_id(folder)
+    write_state(folder, job_id, PENDING)
+
+    def start(dependency=None):
+        global _executor
+        if dependency is not None and (dependency.cancelled() or dependency.exception() or dependency.result() != 0):
+            write_state(folder, job_id, FAILED, returncode=None, finished=time.time())
+            return
+        try:
+            future = _get_executor(max_workers).submit(run_job, folder, job_id, workdir, commands, timeout)
+        except BrokenProcessPool:
+            # a worker died. Start a new pool for the next job
+            _executor = None
+            future = _get_executor(max_workers).submit(run_job, folder, job_id, workdir, commands, timeout)
+        _futures[job_id] = future
+        future.add_done_callback(lambda _: _futures.pop(job_id, None))
+
+    dependency = _futures.get(after) if after is not None else None
+    if dependency is not None:
+        dependency.add_done_callback(start)
+    elif after is not None and read_state(folder, after) != COMPLETED:
+        write_state(folder, job_id, FAILED, returncode=None, finished=time.time())
+    else:
+        start()
+    return job_id
+
+
+# futures of the jobs submitted by this process
+_futures = {}
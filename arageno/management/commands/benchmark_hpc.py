@@ -0,0 +1,87 @@
+"""
+Management command that benchmarks the submission pipeline against the simulated cluster
+"""
+import json
+from django.core.management.base import BaseCommand, CommandError
+from arageno.benchmark import Benchmark
+
+
+def _range(value):
+    """Parses 'min,max' (or a single value) in seconds"""
+    values = [float(v) for v in value.split(',')]
+    return (values[0], values[-1])
+
+
+class Command(BaseCommand):
+    help = 'Runs concurrent submitters and pollers against the simulated HPC and reports the request latencies and SSH calls'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--submissions', type=int, default=20,
+                            help='Number of genotype files to submit (default: %(default)s)')
+        parser.add_argument('--submitters', type=int, default=4,
+                            help='Number of concurrent submitters (default: %(default)s)')
+        parser.add_argument('--pollers', type=int, default=4,
+                            help='Number of concurrent status pollers (default: %(default)s)')
+        parser.add_argument('--workers', type=int, default=2,
+                            help='Number of task worker threads (default: %(default)s)')
+        parser.add_argument('--background-polling', action='store_true',
+                            help='Refresh the submissions with a background poller instead of on request')
+        parser.add_argument('--poll-interval', type=float, default=2,
+                            help='Seconds between two cycles of the background poller (default: %(default)s)')
+        parser.add_argument('--longpoll-timeout', type=int, default=2,
+                            help='STATUS_LONGPOLL_TIMEOUT during the benchmark (default: %(default)s)')
+        parser.add_argument('--scheduler-check-interval', type=int, default=10,
+                            help='HPC_SCHEDULER_CHECK_INTERVAL during the benchmark (default: %(default)s)')
+        parser.add_argument('--snps', type=int, default=5000,
+                            help='Number of SNPs of the generated genotype files (default: %(default)s)')
+        parser.add_argument('--pending-time', type=_range, default=(0, 2),
+                            help='Seconds a job waits in the simulated queue as min,max (default: 0,2)')
+        parser.add_argument('--run-time', type=_range, default=(1, 5),
+                            help='Seconds a job runs on the simulated cluster as min,max (default: 1,5)')
+        parser.add_argument('--failure-rate', type=float, default=0,
+                            help='Share of the jobs that fail (default: %(default)s)')
+        parser.add_argument('--timeout-rate', type=float, default=0,
+                            help='Share of the jobs that are killed by the time limit (default: %(default)s)')
+        parser.add_argument('--oom-rate', type=float, default=0,
+                            help='Share of the jobs that run out of memory (default: %(default)s)')
+        parser.add_argument('--crosses-rate', type=float, default=0.2,
+                            help='Share of the identify jobs that require a crosses job (default: %(default)s)')
+        parser.add_argument('--ssh-latency', type=float, default=0.05,
+                            help='Seconds added to every simulated SSH call (default: %(default)s)')
+        parser.add_argument('--agent', action='store_true',
+                            help='Send the commands to the simulated cluster in batches like the HPC agent')
+        parser.add_argument('--timeout', type=int, default=600,
+                            help='Give up waiting for the submissions after these seconds (default: %(default)s)')
+        parser.add_argument('--seed', type=int, default=None,
+                            help='Seed of the simulation to reproduce a run')
+        parser.add_argument('--json', action='store_true',
+                            help='Print the report as JSON')
+
+    def handle(self, *args, **options):
+        if options['failure_rate'] + options['timeout_rate'] + options['oom_rate'] > 1:
+            raise CommandError('The failure rates must not exceed 1')
+        benchmark = Benchmark(
+            submissions=options['submissions'], submitters=options['submitters'], pollers=options['pollers'],
+            workers=options['workers'], background_polling=options['background_polling'],
+            poll_interval=options['poll_interval'], longpoll_timeout=options['longpoll_timeout'],
+            scheduler_check_interval=options['scheduler_check_interval'],
+            num_of_snps=options['snps'], timeout=options['timeout'], seed=options['seed'],
+            pending_time=options['pending_time'], run_time=options['run_time'], latency=options['ssh_latency'],
+            crosses_rate=options['crosses_rate'], agent=options['agent'],
+            failure_rates={'FAILED': options['failure_rate'], 'TIMEOUT': options['timeout_rate'],
+                           'OUT_OF_MEMORY': options['oom_rate']})
+        report = benchmark.run()
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+        self.stdout.write('Wall time: %.1fs' % report['wall_time'])
+        self.stdout.write('Submissions: %s' % ', '.join('%s %s' % (count, name) for name, count in sorted(report['submissions'].items())))
+        self.stdout.write('%-40s %8s %10s %10s %10s %8s' % ('', 'count', 'p50 (ms)', 'p99 (ms)', 'max (ms)', 'errors'))
+        rows = [('end to end', report['end_to_end'])] + list(report['latencies'].items())
+        for name, stats in rows:
+            if not stats['count']:
+                continue
+            self.stdout.write('%-40s %8s %10.1f %10.1f %10.1f %8s' % (name, stats['count'], stats['p50'], stats['p99'],
+                                                                    stats['max'], report['errors'].get(name, 0)))
+        self.stdout.write('SSH calls: %s (%s)' % (sum(report['ssh_calls'].values()),
+                                                  ', '.join('%s %s' % item for item in report['ssh_calls'].items())))
@@ -0,0 +1,40 @@
+"""
+Management command that refits the runtime and memory polynominals from the sacct accounting data
+"""
+from datetime import timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from arageno.hpc import HPCUnavailableError
+from arageno.services import collect_job_accounting, calibrate_resources
+
+
+class Command(BaseCommand):
+    help = 'Refits the runtime and memory polynominals of the datasets and parse jobs from the observed resource usage'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--quantile', type=float, default=settings.HPC_CALIBRATION_QUANTILE,
+                            help='Share of the observed jobs that must fit into the predicted resources (default: %(default)s)')
+        parser.add_argument('--min-samples', type=int, default=20,
+                            help='Minimum number of successful jobs to refit a polynominal (default: %(default)s)')
+        parser.add_argument('--days', type=int, default=180,
+                            help='Only use jobs of the last days (default: %(default)s)')
+        parser.add_argument('--no-collect', action='store_true',
+                            help='Do not collect the accounting data of recently finished jobs first')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only show the new polynominals')
+
+    def handle(self, *args, **options):
+        if not 0 < options['quantile'] <= 1:
+            raise CommandError('quantile must be between 0 and 1')
+        if not options['no_collect']:
+            try:
+                self.stdout.write('Collected accounting data of %s jobs' % collect_job_accounting())
+            except HPCUnavailableError as err:
+                self.stderr.write('Could not collect accounting data: %s' % err)
+        since = timezone.now() - timedelta(days=options['days'])
+        changes = calibrate_resources(options['quantile'], options['min_samples'], since, dry_run=options['dry_run'])
+        for name, old_value, new_value, num_of_samples in changes:
+            self.stdout.write('%s (%s jobs): %s -> %s' % (name, num_of_samples, old_value, new_value))
+        if not changes:
+            self.stdout.write('Not enough accounting data to refit any polynominal')
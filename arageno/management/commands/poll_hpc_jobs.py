@@ -0,0 +1,38 @@
+"""
+Management command that refreshes the HPC status of all unfinished submissions
+"""
+import time
+import logging
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from arageno.hpc import HPCUnavailableError
+from arageno.services import update_unfinished_submissions, collect_job_accounting
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Polls the HPC for the status of all unfinished submissions on a fixed cadence'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=int, default=settings.HPC_POLL_INTERVAL,
+                            help='Seconds between two refresh cycles (default: %(default)s)')
+        parser.add_argument('--once', action='store_true',
+                            help='Run a single refresh cycle and exit')
+
+    def handle(self, *args, **options):
+        interval = options['interval']
+        logger.info('Starting HPC status poller (interval: %ss)', interval)
+        while True:
+            started = time.time()
+            close_old_connections()
+            num_of_updated = update_unfinished_submissions()
+            try:
+                collect_job_accounting()
+            except HPCUnavailableError as err:
+                logger.warning('Could not collect accounting data: %s', err)
+            logger.debug('Refreshed %s submissions in %.2fs', num_of_updated, time.time() - started)
+            if options['once']:
+                break
+            time.sleep(max(0, interval - (time.time() - started)))
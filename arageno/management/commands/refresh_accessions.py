@@ -0,0 +1,24 @@
+"""
+Management command that refreshes the local snapshot of the accession list
+"""
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from arageno.accessions import refresh_accession_map
+
+
+class Command(BaseCommand):
+    help = 'Refreshes the local snapshot of the accession list from AraPheno or ACCESSION_MAP_FILE'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true',
+                            help='Replace the snapshot even if the accession list did not change')
+
+    def handle(self, *args, **options):
+        try:
+            replaced = refresh_accession_map(force=options['force'])
+        except Exception as err:
+            raise CommandError('Could not refresh the accession map: %s' % repr(err))
+        if replaced:
+            self.stdout.write('Accession map snapshot updated in %s' % settings.ACCESSION_MAP_SNAPSHOT)
+        else:
+            self.stdout.write('Accession map snapshot is up to date')
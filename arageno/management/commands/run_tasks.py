@@ -0,0 +1,36 @@
+"""
+Management command that runs a worker for the database backed task queue
+"""
+import time
+import logging
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from arageno import services  # registers the tasks
+from arageno.tasks import claim_task, run_task, requeue_stale_tasks, get_worker_name
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Runs a worker that executes the queued background tasks'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=int, default=settings.TASK_POLL_INTERVAL,
+                            help='Seconds to wait when no task is due (default: %(default)s)')
+        parser.add_argument('--once', action='store_true',
+                            help='Exit as soon as no task is due')
+
+    def handle(self, *args, **options):
+        worker = get_worker_name()
+        logger.info('Starting task worker %s', worker)
+        while True:
+            close_old_connections()
+            requeue_stale_tasks()
+            task = claim_task(worker)
+            if task is not None:
+                run_task(task)
+                continue
+            if options['once']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,33 @@
+# Generated by Django 2.2.10 on 2026-10-18 08:44
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('arageno', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Task',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100)),
+                ('arguments', models.TextField(default='{}')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('status', models.SmallIntegerField(choices=[(-1, 'Error'), (0, 'Created'), (1, 'Queued'), (2, 'Processing'), (3, 'Finished')], db_index=True, default=1)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('max_attempts', models.PositiveSmallIntegerField(default=5)),
+                ('run_after', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('locked_by', models.CharField(blank=True, max_length=100, null=True)),
+                ('locked_at', models.DateTimeField(blank=True, null=True)),
+                ('last_error', models.TextField(blank=True, null=True)),
+                ('genotype', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='arageno.GenotypeSubmission')),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.10 on 2026-10-18 08:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('arageno', '0002_task'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='genotypesubmission',
+            name='refreshed',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
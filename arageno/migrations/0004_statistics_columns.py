@@ -0,0 +1,74 @@
+# Generated by Django 2.2.10 on 2026-10-18 08:48
+
+import json
+from django.db import migrations, models
+
+
+# copies of arageno.models.get_overlap/get_top_hit as of this migration, so that later changes do not affect it
+def get_overlap(data):
+    overlap = data.get('overlap')
+    if isinstance(overlap, list):
+        overlap = overlap[0] if overlap else None
+    return overlap
+
+
+def get_top_hit(data):
+    matches = data.get('matches')
+    if not matches or not isinstance(matches[0], list):
+        return None
+    return str(matches[0][0])
+
+
+def fill_statistics_columns(apps, schema_editor):
+    for model_name in ('GenotypeSubmission', 'IdentifyJob', 'CrossesJob'):
+        model = apps.get_model('arageno', model_name)
+        for job in model.objects.exclude(statistics__isnull=True).exclude(statistics='').iterator():
+            data = json.loads(job.statistics) or {}
+            job.interpretation_case = data.get('interpretation', {}).get('case')
+            if model_name == 'GenotypeSubmission':
+                job.num_of_snps = data.get('num_of_snps')
+            elif model_name == 'IdentifyJob':
+                job._overlap = get_overlap(data)
+                job.top_hit = get_top_hit(data)
+            job.save()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('arageno', '0003_genotypesubmission_refreshed'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='crossesjob',
+            name='interpretation_case',
+            field=models.SmallIntegerField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='genotypesubmission',
+            name='interpretation_case',
+            field=models.SmallIntegerField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='genotypesubmission',
+            name='num_of_snps',
+            field=models.PositiveIntegerField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='identifyjob',
+            name='_overlap',
+            field=models.FloatField(blank=True, db_column='overlap', db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='identifyjob',
+            name='interpretation_case',
+            field=models.SmallIntegerField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='identifyjob',
+            name='top_hit',
+            field=models.CharField(blank=True, db_index=True, max_length=50, null=True),
+        ),
+        migrations.RunPython(fill_statistics_columns, migrations.RunPython.noop),
+    ]
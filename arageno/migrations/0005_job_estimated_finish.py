@@ -0,0 +1,28 @@
+# Generated by Django 2.2.10 on 2026-10-18 08:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('arageno', '0004_statistics_columns'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='crossesjob',
+            name='estimated_finish',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='genotypesubmission',
+            name='estimated_finish',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='identifyjob',
+            name='estimated_finish',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
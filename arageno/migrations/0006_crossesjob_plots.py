@@ -0,0 +1,29 @@
+# Generated by Django 2.2.10 on 2026-10-18 08:51
+
+import arageno.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('arageno', '0005_job_estimated_finish'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='crossesjob',
+            name='plot_checksum',
+            field=models.CharField(blank=True, max_length=32, null=True),
+        ),
+        migrations.AddField(
+            model_name='crossesjob',
+            name='plot_pdf',
+            field=models.FileField(blank=True, null=True, upload_to=arageno.models.crosses_plot_file),
+        ),
+        migrations.AddField(
+            model_name='crossesjob',
+            name='plot_png',
+            field=models.FileField(blank=True, null=True, upload_to=arageno.models.crosses_plot_file),
+        ),
+    ]
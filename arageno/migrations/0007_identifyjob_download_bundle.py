@@ -0,0 +1,24 @@
+# Generated by Django 2.2.10 on 2026-10-18 08:57
+
+import arageno.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('arageno', '0006_crossesjob_plots'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='identifyjob',
+            name='download_checksum',
+            field=models.CharField(blank=True, max_length=32, null=True),
+        ),
+        migrations.AddField(
+            model_name='identifyjob',
+            name='download_file',
+            field=models.FileField(blank=True, null=True, upload_to=arageno.models.identify_result_file),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 2.2.10 on 2026-10-18 09:04
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('arageno', '0007_identifyjob_download_bundle'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='JobAccounting',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('jobid', models.PositiveIntegerField(unique=True)),
+                ('kind', models.CharField(choices=[('parse', 'Parse'), ('identify', 'Identify'), ('crosses', 'Crosses')], db_index=True, max_length=10)),
+                ('input_format', models.CharField(blank=True, max_length=10, null=True)),
+                ('num_of_markers', models.PositiveIntegerField(blank=True, null=True)),
+                ('state', models.CharField(max_length=30)),
+                ('elapsed', models.PositiveIntegerField(blank=True, null=True)),
+                ('total_cpu', models.FloatField(blank=True, null=True)),
+                ('max_rss', models.PositiveIntegerField(blank=True, null=True)),
+                ('created', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('dataset', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='arageno.Dataset')),
+                ('genotype', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='arageno.GenotypeSubmission')),
+            ],
+        ),
+    ]
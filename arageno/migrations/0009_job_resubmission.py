@@ -0,0 +1,58 @@
+# Generated by Django 2.2.10 on 2026-10-18 09:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('arageno', '0008_jobaccounting'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='crossesjob',
+            name='attempt_history',
+            field=models.TextField(default='[]'),
+        ),
+        migrations.AddField(
+            model_name='crossesjob',
+            name='memory_factor',
+            field=models.FloatField(default=1),
+        ),
+        migrations.AddField(
+            model_name='crossesjob',
+            name='walltime_factor',
+            field=models.FloatField(default=1),
+        ),
+        migrations.AddField(
+            model_name='genotypesubmission',
+            name='attempt_history',
+            field=models.TextField(default='[]'),
+        ),
+        migrations.AddField(
+            model_name='genotypesubmission',
+            name='memory_factor',
+            field=models.FloatField(default=1),
+        ),
+        migrations.AddField(
+            model_name='genotypesubmission',
+            name='walltime_factor',
+            field=models.FloatField(default=1),
+        ),
+        migrations.AddField(
+            model_name='identifyjob',
+            name='attempt_history',
+            field=models.TextField(default='[]'),
+        ),
+        migrations.AddField(
+            model_name='identifyjob',
+            name='memory_factor',
+            field=models.FloatField(default=1),
+        ),
+        migrations.AddField(
+            model_name='identifyjob',
+            name='walltime_factor',
+            field=models.FloatField(default=1),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.2.10 on 2026-10-18 09:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('arageno', '0009_job_resubmission'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='identifyjob',
+            name='array_task_id',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='jobaccounting',
+            name='jobid',
+            field=models.CharField(max_length=30, unique=True),
+        ),
+    ]
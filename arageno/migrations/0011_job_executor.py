@@ -0,0 +1,28 @@
+# Generated by Django 2.2.10 on 2026-10-18 09:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('arageno', '0010_identify_job_array'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='crossesjob',
+            name='executor',
+            field=models.CharField(choices=[('slurm', 'SLURM'), ('local', 'Local process pool')], default='slurm', max_length=10),
+        ),
+        migrations.AddField(
+            model_name='genotypesubmission',
+            name='executor',
+            field=models.CharField(choices=[('slurm', 'SLURM'), ('local', 'Local process pool')], default='slurm', max_length=10),
+        ),
+        migrations.AddField(
+            model_name='identifyjob',
+            name='executor',
+            field=models.CharField(choices=[('slurm', 'SLURM'), ('local', 'Local process pool')], default='slurm', max_length=10),
+        ),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 2.2.10 on 2026-10-18 09:29
+
+import arageno.models
+from django.db import migrations, models
+from django.db.models import Value
+from django.db.models.functions import Concat
+
+# the SLURM jobs ran on the only cluster before the cluster registry
+SLURM_CLUSTER = 'cbe'
+
+
+def assign_cluster(apps, schema_editor):
+    for model_name in ('GenotypeSubmission', 'IdentifyJob', 'CrossesJob'):
+        apps.get_model('arageno', model_name).objects.filter(executor='slurm').update(executor=SLURM_CLUSTER)
+    # the job ids are prefixed with the cluster
+    apps.get_model('arageno', 'JobAccounting').objects.exclude(jobid__contains=':').update(
+        jobid=Concat(Value(SLURM_CLUSTER + ':'), 'jobid'))
+
+
+def unassign_cluster(apps, schema_editor):
+    for model_name in ('GenotypeSubmission', 'IdentifyJob', 'CrossesJob'):
+        apps.get_model('arageno', model_name).objects.filter(executor=SLURM_CLUSTER).update(executor='slurm')
+    JobAccounting = apps.get_model('arageno', 'JobAccounting')
+    for accounting in JobAccounting.objects.filter(jobid__startswith=SLURM_CLUSTER + ':'):
+        accounting.jobid = accounting.jobid.split(':', 1)[1]
+        accounting.save()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('arageno', '0011_job_executor'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='crossesjob',
+            name='executor',
+            field=models.CharField(default=arageno.models.get_default_executor, max_length=20),
+        ),
+        migrations.AlterField(
+            model_name='genotypesubmission',
+            name='executor',
+            field=models.CharField(default=arageno.models.get_default_executor, max_length=20),
+        ),
+        migrations.AlterField(
+            model_name='identifyjob',
+            name='executor',
+            field=models.CharField(default=arageno.models.get_default_executor, max_length=20),
+        ),
+        migrations.RunPython(assign_cluster, unassign_cluster),
+    ]
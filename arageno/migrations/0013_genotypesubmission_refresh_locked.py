@@ -0,0 +1,18 @@
+# Generated by Django 2.2.10 on 2026-10-18 10:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('arageno', '0012_job_cluster'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='genotypesubmission',
+            name='refresh_locked',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
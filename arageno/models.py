@@ -3,16 +3,19 @@ Database models
 """
 import uuid
 import json
+import hashlib
 import os
 from abc import ABCMeta, abstractmethod, abstractproperty
 from datetime import datetime,timedelta
 from django.utils import timezone
 from django.urls import reverse
+from django.conf import settings
 from django.db import models
 from django.utils.encoding import python_2_unicode_compatible
-from django.db.models.signals import post_delete
+from django.db.models.signals import post_delete, post_save
 from django.dispatch.dispatcher import receiver
 import shutil
+import time
 import logging
 import numpy as np
 
@@ -40,6 +43,14 @@ STATUS_CHOICES = (
     )
 )
 
+# executor of the jobs that run in the local process pool. The other executors are the HPC clusters (HPC_CLUSTERS)
+LOCAL = 'local'
+
+
+def get_default_executor():
+    """Returns the first active HPC cluster"""
+    return settings.HPC_ACTIVE_CLUSTERS[0]
+
 
 def delete_upload_folder(instance):
     if not instance or not instance.genotype_file:
@@ -51,10 +62,37 @@ def delete_upload_folder(instance):
 
 def _calculate_polynominal(num_of_markers,polynominal):
     """Calculates the walltime"""
-    if not num_of_markers or not polynominal:
+    if not num_of_markers or polynominal is None:
         return None
-    poly = np.poly1d(polynominal)
-    return abs(poly(num_of_markers))
+    poly = polynominal if isinstance(polynominal, np.poly1d) else np.poly1d(polynominal)
+    # polynominals with integer coefficients return numpy integers, which timedelta does not accept
+    return float(abs(poly(num_of_markers)))
+
+
+_setting_polynominals = {}
+_dataset_polynominals = {}
+
+
+def get_setting_polynominal(key):
+    """Returns the polynominal stored in a setting. Cached per process"""
+    cached = _setting_polynominals.get(key)
+    if cached is not None and time.time() - cached[0] < settings.POLYNOMINAL_CACHE_TTL:
+        return cached[1]
+    setting = Setting.objects.filter(pk=key).first()
+    poly = np.poly1d(json.loads(setting.value)) if setting else None
+    _setting_polynominals[key] = (time.time(), poly)
+    return poly
+
+
+def get_dataset_polynominal(dataset, field):
+    """Returns the polynominal stored in a field of a dataset. Cached per process by its value"""
+    value = getattr(dataset, field)
+    key = (dataset.pk, field)
+    cached = _dataset_polynominals.get(key)
+    if cached is None or cached[0] != value:
+        cached = (value, np.poly1d(json.loads(value)))
+        _dataset_polynominals[key] = cached
+    return cached[1]
 
 def calculate_finish_date(num_of_markers, start_date, polynominal):
     """Calculates the finish date"""
@@ -76,6 +114,22 @@ def calculate_progress(start_date, end_date):
 
 
 
+def get_overlap(data):
+    """Returns the overlap ratio from the statistics. Newer SNPmatch versions also report the number of SNPs"""
+    overlap = data.get('overlap')
+    if isinstance(overlap, list):
+        overlap = overlap[0] if overlap else None
+    return overlap
+
+
+def get_top_hit(data):
+    """Returns the accession id of the best match from the statistics"""
+    matches = data.get('matches')
+    if not matches or not isinstance(matches[0], list):
+        return None
+    return str(matches[0][0])
+
+
 def get_upload_folder(id):
     """Returns the folder path for genotpye uploads"""
     return '%s/%s' % (UPLOAD_FOLDER, id)
@@ -88,6 +142,9 @@ def get_identify_result_path(id, job_id):
 def identify_result_file(instance,filename):
     return '{0}/{1}'.format(get_upload_folder(instance.genotype.id),filename)
 
+def crosses_plot_file(instance, filename):
+    return '{0}/{1}'.format(get_upload_folder(instance.identifyjob.genotype_id),filename)
+
 def genotype_file_directory(instance, filename):
     uid = instance.id
     if not uid:
@@ -108,6 +165,11 @@ class Setting(models.Model):
         return 'Setting [%s: %s ]' % (self.key, self.value)
 
 
+@receiver(post_save, sender=Setting)
+def setting_save(sender, instance, **kwargs):
+    _setting_polynominals.pop(instance.pk, None)
+
+
 @python_2_unicode_compatible
 class Dataset(models.Model):
     """
@@ -130,6 +192,12 @@ class Dataset(models.Model):
         return '%s (%s samples, %s markers)' % (self.name, self.num_of_samples, self.num_of_markers)
 
 
+@receiver(post_save, sender=Dataset)
+def dataset_save(sender, instance, **kwargs):
+    for key in [key for key in _dataset_polynominals if key[0] == instance.pk]:
+        _dataset_polynominals.pop(key, None)
+
+
 class Job(models.Model):
     """
     Common abstract base class for job related information
@@ -143,10 +211,51 @@ class Job(models.Model):
     statistics = models.TextField(blank=True, null=True, db_column='data')
     _progress = models.PositiveSmallIntegerField(default=0,db_column='progress')
     jobid = models.PositiveIntegerField(blank=True, null=True, db_index=True)
+    estimated_finish = models.DateTimeField(blank=True, null=True)
+    interpretation_case = models.SmallIntegerField(blank=True, null=True, db_index=True)
+    # escalation of the requested walltime and memory after the cluster killed the job
+    walltime_factor = models.FloatField(default=1)
+    memory_factor = models.FloatField(default=1)
+    # previous submissions of the job (jobid, SLURM state and requested resources)
+    attempt_history = models.TextField(default='[]')
+    # HPC cluster (or LOCAL) that runs the job
+    executor = models.CharField(max_length=20, default=get_default_executor)
 
     class Meta:
         abstract = True
 
+    @property
+    def stats(self):
+        """Returns the parsed statistics. They are only parsed again when the field was written"""
+        raw = self.statistics
+        cached = self.__dict__.get('_stats_cache')
+        if cached is None or cached[0] is not raw:
+            cached = (raw, json.loads(raw) if raw else None)
+            self._stats_cache = cached
+        return cached[1]
+
+    @property
+    def previous_attempts(self):
+        return json.loads(self.attempt_history or '[]')
+
+    @property
+    def hpc_job_id(self):
+        """Returns the id of the job prefixed with its executor (<executor>:<jobid>)"""
+        if self.jobid is None:
+            return None
+        return '%s:%s' % (self.executor, self.jobid)
+
+    def update_statistics_columns(self, data):
+        """Copies the frequently accessed values of the statistics into their own columns"""
+        self.interpretation_case = data.get('interpretation', {}).get('case')
+
+    def save(self, *args, **kwargs):
+        self.update_statistics_columns(self.stats or {})
+        if self.status == PROCESSING and self.started and self.estimated_finish is None:
+            # estimate once when the job starts instead of on every progress request
+            self.estimated_finish = calculate_finish_date(self.num_of_markers, self.started, self.poly_runtime)
+        super(Job, self).save(*args, **kwargs)
+
     @abstractproperty
     def num_of_markers(self):
         pass
@@ -176,6 +285,8 @@ class Job(models.Model):
             return None
         elif self.status == FINISHED:
             return self.started
+        elif self.estimated_finish:
+            return self.estimated_finish
         else:
             return calculate_finish_date(self.num_of_markers,self.started,self.poly_runtime)
 
@@ -208,6 +319,29 @@ class Job(models.Model):
 
 
 
+class GenotypeSubmissionQuerySet(models.QuerySet):
+    """
+    Custom QuerySet for GenotypeSubmission
+    """
+
+    def unfinished(self):
+        """
+        Returns the submissions that still have jobs running on the HPC
+        """
+        RUNNING = [CREATED,QUEUED,PROCESSING]
+        return self.exclude(status=ERROR).filter(
+            models.Q(status__in=RUNNING) |
+            models.Q(identifyjob__status__in=RUNNING) |
+            models.Q(identifyjob__status=FINISHED, identifyjob__crossesjob__status__in=RUNNING)).distinct()
+
+    def with_jobs(self):
+        """
+        Prefetches the identify jobs with their dataset and crosses job
+        """
+        return self.prefetch_related(models.Prefetch(
+            'identifyjob_set', queryset=IdentifyJob.objects.select_related('dataset', 'crossesjob')))
+
+
 @python_2_unicode_compatible
 class GenotypeSubmission(Job):
     """
@@ -220,14 +354,23 @@ class GenotypeSubmission(Job):
     email = models.CharField(max_length=200)
     genotype_file = models.FileField(upload_to=genotype_file_directory)
     _num_of_markers = models.PositiveIntegerField(blank=True, null=True,db_column='num_of_markers')
+    num_of_snps = models.PositiveIntegerField(blank=True, null=True, db_index=True)
+    refreshed = models.DateTimeField(blank=True, null=True)
+    # set while a thread or process refreshes the HPC status of the submission
+    refresh_locked = models.DateTimeField(blank=True, null=True)
 
+    objects = GenotypeSubmissionQuerySet.as_manager()
 
     @property
     def accession_ids(self):
         """Retrieves the ids of all identifyjobs"""
+        return self.get_accession_ids()
+
+    def get_accession_ids(self, top=None):
+        """Retrieves the ids of the top matches of all identifyjobs"""
         accession_ids = []
         for job in self.identifyjob_set.all():
-            accession_ids.extend(job.accession_ids)
+            accession_ids.extend(job.get_accession_ids(top))
         return set(accession_ids)
 
     @property
@@ -242,36 +385,41 @@ class GenotypeSubmission(Job):
     @property
     def identify_finished(self):
         """Returns if all identifyjobs are finished"""
-        return self.identifyjob_set.unfinished().count() == 0
+        if 'identifyjob_set' not in getattr(self, '_prefetched_objects_cache', {}):
+            return self.identifyjob_set.unfinished().count() == 0
+        # avoid another query if the jobs were prefetched (see GenotypeSubmissionQuerySet.with_jobs)
+        RUNNING = [CREATED,QUEUED,PROCESSING,ERROR]
+        for job in self.identifyjob_set.all():
+            if job.status in RUNNING:
+                return False
+            if job.status == FINISHED and hasattr(job, 'crossesjob') and job.crossesjob.status in RUNNING:
+                return False
+        return True
 
     @property
     def num_of_markers(self):
         """Returns the number of markers"""
-        if self.statistics:
-            data = json.loads(self.statistics)
-            if data:
-                return data['num_of_snps']
+        if self.num_of_snps is not None:
+            return self.num_of_snps
         return self._num_of_markers
 
     @num_of_markers.setter
     def num_of_markers(self, value):
         self._num_of_markers = value
 
+    def update_statistics_columns(self, data):
+        super(GenotypeSubmission, self).update_statistics_columns(data)
+        self.num_of_snps = data.get('num_of_snps')
+
     @property
     def poly_runtime(self):
         ext = 'bed' if self.is_bed else 'vcf'
-        polynominal = Setting.objects.filter(pk="runtime_parsing_%s" % ext).first()
-        if polynominal:
-            return json.loads(polynominal.value)
-        return polynominal
+        return get_setting_polynominal("runtime_parsing_%s" % ext)
 
     @property
     def poly_memory(self):
         ext = 'bed' if self.is_bed else 'vcf'
-        polynominal = Setting.objects.filter(pk="memory_parsing_%s" % ext).first()
-        if polynominal:
-            return json.loads(polynominal.value)
-        return polynominal
+        return get_setting_polynominal("memory_parsing_%s" % ext)
 
 
     @property
@@ -327,22 +475,37 @@ class CrossesJob(Job):
     Job for checking crosses
     """
     identifyjob = models.OneToOneField('IdentifyJob', on_delete=models.CASCADE, primary_key=True)
+    plot_png = models.FileField(upload_to=crosses_plot_file, blank=True, null=True)
+    plot_pdf = models.FileField(upload_to=crosses_plot_file, blank=True, null=True)
+    # checksum of the statistics the plots were rendered from
+    plot_checksum = models.CharField(max_length=32, blank=True, null=True)
     objects = CrossesJobQuerySet.as_manager()
 
+    @property
+    def statistics_checksum(self):
+        if not self.statistics:
+            return None
+        return hashlib.md5(self.statistics.encode()).hexdigest()
+
+    @property
+    def has_current_plots(self):
+        """Returns if the stored plots were rendered from the current statistics"""
+        return bool(self.plot_png and self.plot_pdf) and self.plot_checksum == self.statistics_checksum
+
     @property
     def matches(self):
         """Retrieve match statistics"""
         if self.status == 3:
-            return json.loads(self.statistics)['matches']
+            return self.stats['matches']
         return None
 
     @property
     def poly_runtime(self):
-        return json.loads(self.identifyjob.dataset.runtime_crosses)
+        return get_dataset_polynominal(self.identifyjob.dataset, 'runtime_crosses')
 
     @property
     def poly_memory(self):
-        return json.loads(self.identifyjob.dataset.memory_crosses)
+        return get_dataset_polynominal(self.identifyjob.dataset, 'memory_crosses')
 
     @property
     def num_of_markers(self):
@@ -384,18 +547,32 @@ class IdentifyJob(Job):
         GenotypeSubmission, on_delete=models.CASCADE)
     dataset = models.ForeignKey('Dataset', on_delete=models.CASCADE)
     identify_file = models.FileField(upload_to=identify_result_file)
+    # pre-built zip bundle with the statistics, the result file and the crosses plot
+    download_file = models.FileField(upload_to=identify_result_file, blank=True, null=True)
+    # checksum of the results the bundle was built from
+    download_checksum = models.CharField(max_length=32, blank=True, null=True)
+    _overlap = models.FloatField(blank=True, null=True, db_index=True, db_column='overlap')
+    top_hit = models.CharField(max_length=50, blank=True, null=True, db_index=True)
+    # identify jobs are submitted as job arrays on SLURM clusters. jobid is the id of the array
+    array_task_id = models.PositiveIntegerField(blank=True, null=True)
 
     objects = IdentifyJobQuerySet.as_manager()
 
+    @property
+    def hpc_job_id(self):
+        """Returns the id of the job prefixed with its executor (<executor>:<array job id>_<task id> for array tasks)"""
+        if self.jobid is None or self.array_task_id is None:
+            return super(IdentifyJob, self).hpc_job_id
+        return '%s:%s_%s' % (self.executor, self.jobid, self.array_task_id)
 
 
     @property
     def poly_runtime(self):
-        return json.loads(self.dataset.runtime_identify)
+        return get_dataset_polynominal(self.dataset, 'runtime_identify')
 
     @property
     def poly_memory(self):
-        return json.loads(self.dataset.memory_identify)
+        return get_dataset_polynominal(self.dataset, 'memory_identify')
 
     @property
     def num_of_markers(self):
@@ -404,29 +581,66 @@ class IdentifyJob(Job):
     @property
     def overlap(self):
         """Retrieve the overlap from the statistics"""
-        if self.status == 3:
-            return json.loads(self.statistics)['overlap'] * 100
+        if self.status == 3 and self._overlap is not None:
+            return self._overlap * 100
         return None
 
+    def update_statistics_columns(self, data):
+        super(IdentifyJob, self).update_statistics_columns(data)
+        self._overlap = get_overlap(data)
+        self.top_hit = get_top_hit(data)
+
+    @property
+    def scores_folder(self):
+        """Folder of the columnar scores table, next to the result file"""
+        if not self.identify_file:
+            return None
+        return '%s_scores' % os.path.splitext(self.identify_file.path)[0]
+
+    @property
+    def crosses_finished(self):
+        """Returns if the crosses job is done or was never needed"""
+        try:
+            return self.crossesjob.status in (FINISHED, ERROR)
+        except CrossesJob.DoesNotExist:
+            return self.interpretation_case != 3
+
+    @property
+    def download_bundle_checksum(self):
+        """Checksum of everything that goes into the download bundle"""
+        if self.status != FINISHED or not self.statistics:
+            return None
+        checksum = hashlib.md5(self.statistics.encode())
+        try:
+            if self.crossesjob.status == FINISHED:
+                checksum.update((self.crossesjob.statistics_checksum or "").encode())
+        except CrossesJob.DoesNotExist:
+            pass
+        return checksum.hexdigest()
+
+    @property
+    def has_current_download_bundle(self):
+        """Returns if the stored download bundle was built from the current results"""
+        return bool(self.download_file) and self.download_checksum == self.download_bundle_checksum
+
     @property
     def matches(self):
         """Retrieve match statistics"""
         if self.status == 3:
-            return json.loads(self.statistics)['matches']
+            return self.stats['matches']
         return None
 
     @property
-
     def accession_ids(self):
         """Retrieves the ids of the matched accessions"""
-        try:
-            accession_ids = list(self.crossesjob.accession_ids)
-        except CrossesJob.DoesNotExist:
-            accession_ids = None
+        return self.get_accession_ids()
+
+    def get_accession_ids(self, top=None):
+        """Retrieves the ids of the top matched accessions"""
         accession_ids = []
         matches = self.matches
         if matches:
-            accession_ids.extend([acc[0] for acc in matches])
+            accession_ids.extend([acc[0] for acc in matches[:top]])
         return set(accession_ids)
 
     def __str__(self):
@@ -436,4 +650,97 @@ class IdentifyJob(Job):
 @receiver(post_delete, sender=IdentifyJob)
 def identifyjob_delete(sender, instance, **kwargs):
     # Pass false so FileField doesn't save the model.
+    if instance.scores_folder:
+        shutil.rmtree(instance.scores_folder, ignore_errors=True)
     instance.identify_file.delete(False)
+    if instance.download_file:
+        instance.download_file.delete(False)
+
+
+@receiver(post_delete, sender=CrossesJob)
+def crossesjob_delete(sender, instance, **kwargs):
+    # Pass false so FileField doesn't save the model.
+    if instance.plot_png:
+        instance.plot_png.delete(False)
+    if instance.plot_pdf:
+        instance.plot_pdf.delete(False)
+
+
+# the task that submits a submission to its executor. Only its state is the state of the submission
+PIPELINE_TASK = 'identify_pipeline_task'
+
+
+class TaskQuerySet(models.QuerySet):
+    """
+    Custom QuerySet for Task
+    """
+
+    def pipeline(self):
+        """
+        Returns the pipeline tasks (PIPELINE_TASK). Auxiliary tasks (plots, download bundles) are left out
+        """
+        return self.filter(name=PIPELINE_TASK)
+
+    def runnable(self):
+        """
+        Returns the queued tasks that are due
+        """
+        return self.filter(status=QUEUED, run_after__lte=timezone.now())
+
+
+class Task(models.Model):
+    """
+    Background task that is executed by the run_tasks worker
+    """
+    name = models.CharField(max_length=100)
+    arguments = models.TextField(default='{}')
+    genotype = models.ForeignKey(GenotypeSubmission, on_delete=models.CASCADE, blank=True, null=True)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+    status = models.SmallIntegerField(
+        choices=STATUS_CHOICES, default=QUEUED, db_index=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    max_attempts = models.PositiveSmallIntegerField(default=5)
+    run_after = models.DateTimeField(default=timezone.now, db_index=True)
+    locked_by = models.CharField(max_length=100, blank=True, null=True)
+    locked_at = models.DateTimeField(blank=True, null=True)
+    last_error = models.TextField(blank=True, null=True)
+
+    objects = TaskQuerySet.as_manager()
+
+    def __str__(self):
+        return 'Task (%s, %s: %s (%s/%s))' % (self.pk, self.name, self.get_status_display(), self.attempts, self.max_attempts)
+
+
+class JobAccounting(models.Model):
+    """
+    Resource usage of a finished HPC job as reported by sacct.
+    Used to calibrate the runtime and memory polynominals
+    """
+    PARSE = 'parse'
+    IDENTIFY = 'identify'
+    CROSSES = 'crosses'
+    KIND_CHOICES = (
+        (PARSE, 'Parse'),
+        (IDENTIFY, 'Identify'),
+        (CROSSES, 'Crosses')
+    )
+    # job id prefixed with the cluster (<cluster>:<array job id>_<task id> for array tasks)
+    jobid = models.CharField(max_length=30, unique=True)
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES, db_index=True)
+    # kept when the submission is deleted
+    genotype = models.ForeignKey(GenotypeSubmission, on_delete=models.SET_NULL, blank=True, null=True)
+    dataset = models.ForeignKey(Dataset, on_delete=models.SET_NULL, blank=True, null=True)
+    input_format = models.CharField(max_length=10, blank=True, null=True)
+    # the input of the polynominals when the job was submitted
+    num_of_markers = models.PositiveIntegerField(blank=True, null=True)
+    state = models.CharField(max_length=30)
+    # seconds
+    elapsed = models.PositiveIntegerField(blank=True, null=True)
+    total_cpu = models.FloatField(blank=True, null=True)
+    # kilobytes
+    max_rss = models.PositiveIntegerField(blank=True, null=True)
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __str__(self):
+        return 'JobAccounting (%s, %s: %s, %ss, %skb)' % (self.jobid, self.kind, self.state, self.elapsed, self.max_rss)
@@ -1,13 +1,25 @@
-import json
+"""
+Rendering of the crosses window plots.
+This module does not depend on django so that the plots can be rendered in a separate process pool
+"""
+import multiprocessing
+from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import numpy as np
 import pandas as pd
 import matplotlib as mpl
 mpl.use('Agg')
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 import seaborn as sns
-from .models import CrossesJob, FINISHED
 sns.set(style="whitegrid", color_codes=True)
 
+PLOT_FORMATS = ('png', 'pdf')
+# bins per chromosome for the rendered plots. Caps the number of points no matter how many windows there are
+PLOT_BINS_PER_CHROMOSOME = 200
+
+_executor = None
 
 
 def _get_chromosome_ticks(chromosome_regions,windows):
@@ -23,23 +35,49 @@ def _get_chromosome_ticks(chromosome_regions,windows):
         minor_ticks.append(min_num)
     return (ticks, minor_ticks, sorted_chr)
 
-def _map_y_data(y_data):
-    return y_data
-
+def bin_crosses_windows(statistics, bins_per_chromosome):
+    """
+    Splits each chromosome into bins_per_chromosome bins and counts the windows of each parent per bin.
+    Returns the bin centers (in window coordinates) and a (bins x parents) count matrix
+    """
+    window_data = statistics['genotype_windows']['coordinates']
+    chromosome_regions = statistics['genotype_windows']['chr_bins']
+    starts, _, chromosomes = _get_chromosome_ticks(chromosome_regions, window_data)
+    starts = np.asarray(starts, dtype=float)
+    sizes = np.asarray([chromosome_regions[chromosome] for chromosome in chromosomes], dtype=float)
+    x = np.asarray(window_data['x'], dtype=float)
+    parents, parent_ix = np.unique(np.asarray(window_data['y'], dtype=str), return_inverse=True)
+    chromosome_ix = np.clip(np.searchsorted(starts, x, side='right') - 1, 0, len(chromosomes) - 1)
+    bin_ix = ((x - starts[chromosome_ix]) / sizes[chromosome_ix] * bins_per_chromosome).astype(int)
+    bin_ix = np.clip(bin_ix, 0, bins_per_chromosome - 1) + chromosome_ix * bins_per_chromosome
+    num_of_bins = len(chromosomes) * bins_per_chromosome
+    counts = np.bincount(bin_ix * len(parents) + parent_ix, minlength=num_of_bins * len(parents))
+    centers = starts[:, None] + (np.arange(bins_per_chromosome) + 0.5)[None, :] * (sizes / bins_per_chromosome)[:, None]
+    return {
+        'chromosomes': chromosomes,
+        'chromosome_starts': starts,
+        'chromosome_sizes': sizes,
+        'bins_per_chromosome': bins_per_chromosome,
+        'parents': parents,
+        'x': centers.ravel(),
+        'counts': counts.reshape(num_of_bins, len(parents))
+    }
 
-def plot_crosses_data(crosses_job):
-    """Creates a plot for the crosses"""
 
-    if crosses_job.status != FINISHED:
-        raise ValueError('Job is not finished yet')
-    statistics = json.loads(crosses_job.statistics)
+def plot_crosses_data(statistics, bins_per_chromosome=PLOT_BINS_PER_CHROMOSOME):
+    """Creates a plot for the crosses from the statistics of a finished crosses job"""
     window_data = statistics['genotype_windows']['coordinates']
     chromosome_regions = statistics['genotype_windows']['chr_bins']
-    y = map(_map_y_data, window_data['y'])
-    d = {'Chromosome':window_data['x'], 'Parent':y}
+    binned = bin_crosses_windows(statistics, bins_per_chromosome)
+    bins, parents = np.nonzero(binned['counts'])
+    d = {'Chromosome':binned['x'][bins], 'Parent':binned['parents'][parents]}
     df = pd.DataFrame(d)
     categories = sorted(df.Parent.unique())
-    ax = sns.stripplot(x='Chromosome', y='Parent', data=df, split=False, alpha=0.8,color='#2196F3',order=categories)
+    # use the object oriented API. pyplot's global state is not thread-safe and leaks figures
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+    sns.stripplot(x='Chromosome', y='Parent', data=df, split=False, alpha=0.8,color='#2196F3',order=categories, ax=ax)
     ax.set_xlim([df.Chromosome.min(),df.Chromosome.max()])
     major_ticks,minor_ticks, chr_labels = _get_chromosome_ticks(chromosome_regions,window_data)
     ax.set_xticks(major_ticks)
@@ -47,5 +85,34 @@ def plot_crosses_data(crosses_job):
     ax.set_xticks(minor_ticks, minor=True)
     ax.set_xticklabels(chr_labels,minor=True)
 
-    return plt
+    return fig
+
+
+def render_crosses_plot(statistics, formats=PLOT_FORMATS):
+    """Renders the crosses plot and returns the bytes for each format"""
+    fig = plot_crosses_data(statistics)
+    plots = {}
+    for format in formats:
+        buf = BytesIO()
+        fig.savefig(buf, format=format)
+        plots[format] = buf.getvalue()
+    return plots
+
+
+def _get_executor(max_workers=None):
+    global _executor
+    if _executor is None:
+        # spawn instead of fork because the web workers are multi-threaded
+        _executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'))
+    return _executor
+
 
+def render_crosses_plot_in_pool(statistics, formats=PLOT_FORMATS, max_workers=None, timeout=None):
+    """Renders the crosses plot in the renderer process pool"""
+    global _executor
+    try:
+        return _get_executor(max_workers).submit(render_crosses_plot, statistics, formats).result(timeout)
+    except BrokenProcessPool:
+        # a renderer died (e.g. out of memory). Start a new pool for the next plot
+        _executor = None
+        raise
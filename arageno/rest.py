@@ -4,27 +4,183 @@ Views for the rest API
 from rest_framework import routers, serializers, viewsets, mixins, generics
 from rest_framework.decorators import action, permission_classes
 import rest_framework.permissions as permissions
-from .models import GenotypeSubmission, IdentifyJob, CrossesJob
-from .serializers import GenotypeSubmissionSerializer, IdentifyJobSerializer, CrossesJobSerializer
+from .models import GenotypeSubmission, IdentifyJob, CrossesJob, FINISHED
+from .serializers import GenotypeSubmissionSerializer, IdentifyJobSerializer, CrossesJobSerializer, GenotypeSubmissionStatusSerializer
 from rest_framework.decorators import api_view, permission_classes, renderer_classes, parser_classes
 from rest_framework.parsers import FormParser,MultiPartParser
 from rest_framework.response import Response
+from rest_framework.pagination import CursorPagination, LimitOffsetPagination
 from rest_framework.permissions import IsAuthenticatedOrReadOnly, AllowAny
-from django.http import HttpResponseBadRequest, HttpResponse, Http404
+from django.http import HttpResponseBadRequest, HttpResponse, Http404, HttpResponseNotModified, StreamingHttpResponse
+from django.conf import settings
 from django.db import transaction
+from django.shortcuts import get_object_or_404
 from .models import GenotypeSubmission, IdentifyJob
-from .plotting import plot_crosses_data
-from .services import create_download_zip, start_identify_pipeline, create_identifyjobs, count_lines, update_submission
-from wsgiref.util import FileWrapper
-import tempfile
-import zipfile
-from io import BytesIO
+from . import plotting
+from . import scores
+from .accessions import get_accession_map
+from .services import schedule_download_bundle, enqueue_identify_pipeline, create_identifyjobs, count_lines, update_submission, render_crosses_plots, schedule_scores_conversion
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
+import hashlib
+import os
+import re
+import threading
+import time
+
+
+RANGE_REGEX = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class LongPollSlots(object):
+    """Counts the requests of this process that are held open by the status long-poll"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._count = 0
+
+    def acquire(self, limit):
+        """Returns False if limit requests are already held open"""
+        with self._lock:
+            if self._count >= limit:
+                return False
+            self._count += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self._count -= 1
+
+
+longpoll_slots = LongPollSlots()
+
+
+def _make_etag(*parts):
+    """Returns a strong ETag for the given state"""
+    return quote_etag(hashlib.md5(repr(parts).encode()).hexdigest())
+
+
+def _get_state(obj):
+    """Returns the part of a job or task that changes the API representation"""
+    return (obj.__class__.__name__, obj.pk, obj.status, obj.updated, getattr(obj, 'progress', None))
+
+
+def get_identifyjob_objects(job):
+    objects = [job]
+    if hasattr(job, 'crossesjob'):
+        objects.append(job.crossesjob)
+    return objects
+
+
+def get_submission_objects(genotype):
+    """Returns the submission and all jobs and tasks that are part of its representation"""
+    objects = [genotype]
+    for job in genotype.identifyjob_set.all():
+        objects.extend(get_identifyjob_objects(job))
+    task = genotype.task_set.pipeline().order_by('-created').first()
+    if task is not None:
+        objects.append(task)
+    return objects
+
+
+def _read_file_range(path, start, length, chunk_size=64 * 1024):
+    with open(path, 'rb') as fh:
+        fh.seek(start)
+        while length > 0:
+            chunk = fh.read(min(chunk_size, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def ranged_file_response(request, path, content_type, etag):
+    """
+    Streams a file from disk. Honors a single byte range (Range/If-Range)
+    so that interrupted downloads can be resumed
+    """
+    size = os.path.getsize(path)
+    start, end = 0, size - 1
+    status = 200
+    match = RANGE_REGEX.match(request.META.get('HTTP_RANGE', '').strip())
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if match and any(match.groups()) and (if_range is None or if_range == etag):
+        first, last = match.groups()
+        if first:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+        else:
+            start = max(size - int(last), 0)
+        if start > end:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */%s' % size
+            return response
+        status = 206
+    response = StreamingHttpResponse(_read_file_range(path, start, end - start + 1), status=status, content_type=content_type)
+    response['Content-Length'] = end - start + 1
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    if status == 206:
+        response['Content-Range'] = 'bytes %s-%s/%s' % (start, end, size)
+    return response
+
+
+def conditional_response(request, etag, last_modified, build_response):
+    """
+    Returns 304 if the client's If-None-Match/If-Modified-Since still match,
+    otherwise builds the response and tags it with ETag and Last-Modified
+    """
+    last_modified = int(last_modified.timestamp()) if last_modified else None
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        response = build_response()
+        response['ETag'] = etag
+        if last_modified:
+            response['Last-Modified'] = http_date(last_modified)
+    patch_cache_control(response, no_cache=True)
+    return response
+
+
+class ConditionalRetrieveMixin(object):
+    """
+    Answers conditional GET requests for a single object with 304 Not Modified
+    """
+
+    def get_state_objects(self, obj):
+        """Returns the objects whose state makes up the representation of obj"""
+        return [obj]
+
+    def get_representation_params(self, request):
+        """
+        Returns what changes the representation besides the state of the objects: the renderer
+        (negotiated with Accept, which DRF lists in Vary) and the query parameters (e.g. ?expand=accessions&top=N)
+        """
+        return (request.accepted_renderer.format, sorted(request.query_params.lists()))
+
+    def retrieve(self, request, *args, **kwargs):
+        instance = self.get_object()
+        objects = self.get_state_objects(instance)
+        etag = _make_etag(self.get_representation_params(request), *[_get_state(o) for o in objects])
+        last_modified = max(o.updated for o in objects)
+        return conditional_response(request, etag, last_modified,
+                                    lambda: Response(self.get_serializer(instance).data))
+
+
+class ScoresPagination(LimitOffsetPagination):
+    default_limit = 100
+    max_limit = 1000
+
+
+class CreatedCursorPagination(CursorPagination):
+    """Stable pagination for the (admin) list endpoints"""
+    ordering = '-created'
+    page_size = 50
 
 
 class IsCreationOrIsAuthenticated(permissions.BasePermission):
 
     def has_permission(self, request, view):
-        if not request.user.is_authenticated():
+        if not request.user.is_authenticated:
             if view.action == 'create' or view.action == 'destroy':
                 return True
             else:
@@ -33,9 +189,10 @@ class IsCreationOrIsAuthenticated(permissions.BasePermission):
             return True
 
 
-class GenotypeSubmissionViewSet(mixins.CreateModelMixin,mixins.DestroyModelMixin, viewsets.ReadOnlyModelViewSet):
-    queryset = GenotypeSubmission.objects.all()
+class GenotypeSubmissionViewSet(ConditionalRetrieveMixin, mixins.CreateModelMixin,mixins.DestroyModelMixin, viewsets.ReadOnlyModelViewSet):
+    queryset = GenotypeSubmission.objects.with_jobs()
     serializer_class = GenotypeSubmissionSerializer
+    pagination_class = CreatedCursorPagination
     authentication_classes = []
     parser_classes = (MultiPartParser,FormParser,)
 
@@ -44,6 +201,46 @@ class GenotypeSubmissionViewSet(mixins.CreateModelMixin,mixins.DestroyModelMixin
         obj = update_submission(obj)
         return obj
 
+    def get_state_objects(self, obj):
+        return get_submission_objects(obj)
+
+    def get_representation_params(self, request):
+        # the accession infos and the url of the accession bundle come from the accession snapshot
+        return super(GenotypeSubmissionViewSet, self).get_representation_params(request) + (get_accession_map().fingerprint,)
+
+    @action(detail=True, methods=['get'])
+    def status(self, request, pk=None):
+        """
+        Long-poll for status and progress changes of the submission and its jobs
+        ---
+        Blocks until the state differs from the ETag passed in If-None-Match or
+        STATUS_LONGPOLL_TIMEOUT is reached, in which case 304 is returned.
+        At most STATUS_LONGPOLL_MAX_WAITERS requests per process are held open so that the long-polls
+        do not occupy all gunicorn threads. The others are answered at once (304 with Retry-After)
+        """
+        since = request.META.get('HTTP_IF_NONE_MATCH')
+        held = longpoll_slots.acquire(settings.STATUS_LONGPOLL_MAX_WAITERS)
+        deadline = time.time() + (settings.STATUS_LONGPOLL_TIMEOUT if held else 0)
+        try:
+            while True:
+                genotype = self.get_object()
+                etag = _make_etag(*[_get_state(o) for o in get_submission_objects(genotype)])
+                if etag != since:
+                    response = Response(GenotypeSubmissionStatusSerializer(genotype).data)
+                    break
+                if time.time() >= deadline:
+                    response = HttpResponseNotModified()
+                    if not held:
+                        response['Retry-After'] = settings.STATUS_LONGPOLL_RETRY
+                    break
+                time.sleep(settings.STATUS_LONGPOLL_INTERVAL)
+        finally:
+            if held:
+                longpoll_slots.release()
+        response['ETag'] = etag
+        patch_cache_control(response, no_cache=True)
+        return response
+
 
     def get_permissions(self):
         if self.action == 'list':
@@ -60,13 +257,17 @@ class GenotypeSubmissionViewSet(mixins.CreateModelMixin,mixins.DestroyModelMixin
         num_of_markers = count_lines(genotype_file.temporary_file_path())
         genotype = serializer.save(genotype_file=genotype_file,num_of_markers=num_of_markers)
         create_identifyjobs(genotype)
-        start_identify_pipeline(genotype,send_email=False)
+        enqueue_identify_pipeline(genotype,send_email=False)
 
 
 
-class IdentifyJobViewSet(viewsets.ReadOnlyModelViewSet):
-    queryset = IdentifyJob.objects.all()
+class IdentifyJobViewSet(ConditionalRetrieveMixin, viewsets.ReadOnlyModelViewSet):
+    queryset = IdentifyJob.objects.select_related('dataset', 'crossesjob', 'genotype')
     serializer_class = IdentifyJobSerializer
+    pagination_class = CreatedCursorPagination
+
+    def get_state_objects(self, obj):
+        return get_identifyjob_objects(obj)
 
 
     def get_permissions(self):
@@ -75,9 +276,10 @@ class IdentifyJobViewSet(viewsets.ReadOnlyModelViewSet):
         return super(IdentifyJobViewSet, self).get_permissions()
 
 
-class CrossesJobViewSet(viewsets.ReadOnlyModelViewSet):
-    queryset = CrossesJob.objects.all()
+class CrossesJobViewSet(ConditionalRetrieveMixin, viewsets.ReadOnlyModelViewSet):
+    queryset = CrossesJob.objects.select_related('identifyjob__dataset', 'identifyjob__genotype')
     serializer_class = CrossesJobSerializer
+    pagination_class = CreatedCursorPagination
 
 
     def get_permissions(self):
@@ -118,16 +320,143 @@ def plot_crosses_windows(request,pk,job_id,format=None):
             content_type = 'image/png'
         elif format == 'pdf':
             content_type = 'application/pdf'
-        job = IdentifyJob.objects.get(pk=job_id)
-
-        if str(job.genotype.id) != str(pk):
+        job = get_object_or_404(IdentifyJob.objects.select_related('crossesjob'), pk=job_id, genotype_id=pk)
+        if not hasattr(job, 'crossesjob') or job.crossesjob.status != FINISHED:
             raise Http404()
-        plot = plot_crosses_data(job.crossesjob)
-        buf = BytesIO()
-        plot.savefig(buf,format=format)
-        response = HttpResponse(buf.getvalue(),content_type=content_type)
+        crosses_job = job.crossesjob
+
+        def render_plot():
+            # served from the pre-rendered plots. Only rendered here if the worker did not get to it yet
+            render_crosses_plots(crosses_job)
+            plot_file = crosses_job.plot_pdf if format == 'pdf' else crosses_job.plot_png
+            with plot_file.open('rb') as fh:
+                return HttpResponse(fh.read(),content_type=content_type)
+
+        # the plot only depends on the statistics of the finished job
+        etag = _make_etag(crosses_job.statistics_checksum, format)
+        return conditional_response(request._request, etag, crosses_job.finished, render_plot)
+
+@api_view(['GET'])
+@permission_classes((IsAuthenticatedOrReadOnly,))
+def crosses_windows(request, pk, job_id, format=None):
+    """
+    Binned window data of the crosses plot
+    ---
+    parameters:
+        - name: pk
+          description: id of the submission
+          required: true
+          type: number
+          paramType: path
+        - name: job_id
+          description: id of the job_id
+          required: True
+          type: number
+          paramType: path
+        - name: bins
+          description: number of bins per chromosome
+          required: false
+          type: number
+          paramType: query
+
+    omit_serializer: true
+    """
+    try:
+        bins = int(request.query_params.get('bins', plotting.PLOT_BINS_PER_CHROMOSOME))
+    except ValueError:
+        return HttpResponseBadRequest('bins must be a number')
+    bins = min(max(bins, 1), settings.CROSSES_WINDOWS_MAX_BINS)
+    job = get_object_or_404(IdentifyJob.objects.select_related('crossesjob'), pk=job_id, genotype_id=pk)
+    if not hasattr(job, 'crossesjob') or job.crossesjob.status != FINISHED:
+        raise Http404()
+    crosses_job = job.crossesjob
+
+    def build_response():
+        binned = plotting.bin_crosses_windows(crosses_job.stats, bins)
+        return Response({
+            'chromosomes': binned['chromosomes'],
+            'chromosome_starts': binned['chromosome_starts'].tolist(),
+            'chromosome_sizes': binned['chromosome_sizes'].tolist(),
+            'bins_per_chromosome': bins,
+            'parents': binned['parents'].tolist(),
+            'x': binned['x'].tolist(),
+            'counts': binned['counts'].tolist()
+        })
+
+    etag = _make_etag(crosses_job.statistics_checksum, bins)
+    return conditional_response(request._request, etag, crosses_job.finished, build_response)
+
+@api_view(['GET'])
+@permission_classes((IsAuthenticatedOrReadOnly,))
+def identify_scores(request, pk, job_id, format=None):
+    """
+    Scores of all accessions of an identify job ordered by descending score
+    ---
+    parameters:
+        - name: pk
+          description: id of the submission
+          required: true
+          type: number
+          paramType: path
+        - name: job_id
+          description: id of the job_id
+          required: True
+          type: number
+          paramType: path
+        - name: top
+          description: only return the top N accessions (N >= 1)
+          required: false
+          type: number
+          paramType: query
+        - name: accession
+          description: comma separated accession ids
+          required: false
+          type: string
+          paramType: query
+        - name: min_score
+          description: minimum score
+          required: false
+          type: number
+          paramType: query
+        - name: max_score
+          description: maximum score
+          required: false
+          type: number
+          paramType: query
+
+    omit_serializer: true
+    """
+    params = request.query_params
+    try:
+        top = int(params['top']) if 'top' in params else None
+        min_score = float(params['min_score']) if 'min_score' in params else None
+        max_score = float(params['max_score']) if 'max_score' in params else None
+    except ValueError:
+        return HttpResponseBadRequest('top, min_score and max_score must be numbers')
+    if top is not None and top < 1:
+        return HttpResponseBadRequest('top must be at least 1')
+    accessions = None
+    if 'accession' in params:
+        accessions = [accession.strip() for value in params.getlist('accession') for accession in value.split(',') if accession.strip()]
+    job = get_object_or_404(IdentifyJob, pk=job_id, genotype_id=pk)
+    if job.status != FINISHED or not job.identify_file:
+        raise Http404()
+    if not scores.has_scores(job.scores_folder):
+        # converted by the task workers (e.g. the conversion after the stage-out failed)
+        schedule_scores_conversion(job)
+        response = HttpResponse('The scores are not available yet', status=503)
+        response['Retry-After'] = settings.TASK_POLL_INTERVAL
         return response
 
+    def build_response():
+        rows = scores.open_scores(job.scores_folder).select(top=top, accessions=accessions, min_score=min_score, max_score=max_score)
+        paginator = ScoresPagination()
+        page = paginator.paginate_queryset(rows, request)
+        return paginator.get_paginated_response(page)
+
+    etag = _make_etag(job.identify_file.name, job.finished, request.get_full_path())
+    return conditional_response(request._request, etag, job.finished, build_response)
+
 @api_view(['GET'])
 @permission_classes((IsAuthenticatedOrReadOnly,))
 def download(request, pk, job_id):
@@ -152,10 +481,20 @@ def download(request, pk, job_id):
     """
 
     if request.method == "GET":
-        job = IdentifyJob.objects.get(pk=job_id)
-        fp = tempfile.NamedTemporaryFile(suffix='zip')
-        create_download_zip(fp,job)
-        fp.seek(0)
-        response = HttpResponse(FileWrapper(fp), content_type='application/zip')
-        response['Content-Disposition'] = 'attachment; filename="%s_%s.zip"' % (job.genotype.id, job.dataset.name)
+        job = get_object_or_404(IdentifyJob.objects.select_related('dataset', 'crossesjob'), pk=job_id, genotype_id=pk)
+        if job.status != FINISHED:
+            raise Http404()
+        if not job.has_current_download_bundle:
+            # served from the pre-built bundle. Built by the task workers
+            schedule_download_bundle(job)
+            response = HttpResponse('The download is not available yet', status=503)
+            response['Retry-After'] = settings.TASK_POLL_INTERVAL
+            return response
+        if settings.DOWNLOAD_ACCEL_REDIRECT:
+            # nginx streams the file (including range requests) from the internal location
+            response = HttpResponse(content_type='application/zip')
+            response['X-Accel-Redirect'] = settings.DOWNLOAD_ACCEL_LOCATION + job.download_file.name
+        else:
+            response = ranged_file_response(request._request, job.download_file.path, 'application/zip', _make_etag(job.download_checksum))
+        response['Content-Disposition'] = 'attachment; filename="%s_%s.zip"' % (job.genotype_id, job.dataset.name)
         return response
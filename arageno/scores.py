@@ -0,0 +1,121 @@
+"""
+Columnar storage of the identify scores.
+The scores.txt of SNPmatch is converted once into one .npy file per column, sorted by score,
+so that the rows can be queried from memory-mapped files without reading the whole table.
+This module does not depend on django
+"""
+import os
+import shutil
+import tempfile
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+
+# columns of the SNPmatch scores.txt. Additional columns are ignored
+SCORE_COLUMNS = ('accession', 'matched_snps', 'informative_snps', 'score', 'likelihood', 'likelihood_ratio')
+COLUMN_TYPES = {'accession': str, 'matched_snps': np.int64, 'informative_snps': np.int64}
+# sorted accession ids and the row of each accession
+INDEX_FILE = 'accession_index.npy'
+ROWS_FILE = 'accession_rows.npy'
+
+
+def convert_scores(tsv_path, folder):
+    """
+    Converts the scores TSV into the columnar format. The rows are sorted by ascending score.
+    The folder is replaced atomically so that readers never see a partial table
+    """
+    df = pd.read_csv(tsv_path, sep='\t', header=None, usecols=range(len(SCORE_COLUMNS)),
+                     names=SCORE_COLUMNS, dtype=COLUMN_TYPES)
+    df = df.sort_values('score', kind='mergesort').reset_index(drop=True)
+    parent_folder = os.path.dirname(os.path.abspath(folder))
+    os.makedirs(parent_folder, exist_ok=True)
+    tmp_folder = tempfile.mkdtemp(dir=parent_folder)
+    accessions = df['accession'].values.astype(str)
+    for column in SCORE_COLUMNS:
+        values = accessions if column == 'accession' else df[column].values
+        np.save(os.path.join(tmp_folder, '%s.npy' % column), values)
+    rows = np.argsort(accessions, kind='mergesort')
+    np.save(os.path.join(tmp_folder, INDEX_FILE), accessions[rows])
+    np.save(os.path.join(tmp_folder, ROWS_FILE), rows.astype(np.int64))
+    old_folder = None
+    if os.path.exists(folder):
+        old_folder = tempfile.mkdtemp(dir=parent_folder)
+        os.rename(folder, os.path.join(old_folder, 'scores'))
+    os.rename(tmp_folder, folder)
+    if old_folder is not None:
+        shutil.rmtree(old_folder, ignore_errors=True)
+
+
+def has_scores(folder):
+    return os.path.exists(os.path.join(folder, ROWS_FILE))
+
+
+def open_scores(folder):
+    """Returns the (cached) score table of a folder"""
+    return _open_scores(folder, os.stat(os.path.join(folder, ROWS_FILE)).st_mtime)
+
+
+@lru_cache(maxsize=64)
+def _open_scores(folder, mtime):
+    return ScoreTable(folder)
+
+
+class ScoreTable(object):
+    """Read-only view on the memory-mapped columns of a converted scores table"""
+
+    def __init__(self, folder):
+        self.columns = {column: np.load(os.path.join(folder, '%s.npy' % column), mmap_mode='r')
+                        for column in SCORE_COLUMNS}
+        self.accession_index = np.load(os.path.join(folder, INDEX_FILE), mmap_mode='r')
+        self.accession_rows = np.load(os.path.join(folder, ROWS_FILE), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.accession_rows)
+
+    def get_row(self, row):
+        data = {column: values[row].item() for column, values in self.columns.items()}
+        data['rank'] = len(self) - int(row)
+        return data
+
+    def score_range(self, min_score=None, max_score=None):
+        """Returns the first and last+1 row with a score between min_score and max_score"""
+        scores = self.columns['score']
+        start = 0 if min_score is None else int(np.searchsorted(scores, min_score, side='left'))
+        end = len(self) if max_score is None else int(np.searchsorted(scores, max_score, side='right'))
+        return start, max(start, end)
+
+    def find_accessions(self, accessions):
+        """Returns the rows of the accessions"""
+        rows = []
+        for accession in accessions:
+            ix = int(np.searchsorted(self.accession_index, accession))
+            while ix < len(self) and self.accession_index[ix] == accession:
+                rows.append(int(self.accession_rows[ix]))
+                ix += 1
+        return rows
+
+    def select(self, top=None, accessions=None, min_score=None, max_score=None):
+        """Returns the selected rows ordered by descending score"""
+        start, end = self.score_range(min_score, max_score)
+        if accessions is not None:
+            rows = sorted((row for row in self.find_accessions(accessions) if start <= row < end), reverse=True)
+            return ScoreRows(self, rows[:top])
+        if top is not None:
+            start = max(start, end - top)
+        return ScoreRows(self, range(end - 1, start - 1, -1))
+
+
+class ScoreRows(object):
+    """Lazy sequence of score rows. Only the sliced rows are read from the table"""
+
+    def __init__(self, table, rows):
+        self.table = table
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [self.table.get_row(row) for row in self.rows[item]]
+        return self.table.get_row(self.rows[item])
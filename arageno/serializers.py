@@ -4,10 +4,10 @@ Serializers for REST api views
 
 from django.urls import reverse
 from rest_framework import serializers
-from .models import GenotypeSubmission, IdentifyJob, Dataset
+from .models import GenotypeSubmission, IdentifyJob, CrossesJob, Dataset
 import json
 import logging
-from .apps import AraGenoConfig
+from .accessions import get_accession_map
 
 logger = logging.getLogger(__name__)
 
@@ -16,14 +16,32 @@ def retrieve_accession_infos(accession_ids):
     """Retrieves accession infos from REST endpoint"""
     accession_infos = {}
     if accession_ids:
-        #TODO make it more efficient
+        accessions_map = get_accession_map()
         for acc_id in accession_ids:
-            try:
-                accession_infos[acc_id] = AraGenoConfig.accessions_map[int(acc_id)]
-            except Exception as err:
-                logger.warn('Could not retrieve infos for acc %s. Error: %s ', acc_id, repr(err))
+            acc = accessions_map.get(acc_id)
+            if acc is None:
+                logger.warning('Could not retrieve infos for acc %s', acc_id)
+                continue
+            accession_infos[acc_id] = acc
     return accession_infos
 
+
+def get_accessions_url():
+    """Returns the url of the fingerprinted accession bundle"""
+    fingerprint = get_accession_map().fingerprint
+    if fingerprint is None:
+        return None
+    return reverse('accession_bundle', args=[fingerprint])
+
+def get_pipeline_state(genotype):
+    """Returns the state of the latest pipeline task of the submission"""
+    task = genotype.task_set.pipeline().order_by('-created').first()
+    if task is None:
+        return None
+    return {'status': task.status, 'status_text': task.get_status_display(),
+            'attempts': task.attempts, 'run_after': task.run_after}
+
+
 class JSONSerializerField(serializers.Field):
     """ Serializer for JSONField -- required to make field writable"""
 
@@ -43,49 +61,109 @@ class DatasetSerializer(serializers.HyperlinkedModelSerializer):
 
 
 class CrossesJobSerializer(serializers.HyperlinkedModelSerializer):
-    statistics = JSONSerializerField()
+    statistics = serializers.ReadOnlyField(source='stats')
     status_text = serializers.CharField(source='get_status_display')
     plot_url = serializers.SerializerMethodField()
+    windows_url = serializers.SerializerMethodField()
 
     class Meta:
         model = IdentifyJob
         fields = ('id', 'status', 'status_text',
-                  'progress','remaining','updated','created', 'statistics', 'plot_url')
+                  'progress','remaining','updated','created', 'statistics', 'plot_url', 'windows_url')
 
     def get_plot_url(self, obj):
-        return reverse('crosses_plot', args=[obj.identifyjob.genotype.id, obj.pk])
+        return reverse('crosses_plot', args=[obj.identifyjob.genotype_id, obj.pk])
+
+    def get_windows_url(self, obj):
+        return reverse('crosses_windows', args=[obj.identifyjob.genotype_id, obj.pk])
 
 
 class IdentifyJobSerializer(serializers.HyperlinkedModelSerializer):
     dataset = DatasetSerializer()
-    statistics = JSONSerializerField()
+    statistics = serializers.ReadOnlyField(source='stats')
     status_text = serializers.CharField(source='get_status_display')
     crossesjob = CrossesJobSerializer()
     download_url = serializers.SerializerMethodField()
+    scores_url = serializers.SerializerMethodField()
 
     class Meta:
         model = IdentifyJob
         fields = ('id', 'status', 'status_text','updated','created', 'progress',
-                  'remaining','statistics', 'dataset', 'crossesjob','download_url')
+                  'remaining','statistics', 'dataset', 'crossesjob','download_url', 'scores_url')
 
     def get_download_url(self, obj):
-        return reverse('download', args=[obj.genotype.id, obj.pk])
+        return reverse('download', args=[obj.genotype_id, obj.pk])
+
+    def get_scores_url(self, obj):
+        return reverse('identify_scores', args=[obj.genotype_id, obj.pk])
 
 
 class GenotypeSubmissionSerializer(serializers.HyperlinkedModelSerializer):
     identifyjob_set = IdentifyJobSerializer(many=True, read_only=True)
-    statistics = JSONSerializerField(read_only=True)
+    statistics = serializers.ReadOnlyField(source='stats')
     status_text = serializers.CharField(source='get_status_display',read_only=True)
     accessions = serializers.SerializerMethodField(read_only=True)
+    accessions_url = serializers.SerializerMethodField(read_only=True)
+    pipeline = serializers.SerializerMethodField(read_only=True)
 
     class Meta:
         model = GenotypeSubmission
         fields = ('url', 'id', 'created', 'updated', 'fullname','firstname', 'lastname', 'statistics', 'email',
-                  'progress','remaining', 'status', 'status_text',  'identifyjob_set', 'identify_finished', 'accessions')
+                  'progress','remaining', 'status', 'status_text',  'identifyjob_set', 'identify_finished', 'accessions',
+                  'accessions_url', 'pipeline')
         extra_kwargs = {'firstname': {'write_only': True},
                         'lsatname': {'write_only': True},
                         'id': {'read_only': True}
                         }
 
     def get_accessions(self, obj):
-        return retrieve_accession_infos(obj.accession_ids)
+        """Returns the matched accession ids. The infos are only embedded with ?expand=accessions (&top=N)"""
+        request = self.context.get('request')
+        params = getattr(request, 'query_params', getattr(request, 'GET', {}))
+        if 'accessions' not in params.get('expand', '').split(','):
+            return sorted(obj.accession_ids)
+        try:
+            top = int(params['top']) if 'top' in params else None
+        except ValueError:
+            raise serializers.ValidationError({'top': 'top must be a number'})
+        return retrieve_accession_infos(obj.get_accession_ids(top))
+
+    def get_accessions_url(self, obj):
+        return get_accessions_url()
+
+    def get_pipeline(self, obj):
+        return get_pipeline_state(obj)
+
+
+class CrossesJobStatusSerializer(serializers.ModelSerializer):
+    """Status and progress of a crosses job without the statistics"""
+    status_text = serializers.CharField(source='get_status_display')
+
+    class Meta:
+        model = CrossesJob
+        fields = ('status', 'status_text', 'progress', 'remaining', 'updated')
+
+
+class IdentifyJobStatusSerializer(serializers.ModelSerializer):
+    """Status and progress of an identify job without the statistics"""
+    status_text = serializers.CharField(source='get_status_display')
+    crossesjob = CrossesJobStatusSerializer()
+
+    class Meta:
+        model = IdentifyJob
+        fields = ('id', 'status', 'status_text', 'progress', 'remaining', 'updated', 'crossesjob')
+
+
+class GenotypeSubmissionStatusSerializer(serializers.ModelSerializer):
+    """Status and progress of a submission and its jobs without the statistics"""
+    status_text = serializers.CharField(source='get_status_display')
+    jobs = IdentifyJobStatusSerializer(source='identifyjob_set', many=True)
+    pipeline = serializers.SerializerMethodField()
+
+    class Meta:
+        model = GenotypeSubmission
+        fields = ('id', 'status', 'status_text', 'progress', 'remaining', 'updated', 'identify_finished',
+                  'pipeline', 'jobs')
+
+    def get_pipeline(self, obj):
+        return get_pipeline_state(obj)
@@ -2,21 +2,30 @@
 Business logic/Service layer
 """
 
-from .models import IdentifyJob, Dataset
+from .models import GenotypeSubmission, IdentifyJob, CrossesJob, Dataset, JobAccounting, Setting, FINISHED, ERROR, PIPELINE_TASK
+from .tasks import task, enqueue, is_pending
+from django.core.files.base import ContentFile, File
 from django.core.mail import EmailMessage
 from django.db import transaction
-from .hpc import identify_pipeline, update_genotype_status
+from django.db.models import Q
+from django.utils import timezone
+from datetime import timedelta
+from collections import Counter
+from .hpc import identify_pipeline, submit_identify_batch, update_genotype_status, get_active_job_ids, get_jobs_status, get_jobs_accounting, get_hpc_executors, get_executor, HPCUnavailableError
 from django.conf import settings
 import requests
 import logging
+import json
+import numpy as np
 from . import plotting
+from . import scores
 import re
 import subprocess
-import shutil
 import tempfile
 from .serializers import IdentifyJobSerializer
 from rest_framework.renderers import JSONRenderer
 import zipfile
+import time
 
 
 # Get an instance of a logger
@@ -37,9 +46,23 @@ def create_identifyjobs(genotype, datasets=None):
         identifyjob.save()
 
 
+def enqueue_identify_pipeline(genotype, send_email=True):
+    """Enqueues the identify pipeline for the task workers"""
+    return enqueue(PIPELINE_TASK, genotype=genotype, genotype_id=str(genotype.id), send_email=send_email)
+
+
+@task
+def identify_pipeline_task(genotype_id, send_email=True):
+    """Runs the identify pipeline of a submission. Executed by the task workers"""
+    start_identify_pipeline(GenotypeSubmission.objects.get(pk=genotype_id), send_email=send_email)
+
+
 def start_identify_pipeline(genotype, send_email=True):
     """Start the identify pipeline"""
-    identify_pipeline(genotype.id)
+    batch = settings.IDENTIFY_BATCH_WINDOW > 0
+    identify_pipeline(genotype.id, batch=batch)
+    if batch:
+        schedule_identify_batch()
     if send_email:
         email = EmailMessage(
             'Identification job stated on AraGeno',
@@ -49,12 +72,313 @@ def start_identify_pipeline(genotype, send_email=True):
         )
         email.send(True)
 
+def schedule_identify_batch():
+    """Enqueues the submission of the identify jobs that arrive within IDENTIFY_BATCH_WINDOW"""
+    if not is_pending('submit_identify_batch_task'):
+        enqueue('submit_identify_batch_task', run_after=timezone.now() + timedelta(seconds=settings.IDENTIFY_BATCH_WINDOW))
+
+
+@task
+def submit_identify_batch_task():
+    """Submits the batched identify jobs. Executed by the task workers"""
+    submit_pending_identify_jobs()
+
+
+def submit_pending_identify_jobs():
+    """
+    Submits the identify jobs of all submissions whose parse job was submitted
+    as one batch job per dataset (at most IDENTIFY_BATCH_MAX_SIZE samples per batch).
+    Only called from the single pending submit_identify_batch_task
+    """
+    num_of_submitted = 0
+    executors = [executor.name for executor in get_hpc_executors() if executor.supports_batch]
+    while True:
+        jobs = list(IdentifyJob.objects.select_related('genotype', 'dataset')
+                    .filter(jobid__isnull=True, genotype__jobid__isnull=False, executor__in=executors)
+                    .exclude(genotype__status=ERROR).order_by('pk')[:settings.IDENTIFY_BATCH_MAX_SIZE])
+        if not jobs:
+            return num_of_submitted
+        submit_identify_batch(jobs)
+        num_of_submitted += len(jobs)
+
+
+@task
+def submit_crosses_job_task(crossesjob_id):
+    """
+    Submits a crosses job of an executor that runs the jobs in process (local process pool).
+    Executed by the task workers so that the jobs do not run in a web server process
+    """
+    crosses_job = CrossesJob.objects.select_related('identifyjob__genotype', 'identifyjob__dataset').get(pk=crossesjob_id)
+    if not crosses_job.jobid:
+        get_executor(crosses_job).submit_crosses_job(crosses_job)
+
+
+def claim_refresh(genotype):
+    """
+    Claims the HPC status refresh of a submission and locks it until release_refresh is called.
+    Fails if the submission was refreshed within HPC_STATUS_TTL or another thread or process still refreshes it,
+    however long that takes (e.g. a slow stage-out), so that jobs are not submitted twice
+    """
+    now = timezone.now()
+    stale = Q(refreshed__isnull=True) | Q(refreshed__lt=now - timedelta(seconds=settings.HPC_STATUS_TTL))
+    unlocked = Q(refresh_locked__isnull=True) | Q(
+        refresh_locked__lt=now - timedelta(seconds=settings.HPC_REFRESH_LOCK_TIMEOUT))
+    claimed = GenotypeSubmission.objects.filter(stale, unlocked, pk=genotype.pk).update(refreshed=now,
+                                                                                         refresh_locked=now)
+    if not claimed:
+        return False
+    genotype.refreshed = now
+    genotype.refresh_locked = now
+    return True
+
+
+def release_refresh(genotype):
+    """Releases the lock of claim_refresh. The HPC_STATUS_TTL starts when the refresh is done"""
+    now = timezone.now()
+    GenotypeSubmission.objects.filter(pk=genotype.pk).update(refreshed=now, refresh_locked=None)
+    genotype.refreshed = now
+    genotype.refresh_locked = None
+
+
 def update_submission(genotype):
-    if not genotype.identify_finished:
-        update_genotype_status(genotype)
+    """Refreshes the HPC status of a submission unless the background poller takes care of it"""
+    if settings.HPC_BACKGROUND_POLLING:
+        return genotype
+    if not genotype.identify_finished and claim_refresh(genotype):
+        try:
+            update_genotype_status(genotype)
+        except HPCUnavailableError as err:
+            # serve the last known state from the database
+            logger.warning('Could not refresh %s: %s', genotype, err)
+        finally:
+            release_refresh(genotype)
+        schedule_result_files(genotype)
     return genotype
 
 
+def update_unfinished_submissions():
+    """Refreshes the HPC status of all unfinished submissions"""
+    num_of_updated = 0
+    genotypes = list(GenotypeSubmission.objects.unfinished().with_jobs())
+    job_ids = []
+    for genotype in genotypes:
+        job_ids.extend(get_active_job_ids(genotype))
+    try:
+        statuses = get_jobs_status(job_ids)
+    except HPCUnavailableError as err:
+        logger.warning('Skipping refresh: %s', err)
+        return num_of_updated
+    for genotype in genotypes:
+        if not claim_refresh(genotype):
+            continue
+        try:
+            update_genotype_status(genotype, statuses)
+            schedule_result_files(genotype)
+            num_of_updated += 1
+        except Exception as err:
+            logger.exception('Failed to update status of %s: %s', genotype, repr(err))
+        finally:
+            release_refresh(genotype)
+    return num_of_updated
+
+
+def schedule_result_files(genotype):
+    """
+    Enqueues the rendering of the crosses plots and the building of the download bundles
+    of finished jobs whose files are missing or outdated
+    """
+    for identify_job in genotype.identifyjob_set.all():
+        if identify_job.status != FINISHED or not identify_job.crosses_finished:
+            continue
+        crosses_job = getattr(identify_job, 'crossesjob', None)
+        if crosses_job is not None and crosses_job.status == FINISHED and not crosses_job.has_current_plots:
+            # the bundle is built once the plots are rendered
+            if not is_pending('render_crosses_plots_task', identifyjob_id=crosses_job.pk):
+                enqueue('render_crosses_plots_task', identifyjob_id=crosses_job.pk)
+        elif not identify_job.has_current_download_bundle:
+            schedule_download_bundle(identify_job)
+
+
+def schedule_download_bundle(identify_job):
+    """Enqueues the building of the download bundle of a finished identify job"""
+    if not is_pending('build_download_bundle_task', identifyjob_id=identify_job.pk):
+        enqueue('build_download_bundle_task', identifyjob_id=identify_job.pk)
+
+
+@task
+def render_crosses_plots_task(identifyjob_id):
+    """Renders the plots of a crosses job. Executed by the task workers"""
+    crosses_job = render_crosses_plots(CrossesJob.objects.select_related('identifyjob__genotype').get(pk=identifyjob_id))
+    schedule_download_bundle(crosses_job.identifyjob)
+
+
+@task
+def build_download_bundle_task(identifyjob_id):
+    """Builds the download bundle of an identify job. Executed by the task workers"""
+    build_download_bundle(IdentifyJob.objects.select_related('genotype', 'dataset', 'crossesjob').get(pk=identifyjob_id))
+
+
+@task
+def convert_scores_task(identifyjob_id):
+    """Converts the scores of an identify job into the columnar format. Executed by the task workers"""
+    identify_job = IdentifyJob.objects.get(pk=identifyjob_id)
+    if not scores.has_scores(identify_job.scores_folder):
+        scores.convert_scores(identify_job.identify_file.path, identify_job.scores_folder)
+
+
+def schedule_scores_conversion(identify_job):
+    """Enqueues the conversion of the scores of an identify job unless it is already pending"""
+    if not is_pending('convert_scores_task', identifyjob_id=identify_job.pk):
+        enqueue('convert_scores_task', identifyjob_id=identify_job.pk)
+
+
+def render_crosses_plots(crosses_job):
+    """
+    Renders the crosses plots (PNG and PDF) in the renderer process pool and stores them.
+    Plots are only rendered again when the statistics changed
+    """
+    if crosses_job.status != FINISHED:
+        raise ValueError('Job is not finished yet')
+    if crosses_job.has_current_plots:
+        return crosses_job
+    checksum = crosses_job.statistics_checksum
+    plots = plotting.render_crosses_plot_in_pool(crosses_job.stats, max_workers=settings.PLOT_RENDER_PROCESSES,
+                                                 timeout=settings.PLOT_RENDER_TIMEOUT)
+    for field, format in ((crosses_job.plot_png, 'png'), (crosses_job.plot_pdf, 'pdf')):
+        if field:
+            field.delete(False)
+        field.save(f'{crosses_job.pk}_crosses.{format}', ContentFile(plots[format]), save=False)
+    crosses_job.plot_checksum = checksum
+    crosses_job.save()
+    return crosses_job
+
+
+def _get_accounting_candidates(since):
+    """
+    Returns the job id and the polynominal inputs of the HPC jobs that ended since a date and were not collected yet.
+    Failed jobs have no finish date, so the date of the last update is used. Identify jobs that shared a batch job
+    are skipped, as its usage can not be attributed to a single sample
+    """
+    executors = [executor.name for executor in get_hpc_executors()]
+    ended = Q(status__in=(FINISHED, ERROR), updated__gte=since, jobid__isnull=False, executor__in=executors)
+    candidates = []
+    for genotype in GenotypeSubmission.objects.filter(ended):
+        candidates.append((genotype.hpc_job_id, {'kind': JobAccounting.PARSE, 'genotype': genotype,
+                                                 'input_format': 'bed' if genotype.is_bed else 'vcf',
+                                                 'num_of_markers': genotype._num_of_markers}))
+    identify_jobs = list(IdentifyJob.objects.select_related('genotype').filter(ended))
+    num_of_jobs = Counter(job.hpc_job_id for job in identify_jobs)
+    for job in identify_jobs:
+        if num_of_jobs[job.hpc_job_id] > 1:
+            continue
+        candidates.append((job.hpc_job_id, {'kind': JobAccounting.IDENTIFY, 'genotype': job.genotype,
+                                            'dataset_id': job.dataset_id, 'num_of_markers': job.genotype.num_of_markers}))
+    for job in CrossesJob.objects.select_related('identifyjob__genotype').filter(ended):
+        candidates.append((job.hpc_job_id, {'kind': JobAccounting.CROSSES, 'genotype': job.identifyjob.genotype,
+                                            'dataset_id': job.identifyjob.dataset_id,
+                                            'num_of_markers': job.identifyjob.genotype.num_of_markers}))
+    collected = set(JobAccounting.objects.filter(jobid__in=[jobid for jobid, _ in candidates])
+                    .values_list('jobid', flat=True))
+    return [(jobid, fields) for jobid, fields in candidates if jobid not in collected]
+
+
+# job id -> time when the scheduler is asked again for the accounting of a job it did not report
+_accounting_retries = {}
+
+
+def collect_job_accounting(batch_size=200):
+    """
+    Stores the resource usage reported by the schedulers (sacct, qstat) for the jobs that ended recently.
+    Jobs the scheduler did not report are only asked for again after HPC_ACCOUNTING_RETRY_INTERVAL
+    """
+    since = timezone.now() - timedelta(days=settings.HPC_ACCOUNTING_MAX_AGE)
+    now = time.time()
+    candidates = _get_accounting_candidates(since)
+    # forget the jobs that were collected or are too old
+    for jobid in set(_accounting_retries) - set(jobid for jobid, _ in candidates):
+        del _accounting_retries[jobid]
+    candidates = [(jobid, fields) for jobid, fields in candidates if _accounting_retries.get(jobid, 0) <= now]
+    num_of_collected = 0
+    for ix in range(0, len(candidates), batch_size):
+        batch = candidates[ix:ix + batch_size]
+        accounting = get_jobs_accounting([jobid for jobid, _ in batch])
+        records = []
+        for jobid, fields in batch:
+            data = accounting.get(jobid)
+            if data is None:
+                _accounting_retries[jobid] = now + settings.HPC_ACCOUNTING_RETRY_INTERVAL
+                continue
+            _accounting_retries.pop(jobid, None)
+            records.append(JobAccounting(jobid=jobid, state=data['state'],
+                                         elapsed=None if data['elapsed'] is None else int(data['elapsed']),
+                                         total_cpu=data['total_cpu'],
+                                         max_rss=None if data['max_rss'] is None else int(data['max_rss']), **fields))
+        JobAccounting.objects.bulk_create(records, ignore_conflicts=True)
+        num_of_collected += len(records)
+    return num_of_collected
+
+
+def fit_polynominal(x, y, degree, quantile):
+    """
+    Least squares fit that is shifted by the quantile of the residuals,
+    so that the given share of the observations lies below the curve
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    degree = min(degree, len(np.unique(x)) - 1)
+    poly = np.poly1d(np.polyfit(x, y, degree))
+    margin = np.percentile(y - poly(x), quantile * 100)
+    return poly + max(margin, 0)
+
+
+def _calibrate_polynominal(records, column, current, quantile, min_samples):
+    rows = [(num_of_markers, value) for num_of_markers, value in records.values_list('num_of_markers', column)
+            if num_of_markers is not None and value is not None]
+    if len(rows) < min_samples:
+        return None
+    degree = len(json.loads(current)) - 1 if current else 1
+    x, y = zip(*rows)
+    return json.dumps(fit_polynominal(x, y, degree, quantile).coeffs.tolist())
+
+
+def calibrate_resources(quantile, min_samples, since, dry_run=False):
+    """
+    Refits the runtime and memory polynominals of the datasets (identify, crosses) and of the
+    parse jobs (per input format) from the accounting data of the successful jobs.
+    Returns the changed polynominals as (name, old value, new value, number of samples)
+    """
+    completed = JobAccounting.objects.filter(state='COMPLETED', created__gte=since)
+    resources = (('runtime', 'elapsed'), ('memory', 'max_rss'))
+    changes = []
+    for dataset in Dataset.objects.all():
+        changed = False
+        for kind in (JobAccounting.IDENTIFY, JobAccounting.CROSSES):
+            records = completed.filter(kind=kind, dataset=dataset)
+            for resource, column in resources:
+                field = '%s_%s' % (resource, kind)
+                value = _calibrate_polynominal(records, column, getattr(dataset, field), quantile, min_samples)
+                if value is None:
+                    continue
+                changes.append(('%s.%s' % (dataset.name, field), getattr(dataset, field), value, records.count()))
+                setattr(dataset, field, value)
+                changed = True
+        if changed and not dry_run:
+            dataset.save()
+    for input_format in ('vcf', 'bed'):
+        records = completed.filter(kind=JobAccounting.PARSE, input_format=input_format)
+        for resource, column in resources:
+            key = '%s_parsing_%s' % (resource, input_format)
+            setting = Setting.objects.filter(pk=key).first()
+            current = setting.value if setting else None
+            value = _calibrate_polynominal(records, column, current, quantile, min_samples)
+            if value is None:
+                continue
+            changes.append((key, current, value, records.count()))
+            if not dry_run:
+                Setting.objects.update_or_create(key=key, defaults={'value': value})
+    return changes
+
+
 def count_lines(filename):
     """Return number of lines in file"""
     lines = None
@@ -69,20 +393,32 @@ def count_lines(filename):
 def create_download_zip(fp,job):
 
     with zipfile.ZipFile(fp, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-        dir_name = tempfile.mkdtemp()
-        json = JSONRenderer().render(IdentifyJobSerializer(job).data)
-        stats_file = '%s/stats.json' % dir_name
-        with open(stats_file,'wb') as fp:
-            fp.write(json)
-        zip_file.write(stats_file,'stats.json')
-        # put files there
-        shutil.copyfile(job.identify_file.path,'%s/result.tsv' % dir_name)
-        zip_file.write('%s/result.tsv' % dir_name,'result.tsv')
-        if(hasattr(job, 'crossesjob')):
-            plt = plotting.plot_crosses_data(job.crossesjob)
-            plt.savefig('%s/crosses_plot.pdf' % dir_name)
-            zip_file.write('%s/crosses_plot.pdf' % dir_name,'crosses_plot.pdf')
-        shutil.rmtree(dir_name,ignore_errors=True)
+        zip_file.writestr('stats.json', JSONRenderer().render(IdentifyJobSerializer(job).data))
+        zip_file.write(job.identify_file.path, 'result.tsv')
+        if hasattr(job, 'crossesjob') and job.crossesjob.status == FINISHED:
+            crosses_job = render_crosses_plots(job.crossesjob)
+            zip_file.write(crosses_job.plot_pdf.path,'crosses_plot.pdf')
+
+
+def build_download_bundle(job):
+    """
+    Builds the zip bundle of a finished identify job and stores it next to the result file.
+    The bundle is only built again when the results changed
+    """
+    if job.status != FINISHED:
+        raise ValueError('Job is not finished yet')
+    if job.has_current_download_bundle:
+        return job
+    checksum = job.download_bundle_checksum
+    with tempfile.TemporaryFile() as fp:
+        create_download_zip(fp, job)
+        fp.seek(0)
+        if job.download_file:
+            job.download_file.delete(False)
+        job.download_file.save(f'{job.pk}_download.zip', File(fp), save=False)
+    job.download_checksum = checksum
+    job.save(update_fields=['download_file', 'download_checksum'])
+    return job
 
 
 
@@ -0,0 +1,482 @@
+"""
+In-process stand-in for the HPC login node and SLURM.
+SimulatedCluster understands the commands that hpc.py runs over SSH (sbatch, scontrol, squeue, sacct,
+cat, test, mkdir, rm, find) and keeps a simulated queue with configurable pending/run times and failure rates.
+The remote file system is mapped into a local folder and finished jobs write synthetic result files
+and, if their submit script contains one, the sentinels in the spool folder (see hpc.SENTINEL_SCRIPT).
+With agent=True the connections also execute the batches of commands of the agent
+(submit_script_templates/hpc_agent.py) in one call.
+Swap it in with hpc.set_connection_factory(cluster.connect).
+This module does not depend on django
+"""
+import hashlib
+import json
+import os
+import random
+import re
+import shlex
+import shutil
+import tempfile
+import threading
+import time
+from collections import Counter
+from invoke.exceptions import UnexpectedExit
+from invoke.runners import Result
+
+PENDING = 'PENDING'
+RUNNING = 'RUNNING'
+COMPLETED = 'COMPLETED'
+CANCELLED = 'CANCELLED'
+# final states a job can be ended with (besides COMPLETED)
+FAILURE_STATES = ('FAILED', 'TIMEOUT', 'OUT_OF_MEMORY', 'NODE_FAIL')
+FINAL_STATES = (COMPLETED, CANCELLED) + FAILURE_STATES
+
+SBATCH_DIRECTIVE = re.compile(r'^#SBATCH\s+(--?[\w-]+)(?:[=\s]+(\S+))?')
+SENTINEL_LINE = re.compile(r'^SENTINEL=(\S+)/', re.MULTILINE)
+# exit code in the sentinel of the jobs that end in a state. Killed jobs (SIGKILL) do not write a sentinel
+SENTINEL_EXIT_CODES = {COMPLETED: 0, 'FAILED': 1, 'TIMEOUT': 143}
+CHROMOSOMES = ('Chr1', 'Chr2', 'Chr3', 'Chr4', 'Chr5')
+ACCESSIONS = ('6909', '9399', '9057', '6095', '6100', '6126', '9970', '5253', '6137', '6092', '997', '1006')
+
+
+class SimulatedJob(object):
+
+    def __init__(self, job_id, kind, env, workdir, submitted, pending_time, run_time, outcome,
+                 depends=(), held=False, index_line=None):
+        self.job_id = job_id
+        self.kind = kind
+        self.env = env
+        self.workdir = workdir
+        self.submitted = submitted
+        self.pending_time = pending_time
+        self.run_time = run_time
+        self.outcome = outcome
+        self.depends = list(depends)
+        self.held = held
+        self.released = None
+        self.index_line = index_line
+        # spool folder of the sentinels
+        self.spool = None
+        self.state = PENDING
+        self.started = None
+        self.ended = None
+
+
+class SimulatedCluster(object):
+    """
+    Simulated login node with a SLURM queue.
+    Pending and run times are drawn uniformly from the given (min, max) ranges in seconds.
+    failure_rates maps a final state (FAILED, TIMEOUT, OUT_OF_MEMORY, NODE_FAIL) to its probability.
+    crosses_rate is the share of identify jobs whose result requires a crosses job.
+    Every SSH call (or batch of agent commands) sleeps for latency seconds and is counted in calls
+    """
+
+    def __init__(self, root=None, pending_time=(0, 5), run_time=(5, 30), failure_rates=None, crosses_rate=0.2,
+                 latency=0.0, seed=None, clock=time.time, agent=False):
+        self.root = root or tempfile.mkdtemp(prefix='arageno-simulator-')
+        self.pending_time = pending_time
+        self.run_time = run_time
+        self.failure_rates = failure_rates or {}
+        self.crosses_rate = crosses_rate
+        self.latency = latency
+        self.clock = clock
+        self.agent = agent
+        self.calls = Counter()
+        self.jobs = {}
+        self._random = random.Random(seed)
+        self._seed = seed
+        self._next_job_id = 1000
+        self._lock = threading.RLock()
+
+    def connect(self):
+        """Connection factory for hpc.set_connection_factory"""
+        if self.agent:
+            return SimulatedAgentConnection(self)
+        return SimulatedConnection(self)
+
+    def close(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def local_path(self, remote_path):
+        return os.path.join(self.root, remote_path.lstrip('/'))
+
+    def count(self, name):
+        with self._lock:
+            self.calls[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def put(self, local, remote):
+        self.count('put')
+        path = self.local_path(remote)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copyfile(local, path)
+
+    def get(self, remote, local):
+        self.count('get')
+        shutil.copyfile(self.local_path(remote), local)
+
+    def run(self, command):
+        """Runs a shell command and returns (exit code, stdout, stderr)"""
+        # one SSH call per command line, named after its last command (cd X && cat F is counted as cat)
+        self.count(command.split('&&')[-1].split()[0])
+        return self._run(command)
+
+    def call(self, commands, stop_on_error=False):
+        """Executes a batch of agent commands with one call"""
+        self.count('agent')
+        results = []
+        for command in commands:
+            if stop_on_error and results and not results[-1]['ok']:
+                results.append({'ok': False, 'error': 'Skipped'})
+                continue
+            results.append(self._execute(command))
+        return results
+
+    def _execute(self, command):
+        op = command['op']
+        if op == 'run':
+            exited, stdout, stderr = self._run(command['cmd'])
+            return {'ok': exited == 0, 'exited': exited, 'stdout': stdout, 'stderr': stderr}
+        if op == 'ping':
+            return {'ok': True, 'value': 1}
+        path = self.local_path(command['path'])
+        if op == 'exists':
+            return {'ok': True, 'value': os.path.exists(path)}
+        if op == 'mkdir':
+            os.makedirs(path, exist_ok=True)
+        elif op == 'write':
+            with open(path, 'w') as fh:
+                fh.write(command['content'])
+        elif op == 'read':
+            if not os.path.exists(path):
+                return {'ok': False, 'error': 'No such file: %s' % command['path']}
+            with open(path) as fh:
+                return {'ok': True, 'value': fh.read()}
+        elif op == 'remove':
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            elif os.path.exists(path):
+                os.remove(path)
+        elif op == 'list':
+            with self._lock:
+                self._update_jobs()
+            if not os.path.isdir(path):
+                return {'ok': True, 'value': {}}
+            return {'ok': True, 'value': {name: os.path.getmtime(os.path.join(path, name)) for name in os.listdir(path)}}
+        else:
+            return {'ok': False, 'error': 'Unknown operation'}
+        return {'ok': True}
+
+    def _run(self, command):
+        commands = [shlex.split(part) for part in command.split('&&')]
+        for args in commands:
+            handler = getattr(self, '_cmd_%s' % args[0], None)
+            if handler is None:
+                return 127, '', '%s: command not found\n' % args[0]
+            with self._lock:
+                exited, stdout, stderr = handler(args[1:])
+            if exited:
+                return exited, stdout, stderr
+        return exited, stdout, stderr
+
+    # shell commands
+
+    def _cmd_cd(self, args):
+        self._cwd = args[0]
+        return 0, '', ''
+
+    def _cmd_cat(self, args):
+        path = args[0] if args[0].startswith('/') else os.path.join(getattr(self, '_cwd', '/'), args[0])
+        try:
+            with open(self.local_path(path)) as fh:
+                return 0, fh.read(), ''
+        except IOError:
+            return 1, '', 'cat: %s: No such file or directory\n' % path
+
+    def _cmd_test(self, args):
+        path = args[-1]
+        if path.startswith('$(echo '):
+            path = path[len('$(echo '):-1]
+        return (0 if os.path.exists(self.local_path(path)) else 1), '', ''
+
+    def _cmd_mkdir(self, args):
+        os.makedirs(self.local_path(args[-1]), exist_ok=True)
+        return 0, '', ''
+
+    def _cmd_rm(self, args):
+        self._execute({'op': 'remove', 'path': args[-1]})
+        return 0, '', ''
+
+    def _cmd_find(self, args):
+        """find <folder> -maxdepth 1 -type f -printf '%f %T@\\n'"""
+        self._update_jobs()
+        path = self.local_path(args[0])
+        if not os.path.isdir(path):
+            return 1, '', 'find: %s: No such file or directory\n' % args[0]
+        lines = ['%s %s' % (name, os.path.getmtime(os.path.join(path, name))) for name in sorted(os.listdir(path))]
+        return 0, ''.join(line + '\n' for line in lines), ''
+
+    # SLURM commands
+
+    def _cmd_sbatch(self, args):
+        held = '-H' in args
+        depends = []
+        if '-d' in args:
+            depends = args[args.index('-d') + 1].split(':')[1:]
+        script_path = args[-1]
+        try:
+            with open(self.local_path(script_path)) as fh:
+                script = fh.read()
+        except IOError:
+            return 1, '', 'sbatch: error: Unable to open file %s\n' % script_path
+        directives = self._parse_script(script)
+        spool = SENTINEL_LINE.search(script)
+        job_id = str(self._next_job_id)
+        self._next_job_id += 1
+        env = dict(item.split('=', 1) for item in directives.get('--export', '').split(',') if '=' in item)
+        # AraGeno-<parse|identify|identify-batch|crosses>-<name>
+        kind = directives.get('-J', '').split('-')[1]
+        if directives.get('-J', '').startswith('AraGeno-identify-batch-'):
+            kind = 'batch'
+        now = self.clock()
+        jobs = []
+        if '--array' in directives:
+            first, last = [int(value) for value in directives['--array'].split('-')]
+            index = self._read_index(env['INDEX_FILE'])
+            for task_id in range(first, last + 1):
+                task_job_id = '%s_%s' % (job_id, task_id)
+                jobs.append(self._create_job(task_job_id, kind, env, directives.get('-D'), now, depends,
+                                             held, index.get(str(task_id))))
+        else:
+            jobs.append(self._create_job(job_id, kind, env, directives.get('-D'), now, depends, held))
+        for job in jobs:
+            job.spool = spool.group(1) if spool else None
+            self.jobs[job.job_id] = job
+        return 0, 'Submitted batch job %s\n' % job_id, ''
+
+    def _cmd_scontrol(self, args):
+        if args[0] != 'release':
+            return 1, '', 'scontrol: unsupported command %s\n' % args[0]
+        now = self.clock()
+        for job_id in args[1].split(','):
+            for job in self._find_jobs(job_id):
+                if job.held:
+                    job.held = False
+                    job.released = now
+        return 0, '', ''
+
+    def _cmd_squeue(self, args):
+        job_ids = args[args.index('-j') + 1].split(',')
+        now = self.clock()
+        lines = []
+        for job_id in job_ids:
+            for job in self._find_jobs(job_id):
+                self._update(job, now)
+                if job.state in (PENDING, RUNNING):
+                    lines.append('%s %s' % (job.job_id, job.state))
+        return 0, '\n'.join(lines) + ('\n' if lines else ''), ''
+
+    def _cmd_sacct(self, args):
+        job_ids = args[args.index('-j') + 1].split(',')
+        fields = args[args.index('-o') + 1].split(',')
+        now = self.clock()
+        lines = []
+        for job_id in job_ids:
+            for job in self._find_jobs(job_id):
+                self._update(job, now)
+                elapsed = 0 if job.started is None else (job.ended or now) - job.started
+                # the batch step of a job killed by a time limit or a node failure is cancelled
+                step_state = CANCELLED if job.state in ('TIMEOUT', 'NODE_FAIL') else job.state
+                max_rss = '%dK' % self._random.randint(100000, 4000000)
+                for step_id, state, rss in ((job.job_id, job.state, ''), (job.job_id + '.batch', step_state, max_rss)):
+                    values = {'jobid': step_id, 'state': state, 'elapsed': _format_duration(elapsed),
+                              'totalcpu': _format_duration(elapsed * 0.9), 'maxrss': rss}
+                    lines.append('|'.join(values[field] for field in fields) + '|')
+        return 0, '\n'.join(lines) + ('\n' if lines else ''), ''
+
+    # queue
+
+    def _parse_script(self, script):
+        directives = {}
+        for line in script.splitlines():
+            match = SBATCH_DIRECTIVE.match(line)
+            if match:
+                directives[match.group(1)] = match.group(2) or ''
+        return directives
+
+    def _read_index(self, index_file):
+        with open(self.local_path(index_file)) as fh:
+            return {line.split('\t')[0]: line.rstrip('\n').split('\t') for line in fh if line.strip()}
+
+    def _create_job(self, job_id, kind, env, workdir, now, depends, held, index_line=None):
+        outcome = COMPLETED
+        draw = self._random.random()
+        for state, rate in sorted(self.failure_rates.items()):
+            if draw < rate:
+                outcome = state
+                break
+            draw -= rate
+        return SimulatedJob(job_id, kind, env, workdir, now, self._random.uniform(*self.pending_time),
+                            self._random.uniform(*self.run_time), outcome, depends, held, index_line)
+
+    def _find_jobs(self, job_id):
+        if job_id in self.jobs:
+            return [self.jobs[job_id]]
+        # all tasks of an array
+        return [job for key, job in sorted(self.jobs.items()) if key.split('_')[0] == job_id]
+
+    def _update_jobs(self):
+        """Moves all jobs through the queue, e.g. to write the sentinels before the spool folder is listed"""
+        now = self.clock()
+        for job in list(self.jobs.values()):
+            self._update(job, now)
+
+    def _update(self, job, now):
+        """Moves the job through the queue up to the current time"""
+        if job.state in FINAL_STATES or job.held:
+            return
+        ready_at = job.submitted + job.pending_time
+        if job.released is not None:
+            ready_at = max(ready_at, job.released)
+        for dependency_id in job.depends:
+            dependency = self.jobs.get(dependency_id)
+            if dependency is None:
+                continue
+            self._update(dependency, now)
+            if dependency.state in FINAL_STATES and dependency.state != COMPLETED:
+                job.state = CANCELLED
+                return
+            if dependency.state != COMPLETED:
+                return
+            ready_at = max(ready_at, dependency.ended)
+        if now < ready_at:
+            return
+        if job.state == PENDING:
+            self._write_sentinel(job, 'started')
+        job.started = ready_at
+        job.state = RUNNING
+        if now < ready_at + job.run_time:
+            return
+        job.ended = ready_at + job.run_time
+        job.state = job.outcome
+        files = self._write_results(job) if job.state == COMPLETED else []
+        if job.state in SENTINEL_EXIT_CODES:
+            checksums = {}
+            for remote_path in files:
+                with open(self.local_path(remote_path), 'rb') as fh:
+                    checksums[remote_path] = hashlib.md5(fh.read()).hexdigest()
+            self._write_sentinel(job, 'done', json.dumps({'exit_code': SENTINEL_EXIT_CODES[job.state], 'started': int(job.started),
+                                                          'finished': int(job.ended), 'checksums': checksums}))
+
+    def _write_sentinel(self, job, suffix, content=''):
+        if job.spool is None:
+            return
+        path = self.local_path(os.path.join(job.spool, '%s.%s' % (job.job_id, suffix)))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as fh:
+            fh.write(content)
+
+    # synthetic results
+
+    def _write_json(self, workdir, filename, data):
+        remote_path = os.path.join(workdir, filename)
+        path = self.local_path(remote_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as fh:
+            json.dump(data, fh)
+        return remote_path
+
+    def _write_results(self, job):
+        """Writes the result files of a completed job and returns their remote paths"""
+        rnd = random.Random('%s-%s' % (self._seed, job.job_id))
+        if job.kind == 'parse':
+            workdir = job.workdir
+            snps = {chromosome: rnd.randint(1000, 50000) for chromosome in CHROMOSOMES}
+            stats_file = self._write_json(workdir, '%s.stats.json' % job.env['ID'], {
+                'snps': snps, 'num_of_snps': sum(snps.values()),
+                'percent_heterozygosity': rnd.random() * 0.1,
+                'interpretation': {'case': 0, 'text': 'Sufficient number of SNPs'}})
+            with open(self.local_path(os.path.join(workdir, '%s.npz' % job.env['ID'])), 'w') as fh:
+                fh.write('simulated')
+            return [stats_file]
+        if job.kind == 'identify':
+            return self._write_identify_results(rnd, job.index_line[4], job.index_line[2])
+        if job.kind == 'batch':
+            files = []
+            for index_line in self._read_index(job.env['INDEX_FILE']).values():
+                files.extend(self._write_identify_results(rnd, index_line[4], index_line[2]))
+            return files
+        if job.kind == 'crosses':
+            return [self._write_crosses_results(rnd, job.workdir, job.env['JOB_ID'])]
+        return []
+
+    def _write_identify_results(self, rnd, workdir, job_id):
+        accessions = rnd.sample(ACCESSIONS, len(ACCESSIONS))
+        scores = sorted((rnd.uniform(0.7, 1.0) for _ in accessions), reverse=True)
+        informative = rnd.randint(10000, 3000000)
+        matches = [[acc, score, informative, rnd.uniform(1, 5)] for acc, score in zip(accessions, scores)]
+        case = 3 if rnd.random() < self.crosses_rate else rnd.choice((1, 2))
+        matches_file = self._write_json(workdir, '%s.matches.json' % job_id, {
+            'matches': matches, 'overlap': [rnd.random(), informative],
+            'interpretation': {'case': case, 'text': 'Simulated result'}})
+        scores_file = os.path.join(workdir, '%s.scores.txt' % job_id)
+        with open(self.local_path(scores_file), 'w') as fh:
+            for acc, score, num_of_snps, likelihood in matches:
+                fh.write('%s\t%s\t%s\t%s\t%s\t%s\n' % (acc, int(score * num_of_snps), num_of_snps, score,
+                                                       likelihood, likelihood / matches[0][3]))
+        return [matches_file, scores_file]
+
+    def _write_crosses_results(self, rnd, workdir, job_id):
+        chr_bins = {chromosome: rnd.randint(50, 100) for chromosome in CHROMOSOMES}
+        num_of_windows = sum(chr_bins.values())
+        father, mother = rnd.sample(ACCESSIONS, 2)
+        return self._write_json(workdir, '%s_crosses.matches.json' % job_id, {
+            'matches': [[acc, rnd.randint(1, 40)] for acc in ACCESSIONS],
+            'interpretation': {'case': 6, 'text': 'Simulated F2'},
+            'parents': {'father': [father, 4], 'mother': [mother, 4]},
+            'overlap': [rnd.random(), rnd.randint(10000, 3000000)],
+            'genotype_windows': {'chr_bins': chr_bins, 'coordinates': {
+                'x': list(range(1, num_of_windows + 1)),
+                'y': [rnd.choice((father, mother, 'NA')) for _ in range(num_of_windows)]}}})
+
+
+class SimulatedConnection(object):
+    """Stand-in for a fabric Connection to the simulated cluster"""
+
+    def __init__(self, cluster):
+        self.cluster = cluster
+        self.is_connected = False
+        self.transport = None
+
+    def open(self):
+        self.cluster.count('connect')
+        self.is_connected = True
+
+    def close(self):
+        self.is_connected = False
+
+    def run(self, command, warn=False, hide=None, pty=False, timeout=None, **kwargs):
+        exited, stdout, stderr = self.cluster.run(command)
+        result = Result(stdout=stdout, stderr=stderr, command=command, exited=exited, pty=pty)
+        if exited and not warn:
+            raise UnexpectedExit(result)
+        return result
+
+    def put(self, local, remote):
+        return self.cluster.put(local, remote)
+
+    def get(self, remote, local):
+        return self.cluster.get(remote, local)
+
+
+class SimulatedAgentConnection(SimulatedConnection):
+    """Connection to the simulated cluster with a running agent"""
+
+    def call(self, commands, stop_on_error=False):
+        return self.cluster.call(commands, stop_on_error)
+
+
+def _format_duration(seconds):
+    seconds = int(seconds)
+    return '%02d:%02d:%02d' % (seconds // 3600, seconds % 3600 // 60, seconds % 60)
@@ -0,0 +1,66 @@
+"""
+Runs snpmatch inbred for several samples against one dataset in a single process.
+The dataset files are only loaded once and shared between the samples.
+A sample that fails does not fail the batch: the driver writes a <identify job id>.failed marker
+into the working directory of the sample and exits with 0, so that the status of every identify job
+is decided by its own files.
+Runs on the HPC with the python of the snpmatch module (python 2.7)
+
+Usage: identify_batch.py INDEX_FILE HDF5_FILE HDF5_ACC_FILE
+"""
+from __future__ import print_function
+import os
+import sys
+import traceback
+from pkg_resources import load_entry_point
+
+
+def cache_datasets():
+    """Replaces the dataset loader of snpmatch with one that returns the already loaded dataset"""
+    try:
+        from snpmatch.core import snp_genotype
+    except ImportError:
+        print('Dataset loader not found. Loading the dataset for every sample', file=sys.stderr)
+        return
+    load_dataset = snp_genotype.Genotype
+    datasets = {}
+
+    def cached_dataset(*args, **kwargs):
+        key = (args, tuple(sorted(kwargs.items())))
+        if key not in datasets:
+            datasets[key] = load_dataset(*args, **kwargs)
+        return datasets[key]
+    snp_genotype.Genotype = cached_dataset
+
+
+def write_failure_marker(job_id, reason):
+    with open('%s.failed' % job_id, 'w') as fh:
+        fh.write(reason)
+
+
+def main(index_file, hdf5_file, hdf5_acc_file):
+    cache_datasets()
+    snpmatch = load_entry_point('SNPmatch', 'console_scripts', 'snpmatch')
+    failed = []
+    with open(index_file) as fh:
+        samples = [line.split() for line in fh if line.strip()]
+    for _, genotype_id, job_id, _, workdir in samples:
+        os.chdir(workdir)
+        sys.argv = ['snpmatch', 'inbred', '-v', '-i', '%s.npz' % genotype_id, '-o', job_id,
+                    '-d', hdf5_file, '-e', hdf5_acc_file]
+        try:
+            snpmatch()
+        except SystemExit as err:
+            if err.code:
+                write_failure_marker(job_id, 'snpmatch exited with %s\n' % err.code)
+                failed.append(job_id)
+        except Exception:
+            traceback.print_exc()
+            write_failure_marker(job_id, traceback.format_exc())
+            failed.append(job_id)
+    if failed:
+        print('Failed identify jobs: %s' % ','.join(failed), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:4])
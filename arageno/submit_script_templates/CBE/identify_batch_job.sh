@@ -0,0 +1,17 @@
+#!/bin/bash
+#SBATCH --ntasks=1
+#SBATCH --mem=%(memory)s
+#SBATCH -J AraGeno-identify-batch-%(name)s
+#SBATCH --export=INDEX_FILE=%(index_file)s,DATASET=%(dataset)s
+#SBATCH --time=%(walltime)s
+#SBATCH -D %(workdir)s
+
+set -e
+
+%(sentinel)s
+
+module load snpmatch/3.0.1-foss-2018b-python-2.7.15
+export NUMEXPR_MAX_THREADS=272
+DATASET_FOLDER=%(dataset_folder)s/$DATASET
+# scores all samples of the index file (same format as the job arrays) in one process
+python %(driver)s $INDEX_FILE $DATASET_FOLDER/$DATASET.hdf5 $DATASET_FOLDER/$DATASET.acc.hdf5
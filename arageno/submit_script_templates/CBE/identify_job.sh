@@ -1,15 +1,22 @@
 #!/bin/bash
 #SBATCH --ntasks=1
 #SBATCH --mem=%(memory)s
-#SBATCH -J AraGeno-identify-%(id)s
-#SBATCH --export=ID=%(id)s,JOB_ID=%(identify_job_id)s,DATASET=%(dataset)s
+#SBATCH -J AraGeno-identify-%(name)s
+#SBATCH --array=0-%(last_task_id)s
+#SBATCH --export=INDEX_FILE=%(index_file)s
 #SBATCH --time=%(walltime)s
 #SBATCH -D %(workdir)s
 
 set -e
 
+%(sentinel)s
+
+# one line per array task: task id, submission id, identify job id, dataset, working directory
+read TASK_ID ID JOB_ID DATASET WORKDIR < <(awk -v task=$SLURM_ARRAY_TASK_ID '$1 == task' $INDEX_FILE)
+cd $WORKDIR
+
 module load snpmatch/3.0.1-foss-2018b-python-2.7.15
 export NUMEXPR_MAX_THREADS=272
-DATASET_FOLDER=/scratch-cbe/shared/matrices_for_snpmatch/$DATASET
+DATASET_FOLDER=%(dataset_folder)s/$DATASET
 snpmatch inbred -v -i $ID.npz -o $JOB_ID -d $DATASET_FOLDER/$DATASET.hdf5 -e $DATASET_FOLDER/$DATASET.acc.hdf5
 #sleep 5 && echo 'test' > $JOB_ID.txt && echo '{"matches": [{"2278": [0.9839400114088569, 7884, 0.9412607449856734], "6909": [0.99421713749268104, 7982, 0.9529608404966571]}], "interpretation": {"case": 2, "text": "An ambiguous sample: Accessions in top hits can be really close"}, "overlap": [0.7530342533489166, 8376]}' > $JOB_ID.txt.matches.json
@@ -7,6 +7,8 @@
 #SBATCH -D %(workdir)s
 set -e
 
+%(sentinel)s
+
 module load snpmatch/3.0.1-foss-2018b-python-2.7.15
 
 export NUMEXPR_MAX_THREADS=272
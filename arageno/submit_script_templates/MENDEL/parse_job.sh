@@ -3,14 +3,16 @@
 #PBS -P %(project)s
 #PBS -N parse_genotype
 #PBS -A %(id)s
-#PBS -v INPUT_FILE=%(input_file)s,ID=%(id)s,TMPDIR=$WORK/GENOTYPER/$ID
+#PBS -v INPUT_FILE=%(input_file)s,ID=%(id)s,TMPDIR=%(workdir)s
 #PBS -l walltime=%(walltime)s
 
 set -e
 
+%(sentinel)s
+
 module load SNPmatch/2.0.0-foss-2018a-Python-2.7.14 
 
-cd "$WORK/GENOTYPER/$ID"
+cd %(workdir)s
 
 snpmatch parser -i ${INPUT_FILE} -o ${ID}
 
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+"""
+Agent on the HPC login node that executes batches of commands for hpc.py.
+It is started over SSH (hpc.AgentConnection) and runs as long as the SSH channel is open.
+Reads one JSON request per line from stdin and writes one JSON response per line to stdout:
+
+    {"id": 1, "stop_on_error": false, "commands": [{"op": "run", "cmd": "squeue ..."}, {"op": "read", "path": "..."}]}
+    {"id": 1, "results": [{"ok": true, "exited": 0, "stdout": "...", "stderr": ""}, {"ok": true, "value": "..."}]}
+
+Operations: ping, run (shell command), exists, mkdir, write (text content), read, remove,
+list (modification time of the files of a folder).
+With stop_on_error the commands after the first failing one are skipped.
+Runs with the python of the login node (python 2.7 or 3)
+"""
+from __future__ import print_function
+import json
+import os
+import shutil
+import subprocess
+import sys
+import traceback
+
+VERSION = 1
+
+
+def _path(path):
+    return os.path.expandvars(os.path.expanduser(path))
+
+
+def _decode(data):
+    if isinstance(data, bytes):
+        return data.decode('utf-8', 'replace')
+    return data
+
+
+def op_ping():
+    return {'value': VERSION}
+
+
+def op_run(cmd):
+    process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                               stdin=open(os.devnull))
+    stdout, stderr = process.communicate()
+    return {'ok': process.returncode == 0, 'exited': process.returncode,
+            'stdout': _decode(stdout), 'stderr': _decode(stderr)}
+
+
+def op_exists(path):
+    return {'value': os.path.exists(_path(path))}
+
+
+def op_mkdir(path):
+    path = _path(path)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    return {}
+
+
+def op_write(path, content):
+    """Writes a text file atomically"""
+    path = _path(path)
+    tmp_path = '%s.%s.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wb') as fh:
+        fh.write(content.encode('utf-8'))
+    os.rename(tmp_path, path)
+    return {}
+
+
+def op_read(path):
+    with open(_path(path), 'rb') as fh:
+        return {'value': _decode(fh.read())}
+
+
+def op_list(path):
+    """Returns the modification time of the files of a folder (none if the folder does not exist)"""
+    path = _path(path)
+    files = {}
+    if os.path.isdir(path):
+        for name in os.listdir(path):
+            try:
+                files[name] = os.path.getmtime(os.path.join(path, name))
+            except OSError:
+                # removed in the meantime
+                pass
+    return {'value': files}
+
+
+def op_remove(path):
+    path = _path(path)
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.lexists(path):
+        os.remove(path)
+    return {}
+
+
+OPERATIONS = {'ping': op_ping, 'run': op_run, 'exists': op_exists, 'mkdir': op_mkdir,
+              'write': op_write, 'read': op_read, 'remove': op_remove, 'list': op_list}
+
+
+def execute(command):
+    command = dict(command)
+    operation = OPERATIONS.get(command.pop('op', None))
+    if operation is None:
+        return {'ok': False, 'error': 'Unknown operation'}
+    try:
+        result = operation(**command)
+    except Exception as err:
+        return {'ok': False, 'error': '%s: %s' % (type(err).__name__, err)}
+    result.setdefault('ok', True)
+    return result
+
+
+def handle(request):
+    results = []
+    for command in request.get('commands', []):
+        if request.get('stop_on_error') and results and not results[-1]['ok']:
+            results.append({'ok': False, 'error': 'Skipped'})
+            continue
+        results.append(execute(command))
+    return {'id': request.get('id'), 'results': results}
+
+
+def main():
+    for line in iter(sys.stdin.readline, ''):
+        if not line.strip():
+            continue
+        try:
+            response = handle(json.loads(line))
+        except Exception:
+            response = {'error': traceback.format_exc()}
+        sys.stdout.write(json.dumps(response) + '\n')
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""
+Database backed task queue for work that should not run inside a request
+"""
+import json
+import os
+import socket
+import logging
+import traceback
+from datetime import timedelta
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+from .models import Task, QUEUED, PROCESSING, FINISHED, ERROR, PIPELINE_TASK
+
+logger = logging.getLogger(__name__)
+
+TASKS = {}
+
+
+def task(func):
+    """Registers a function so that it can be enqueued by its name"""
+    TASKS[func.__name__] = func
+    return func
+
+
+def enqueue(name, genotype=None, max_attempts=None, run_after=None, **kwargs):
+    """
+    Enqueues a registered task. The worker picks it up once the transaction is committed
+    and not before run_after
+    """
+    if name not in TASKS:
+        raise ValueError(f'Task {name} not registered')
+    return Task.objects.create(name=name, genotype=genotype, arguments=json.dumps(kwargs),
+                               max_attempts=max_attempts or settings.TASK_MAX_ATTEMPTS,
+                               run_after=run_after or timezone.now())
+
+
+def is_pending(name, **kwargs):
+    """Returns if a task with the same arguments is queued or running"""
+    return Task.objects.filter(name=name, arguments=json.dumps(kwargs), status__in=[QUEUED, PROCESSING]).exists()
+
+
+def get_worker_name():
+    return '%s:%s' % (socket.gethostname(), os.getpid())
+
+
+def get_backoff(attempts):
+    """Returns the delay before the next attempt (exponential backoff)"""
+    return timedelta(seconds=min(settings.TASK_RETRY_DELAY * 2 ** (attempts - 1), settings.TASK_MAX_RETRY_DELAY))
+
+
+def claim_task(worker):
+    """Claims the next due task. Concurrent workers compete through a conditional update"""
+    for task in Task.objects.runnable().order_by('run_after')[:10]:
+        claimed = Task.objects.filter(pk=task.pk, status=QUEUED).update(
+            status=PROCESSING, locked_by=worker, locked_at=timezone.now(), attempts=F('attempts') + 1)
+        if claimed:
+            task.refresh_from_db()
+            return task
+    return None
+
+
+def requeue_stale_tasks():
+    """Requeues the tasks of workers that died while processing them"""
+    stale_date = timezone.now() - timedelta(seconds=settings.TASK_LOCK_TIMEOUT)
+    return Task.objects.filter(status=PROCESSING, locked_at__lt=stale_date).update(
+        status=QUEUED, locked_by=None, locked_at=None)
+
+
+def run_task(task):
+    """Runs a claimed task and schedules a retry with backoff if it fails"""
+    logger.info('Running %s', task)
+    try:
+        func = TASKS[task.name]
+        func(**json.loads(task.arguments))
+    except Exception as err:
+        logger.exception('%s failed: %s', task, repr(err))
+        task.last_error = traceback.format_exc()
+        if task.attempts >= task.max_attempts:
+            task.status = ERROR
+            # a failed auxiliary task does not fail the submission
+            if task.genotype and task.name == PIPELINE_TASK:
+                task.genotype.status = ERROR
+                task.genotype.save(update_fields=['status', 'updated'])
+        else:
+            task.status = QUEUED
+            task.run_after = timezone.now() + get_backoff(task.attempts)
+    else:
+        task.status = FINISHED
+    task.locked_by = None
+    task.locked_at = None
+    task.save()
+    return task
@@ -1,3 +1,1303 @@
-from django.test import TestCase
+import hashlib
+import importlib.util
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+from datetime import timedelta
+from io import BytesIO
+from unittest import mock
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from invoke.exceptions import UnexpectedExit
+from invoke.runners import Result
+from . import accessions, executors, hpc, local_jobs, models, plotting, scores, services, tasks
+from .models import (GenotypeSubmission, IdentifyJob, CrossesJob, Dataset, JobAccounting, Setting, Task, FINISHED, PROCESSING,
+                     QUEUED, ERROR, LOCAL, PIPELINE_TASK)
 
-# Create your tests here.
+IDENTIFY_STATISTICS = {'matches': [['9970', 0.88, 1480686, 0.45], ['9399', 0.87, 2758007, 0.85]],
+                       'interpretation': {'case': 3, 'text': 'An ambiguous sample'},
+                       'overlap': [0.73, 3224626]}
+CROSSES_STATISTICS = {'matches': [['9399', 35], ['6095', 30]],
+                      'interpretation': {'case': 6, 'text': 'Sample may be a F2!'},
+                      'genotype_windows': {'chr_bins': {'Chr1': 2}, 'coordinates': {'x': [1, 2], 'y': ['NA', '9399']}}}
+
+
+def create_submission(num_of_datasets):
+    genotype = GenotypeSubmission.objects.create(
+        firstname='Test', lastname='User', email='test@example.com', genotype_file='uploaded_genotypes/test/test.vcf',
+        status=FINISHED, statistics=json.dumps({'snps': {'Chr1': 10}, 'num_of_snps': 10, 'interpretation': {'case': 0, 'text': 'Ok'}}))
+    for ix in range(num_of_datasets):
+        dataset = Dataset.objects.create(
+            name='dataset%s' % ix, description='', num_of_samples=10, num_of_markers=100,
+            runtime_identify='[1, 0]', memory_identify='[1, 0]', runtime_crosses='[1, 0]', memory_crosses='[1, 0]')
+        job = IdentifyJob.objects.create(genotype=genotype, dataset=dataset, status=FINISHED,
+                                         statistics=json.dumps(IDENTIFY_STATISTICS))
+        CrossesJob.objects.create(identifyjob=job, status=FINISHED, statistics=json.dumps(CROSSES_STATISTICS))
+    return genotype
+
+
+@override_settings(HPC_BACKGROUND_POLLING=True)
+class SubmissionQueryBudgetTest(TestCase):
+    """The submission detail must be served with a constant number of queries"""
+
+    def _count_queries(self, genotype):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse('genotypesubmission-detail', args=[genotype.id]),
+                                       HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, 200)
+        return len(ctx)
+
+    def test_detail_query_budget(self):
+        genotype = create_submission(1)
+        with self.assertNumQueries(4):
+            self.client.get(reverse('genotypesubmission-detail', args=[genotype.id]), HTTP_ACCEPT='application/json')
+
+    def test_detail_queries_independent_of_datasets(self):
+        self.assertEqual(self._count_queries(create_submission(1)), self._count_queries(create_submission(4)))
+
+
+class FakeCluster(object):
+    """Answers the agent commands of an HPCExecutor with canned scheduler outputs and files"""
+
+    def __init__(self, outputs=None, files=None, spool=None):
+        self.outputs = outputs or {}
+        self.files = files or {}
+        self.spool = spool or {}
+        self.commands = []
+
+    def call(self, commands, stop_on_error=False):
+        self.commands.extend(commands)
+        results = []
+        for command in commands:
+            if command['op'] == 'run':
+                program = command['cmd'].split()[0]
+                results.append({'ok': True, 'exited': 0, 'stdout': self.outputs.get(program, ''), 'stderr': ''})
+            elif command['op'] == 'list':
+                results.append({'ok': True, 'value': self.spool})
+            elif command['op'] == 'read' and command['path'] in self.files:
+                results.append({'ok': True, 'value': self.files[command['path']]})
+            elif command['op'] == 'read':
+                results.append({'ok': False, 'error': 'No such file'})
+            elif command['op'] == 'exists':
+                results.append({'ok': True, 'value': command['path'] in self.files})
+            else:
+                results.append({'ok': True})
+        return results
+
+    def ran(self, program):
+        return any(command['op'] == 'run' and command['cmd'].startswith(program) for command in self.commands)
+
+
+QSTAT_OUTPUT = """Job Id: 101.mendel
+    Job_Name = identify_job.sh
+    job_state = F
+    Exit_status = -29
+    resources_used.walltime = 01:00:05
+
+Job Id: 102.mendel
+    job_state = F
+    Exit_status = -27
+
+Job Id: 103.mendel
+    job_state = R
+
+Job Id: 104.mendel
+    job_state = F
+    Exit_status = 0
+
+Job Id: 105.mendel
+    job_state = F
+"""
+
+SQUEUE_OUTPUT = "200_1 RUNNING\n200_2 PENDING\n"
+
+SACCT_OUTPUT = """201|CANCELLED by 0|
+201.batch|FAILED|
+202|TIMEOUT|
+202.batch|CANCELLED|
+203|COMPLETED|
+203.batch|COMPLETED|
+"""
+
+
+@override_settings(HPC_SENTINELS=False)
+class SchedulerStatusTest(SimpleTestCase):
+    """The job states are parsed from canned qstat, squeue and sacct outputs"""
+
+    def test_pbs_exit_status(self):
+        cluster = FakeCluster({'qstat': QSTAT_OUTPUT})
+        statuses = hpc.SCHEDULERS['pbs'].get_jobs_status(cluster, ['101', '102', '103', '104', '105', '106'])
+        self.assertEqual(statuses, {'101': hpc.RESUBMIT_TIMEOUT, '102': hpc.RESUBMIT_OUT_OF_MEMORY, '103': PROCESSING,
+                                    '104': FINISHED, '105': ERROR, '106': ERROR})
+
+    def test_slurm_batch_step_precedence(self):
+        cluster = FakeCluster({'squeue': SQUEUE_OUTPUT, 'sacct': SACCT_OUTPUT})
+        statuses = hpc.SCHEDULERS['slurm'].get_jobs_status(cluster, ['200_1', '200_2', '201', '202', '203', '204'])
+        # the failed batch step wins over the cancelled allocation, but not over its time limit.
+        # Jobs that are neither queued nor accounted are unknown
+        self.assertEqual(statuses, {'200_1': PROCESSING, '200_2': QUEUED, '201': ERROR, '202': hpc.RESUBMIT_TIMEOUT,
+                                    '203': FINISHED})
+        # sacct is only asked for the jobs that are not queued anymore
+        self.assertEqual([command['cmd'] for command in cluster.commands][1], 'sacct -j 201,202,203,204 -o jobid,state -pn')
+
+    def test_slurm_skips_sacct_for_queued_jobs(self):
+        cluster = FakeCluster({'squeue': SQUEUE_OUTPUT})
+        statuses = hpc.SCHEDULERS['slurm'].get_jobs_status(cluster, ['200_1', '200_2'])
+        self.assertEqual(statuses, {'200_1': PROCESSING, '200_2': QUEUED})
+        self.assertEqual(len(cluster.commands), 1)
+
+
+@override_settings(HPC_SENTINELS=True, HPC_SCHEDULER_CHECK_INTERVAL=300, HPC_SENTINEL_MAX_AGE=7)
+class SentinelStatusTest(SimpleTestCase):
+    """Finished jobs are detected with the sentinels and the scheduler is only asked for the failed ones"""
+    result_path = '/work/G1/300.matches.json'
+
+    def setUp(self):
+        now = time.time()
+        self.executor = hpc.HPCExecutor('test', 'login', 'slurm', 'CBE', '/work', '/datasets')
+        self.cluster = FakeCluster(
+            outputs={'sacct': '301|OUT_OF_MEMORY|\n301.batch|OUT_OF_MEMORY|\n'},
+            files={'/work/spool/300.done': json.dumps({'exit_code': 0, 'started': now - 60, 'finished': now, 'checksums': {
+                       self.result_path: hashlib.md5(b'{"matches": []}').hexdigest()}}),
+                   '/work/spool/301.done': json.dumps({'exit_code': 137, 'started': now - 60, 'finished': now, 'checksums': {}}),
+                   self.result_path: '{"matches": []}'},
+            spool={'300.done': now, '301.done': now, '302.started': now, '999.done': now - 8 * 24 * 3600})
+        self.executor.call = self.cluster.call
+        # the jobs without sentinel were checked recently
+        self.executor._scheduler_checks = {'302': now}
+
+    def test_sentinel_statuses(self):
+        statuses = self.executor.get_jobs_status(['test:300', 'test:301', 'test:302'])
+        self.assertEqual(statuses, {'test:300': FINISHED, 'test:301': hpc.RESUBMIT_OUT_OF_MEMORY, 'test:302': PROCESSING})
+        self.assertFalse(self.cluster.ran('squeue -r -j 300'))
+        self.assertIn({'op': 'remove', 'path': '/work/spool/999.done'}, self.cluster.commands)
+
+    def test_checksum_mismatch(self):
+        self.executor.get_jobs_status(['test:300'])
+        self.assertEqual(self.executor._read_files([self.result_path], '300'), ['{"matches": []}'])
+        self.cluster.files[self.result_path] = '{"matches": [["9970", 1.0]]}'
+        with self.assertRaises(hpc.HPCCommandError):
+            self.executor._read_files([self.result_path], '300')
+
+
+@override_settings(HPC_BACKGROUND_POLLING=True, STATUS_LONGPOLL_TIMEOUT=0, STATUS_LONGPOLL_INTERVAL=0)
+class StatusLongPollTest(TestCase):
+    """The status long-poll answers 304 when the state did not change within the timeout"""
+
+    def _get_status(self, genotype, etag=None):
+        headers = {'HTTP_IF_NONE_MATCH': etag} if etag else {}
+        return self.client.get(reverse('genotypesubmission-status', args=[genotype.id]), HTTP_ACCEPT='application/json',
+                               **headers)
+
+    def test_not_modified_on_timeout(self):
+        genotype = create_submission(1)
+        etag = self._get_status(genotype)['ETag']
+        response = self._get_status(genotype, etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertFalse(response.has_header('Retry-After'))
+
+    def test_changed_state(self):
+        genotype = create_submission(1)
+        etag = self._get_status(genotype)['ETag']
+        IdentifyJob.objects.filter(genotype=genotype).update(status=QUEUED)
+        response = self._get_status(genotype, etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.json()['jobs'][0]['status'], QUEUED)
+
+    @override_settings(STATUS_LONGPOLL_TIMEOUT=60, STATUS_LONGPOLL_MAX_WAITERS=0, STATUS_LONGPOLL_RETRY=3)
+    def test_answered_at_once_without_free_slot(self):
+        genotype = create_submission(1)
+        etag = self._get_status(genotype)['ETag']
+        started = time.time()
+        response = self._get_status(genotype, etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['Retry-After'], '3')
+        self.assertLess(time.time() - started, 5)
+
+
+ACCESSIONS = [{'pk': 9399, 'name': 'Bs-1', 'country': 'CHE'}, {'pk': 6909, 'name': 'Col-0', 'country': 'USA'}]
+
+
+class AccessionSnapshotTest(SimpleTestCase):
+    """The accession snapshot is switched between versions with a symlink and never fetched on a request"""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.folder = os.path.join(self.tmp_dir, 'accessions')
+        accessions._last_check = 0
+
+    def _get_accession_map(self):
+        with override_settings(ACCESSION_MAP_SNAPSHOT=self.folder), \
+                mock.patch.object(accessions, '_refresh_in_background') as refresh:
+            return accessions.get_accession_map(), refresh.called
+
+    def test_lookup(self):
+        accessions.write_snapshot(ACCESSIONS, self.folder, {})
+        accession_map, refreshed = self._get_accession_map()
+        self.assertFalse(refreshed)
+        self.assertEqual(len(accession_map), 2)
+        self.assertEqual(accession_map.get('6909')['name'], 'Col-0')
+        self.assertEqual(accession_map[9399]['url'], 'https://arapheno.1001genomes.org/accession/9399')
+        self.assertNotIn(1, accession_map)
+        self.assertIsNone(accession_map.get('abc'))
+
+    def test_switch_versions(self):
+        accessions.write_snapshot(ACCESSIONS, self.folder, {})
+        first_version = os.path.realpath(self.folder)
+        first_map = self._get_accession_map()[0]
+        for num in range(3):
+            accessions.write_snapshot(ACCESSIONS + [{'pk': 100 + num, 'name': 'new'}], self.folder, {})
+        self.assertTrue(os.path.islink(self.folder))
+        # the current and the previous version are kept
+        self.assertEqual(len(os.listdir(self.folder + '.versions')), 2)
+        self.assertFalse(os.path.exists(first_version))
+        accession_map = self._get_accession_map()[0]
+        self.assertEqual(len(accession_map), 3)
+        self.assertNotEqual(accession_map.fingerprint, first_map.fingerprint)
+        # maps opened before the switch keep reading their own version
+        self.assertEqual(first_map.get(6909)['name'], 'Col-0')
+
+    def test_replace_legacy_folder(self):
+        os.makedirs(self.folder)
+        accessions.write_snapshot(ACCESSIONS, self.folder, {})
+        self.assertTrue(os.path.islink(self.folder))
+        self.assertEqual(len(self._get_accession_map()[0]), 2)
+
+    def test_missing_snapshot(self):
+        with mock.patch.object(accessions, 'refresh_accession_map') as refresh_accession_map:
+            accession_map, refreshed = self._get_accession_map()
+        self.assertFalse(refresh_accession_map.called)
+        self.assertTrue(refreshed)
+        self.assertEqual(len(accession_map), 0)
+        self.assertIsNone(accession_map.fingerprint)
+
+
+SACCT_ACCOUNTING = {'state': 'COMPLETED', 'elapsed': 600, 'total_cpu': 590.5, 'max_rss': 2048}
+
+
+class JobAccountingTest(TestCase):
+    """The accounting of the ended HPC jobs is collected once and missing jobs are not asked for on every cycle"""
+
+    def setUp(self):
+        services._accounting_retries.clear()
+        self.addCleanup(services._accounting_retries.clear)
+        genotype = create_submission(3)
+        GenotypeSubmission.objects.filter(pk=genotype.pk).update(executor='test', jobid=10)
+        jobs = list(genotype.identifyjob_set.order_by('pk'))
+        # the first two samples were scored by one batch job
+        IdentifyJob.objects.filter(pk__in=[jobs[0].pk, jobs[1].pk]).update(executor='test', jobid=20)
+        IdentifyJob.objects.filter(pk=jobs[2].pk).update(executor='test', jobid=21)
+        # failed jobs have no finish date
+        CrossesJob.objects.filter(identifyjob=jobs[0]).update(executor='test', jobid=30, status=ERROR, finished=None)
+        executor = mock.Mock()
+        executor.name = 'test'
+        patcher = mock.patch.object(services, 'get_hpc_executors', return_value=[executor])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _collect(self, reported):
+        with mock.patch.object(services, 'get_jobs_accounting',
+                               side_effect=lambda job_ids: {job_id: SACCT_ACCOUNTING for job_id in job_ids
+                                                            if job_id in reported}) as get_jobs_accounting:
+            num_of_collected = services.collect_job_accounting()
+        return num_of_collected, [sorted(call[0][0]) for call in get_jobs_accounting.call_args_list]
+
+    def test_collect(self):
+        num_of_collected, calls = self._collect({'test:10', 'test:30'})
+        # the batch job is skipped, the failed crosses job is collected
+        self.assertEqual(calls, [['test:10', 'test:21', 'test:30']])
+        self.assertEqual(num_of_collected, 2)
+        self.assertEqual(dict(JobAccounting.objects.values_list('jobid', 'kind')),
+                         {'test:10': JobAccounting.PARSE, 'test:30': JobAccounting.CROSSES})
+
+    @override_settings(HPC_ACCOUNTING_RETRY_INTERVAL=900)
+    def test_retry_missing_jobs(self):
+        self._collect({'test:10', 'test:30'})
+        # the job sacct did not report is not asked for again until the retry interval passed
+        self.assertEqual(self._collect({'test:21'}), (0, []))
+        services._accounting_retries['test:21'] = 0
+        self.assertEqual(self._collect({'test:21'}), (1, [['test:21']]))
+        self.assertEqual(services._accounting_retries, {})
+
+
+class CalibrationTest(TestCase):
+    """The polynominals are refitted from the accounting of the successful jobs"""
+
+    def _create_accounting(self, dataset, num_of_jobs):
+        # elapsed = 3 * markers + 10 plus a residual of 0 to 9 seconds
+        JobAccounting.objects.bulk_create([
+            JobAccounting(jobid='test:%s' % ix, kind=JobAccounting.IDENTIFY, dataset=dataset, state='COMPLETED',
+                          num_of_markers=100 * (ix + 1), elapsed=300 * (ix + 1) + 10 + ix % 10, max_rss=1000)
+            for ix in range(num_of_jobs)])
+
+    def test_fit_polynominal(self):
+        x = [100 * (ix + 1) for ix in range(100)]
+        y = [3 * markers + 10 + ix % 10 for ix, markers in enumerate(x)]
+        poly = services.fit_polynominal(x, y, 1, 0.9)
+        self.assertAlmostEqual(poly.coeffs[0], 3, places=3)
+        self.assertGreaterEqual(sum(value <= poly(markers) + 1e-6 for markers, value in zip(x, y)), 90)
+        self.assertLess(sum(value < poly(markers) - 1e-6 for markers, value in zip(x, y)), 100)
+        # the degree is limited by the number of distinct inputs
+        self.assertEqual(services.fit_polynominal([10, 10, 20], [1, 2, 3], 3, 0.9).order, 1)
+
+    def test_calibrate_dataset(self):
+        dataset = create_submission(1).identifyjob_set.get().dataset
+        self._create_accounting(dataset, 20)
+        since = timezone.now() - timedelta(days=1)
+        changes = services.calibrate_resources(0.95, 10, since, dry_run=True)
+        self.assertEqual([(name, samples) for name, _, _, samples in changes],
+                         [('dataset0.runtime_identify', 20), ('dataset0.memory_identify', 20)])
+        self.assertEqual(Dataset.objects.get(pk=dataset.pk).runtime_identify, '[1, 0]')
+        services.calibrate_resources(0.95, 10, since)
+        slope, intercept = json.loads(Dataset.objects.get(pk=dataset.pk).runtime_identify)
+        self.assertAlmostEqual(slope, 3, places=2)
+        slope, intercept = json.loads(Dataset.objects.get(pk=dataset.pk).memory_identify)
+        self.assertAlmostEqual(slope, 0)
+        self.assertAlmostEqual(intercept, 1000)
+
+    def test_skip_undersampled(self):
+        dataset = create_submission(1).identifyjob_set.get().dataset
+        self._create_accounting(dataset, 5)
+        JobAccounting.objects.filter(jobid='test:0').update(state='TIMEOUT')
+        self.assertEqual(services.calibrate_resources(0.95, 5, timezone.now() - timedelta(days=1)), [])
+        self.assertEqual(Dataset.objects.get(pk=dataset.pk).runtime_identify, '[1, 0]')
+
+
+@override_settings(HPC_STATUS_TTL=0)
+class StatusPollerTest(TestCase):
+    """The poller refreshes all unfinished submissions with one status query and keeps SSH out of the requests"""
+
+    def setUp(self):
+        self.genotypes = [create_submission(1), create_submission(1)]
+        for ix, genotype in enumerate(self.genotypes):
+            genotype.identifyjob_set.update(status=QUEUED, jobid=100 + ix)
+        patcher = mock.patch.object(services, 'update_genotype_status')
+        self.update_genotype_status = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_poll_once(self):
+        with mock.patch.object(services, 'get_jobs_status', return_value={}) as get_jobs_status, \
+                mock.patch('arageno.management.commands.poll_hpc_jobs.collect_job_accounting') as collect_job_accounting:
+            call_command('poll_hpc_jobs', '--once')
+        self.assertEqual(get_jobs_status.call_count, 1)
+        self.assertEqual(sorted(get_jobs_status.call_args[0][0]),
+                         sorted(job.hpc_job_id for job in IdentifyJob.objects.filter(status=QUEUED)))
+        self.assertEqual(sorted(call[0][0].pk for call in self.update_genotype_status.call_args_list),
+                         sorted(genotype.pk for genotype in self.genotypes))
+        self.assertTrue(collect_job_accounting.called)
+        # the refresh locks are released
+        self.assertFalse(GenotypeSubmission.objects.filter(refresh_locked__isnull=False).exists())
+
+    def test_cluster_unavailable(self):
+        with mock.patch.object(services, 'get_jobs_status', side_effect=hpc.HPCUnavailableError('down')):
+            self.assertEqual(services.update_unfinished_submissions(), 0)
+        self.assertFalse(self.update_genotype_status.called)
+
+    def test_requests_do_not_refresh(self):
+        with override_settings(HPC_BACKGROUND_POLLING=True):
+            response = self.client.get(reverse('genotypesubmission-detail', args=[self.genotypes[0].id]),
+                                       HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(self.update_genotype_status.called)
+        with override_settings(HPC_BACKGROUND_POLLING=False):
+            self.client.get(reverse('genotypesubmission-detail', args=[self.genotypes[0].id]),
+                            HTTP_ACCEPT='application/json')
+        self.assertEqual(self.update_genotype_status.call_count, 1)
+
+
+class FakeConnection(object):
+    """SSH connection that counts how often it was opened"""
+    opened = 0
+
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.is_connected = False
+
+    def open(self):
+        if self.fail:
+            raise IOError('Connection refused')
+        FakeConnection.opened += 1
+        self.is_connected = True
+
+    def close(self):
+        self.is_connected = False
+
+    def run(self, cmd, **kwargs):
+        return cmd
+
+
+class ConnectionPoolTest(SimpleTestCase):
+    """The SSH connections are reused and an unreachable cluster is not called until the reset timeout passed"""
+
+    def setUp(self):
+        FakeConnection.opened = 0
+
+    def test_reuse_connections(self):
+        pool = hpc.ConnectionPool(FakeConnection, 2, checkout_timeout=0.1)
+        with pool.connection() as first:
+            with pool.connection() as second:
+                self.assertIsNot(first, second)
+                # all connections are checked out
+                with self.assertRaises(hpc.HPCUnavailableError):
+                    with pool.connection():
+                        pass
+        with pool.connection() as conn:
+            self.assertIn(conn, (first, second))
+        self.assertEqual(FakeConnection.opened, 2)
+        # stale connections are replaced
+        first.close()
+        second.close()
+        with pool.connection() as conn:
+            self.assertTrue(conn.is_connected)
+        self.assertEqual(FakeConnection.opened, 3)
+
+    def test_circuit_breaker(self):
+        breaker = hpc.CircuitBreaker(2, 60)
+        breaker.record_failure()
+        breaker.check()
+        breaker.record_failure()
+        self.assertTrue(breaker.is_open)
+        with self.assertRaises(hpc.HPCUnavailableError):
+            breaker.check()
+        # half-open after the reset timeout: a single trial call is let through
+        breaker._opened_at -= 60
+        self.assertTrue(breaker.is_available)
+        breaker.check()
+        with self.assertRaises(hpc.HPCUnavailableError):
+            breaker.check()
+        breaker.record_success()
+        self.assertFalse(breaker.is_open)
+        breaker.check()
+
+    @override_settings(HPC_CIRCUIT_BREAKER_THRESHOLD=2, HPC_CIRCUIT_BREAKER_RESET=60, HPC_POOL_SIZE=2)
+    def test_unreachable_cluster(self):
+        executor = hpc.HPCExecutor('test', 'login', 'slurm', 'CBE', '/work', '/datasets')
+        connections = []
+        executor.set_connection_factory(lambda: connections.append(FakeConnection(fail=True)) or connections[-1])
+        for _ in range(2):
+            with self.assertRaises(hpc.HPCUnavailableError):
+                executor.run('squeue')
+        self.assertFalse(executor.is_available)
+        with self.assertRaises(hpc.HPCUnavailableError):
+            executor.run('squeue')
+        # the open circuit does not try to connect
+        self.assertEqual(len(connections), 2)
+
+
+def failing_test_task(fail=True):
+    if fail:
+        raise ValueError('failed')
+
+
+@override_settings(TASK_RETRY_DELAY=30, TASK_MAX_RETRY_DELAY=100, TASK_LOCK_TIMEOUT=3600)
+class TaskQueueTest(TestCase):
+    """Failed tasks are retried with backoff until max_attempts and stale tasks are requeued"""
+
+    def setUp(self):
+        patcher = mock.patch.dict(tasks.TASKS, {'failing_test_task': failing_test_task,
+                                                PIPELINE_TASK: failing_test_task})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_unknown_task(self):
+        with self.assertRaises(ValueError):
+            tasks.enqueue('unknown_task')
+
+    def test_run(self):
+        task = tasks.enqueue('failing_test_task', fail=False)
+        self.assertTrue(tasks.is_pending('failing_test_task', fail=False))
+        self.assertFalse(tasks.is_pending('failing_test_task', fail=True))
+        task = tasks.run_task(tasks.claim_task('worker'))
+        self.assertEqual((task.status, task.attempts), (FINISHED, 1))
+        self.assertIsNone(tasks.claim_task('worker'))
+        self.assertFalse(tasks.is_pending('failing_test_task', fail=False))
+
+    def test_retry_with_backoff(self):
+        genotype = create_submission(0)
+        tasks.enqueue('failing_test_task', genotype=genotype, max_attempts=2)
+        task = tasks.run_task(tasks.claim_task('worker'))
+        self.assertEqual((task.status, task.attempts), (QUEUED, 1))
+        self.assertIn('ValueError', task.last_error)
+        self.assertGreater(task.run_after, timezone.now() + timedelta(seconds=25))
+        # not due before the backoff passed
+        self.assertIsNone(tasks.claim_task('worker'))
+        Task.objects.filter(pk=task.pk).update(run_after=timezone.now())
+        task = tasks.run_task(tasks.claim_task('worker'))
+        self.assertEqual((task.status, task.attempts), (ERROR, 2))
+        # a failed auxiliary task does not fail the submission
+        self.assertEqual(GenotypeSubmission.objects.get(pk=genotype.pk).status, FINISHED)
+
+    def test_failed_pipeline(self):
+        genotype = create_submission(0)
+        tasks.enqueue(PIPELINE_TASK, genotype=genotype, max_attempts=1)
+        self.assertEqual(tasks.run_task(tasks.claim_task('worker')).status, ERROR)
+        self.assertEqual(GenotypeSubmission.objects.get(pk=genotype.pk).status, ERROR)
+
+    def test_backoff(self):
+        self.assertEqual([tasks.get_backoff(attempts).total_seconds() for attempts in (1, 2, 3)], [30, 60, 100])
+
+    def test_requeue_stale_tasks(self):
+        stale = tasks.enqueue('failing_test_task')
+        running = tasks.enqueue('failing_test_task', fail=False)
+        Task.objects.filter(pk=stale.pk).update(status=PROCESSING, locked_by='dead',
+                                                locked_at=timezone.now() - timedelta(hours=2))
+        Task.objects.filter(pk=running.pk).update(status=PROCESSING, locked_by='alive', locked_at=timezone.now())
+        self.assertEqual(tasks.requeue_stale_tasks(), 1)
+        self.assertEqual(Task.objects.get(pk=stale.pk).status, QUEUED)
+        self.assertEqual(Task.objects.get(pk=running.pk).status, PROCESSING)
+
+
+@override_settings(HPC_BACKGROUND_POLLING=False, HPC_STATUS_TTL=60, HPC_REFRESH_LOCK_TIMEOUT=600)
+class StatusRefreshTest(TestCase):
+    """The HPC status of a submission is refreshed at most once per TTL and by a single thread or process"""
+
+    def setUp(self):
+        self.genotype = create_submission(1)
+        self.genotype.identifyjob_set.update(status=QUEUED, jobid=100)
+        patcher = mock.patch.object(services, 'update_genotype_status')
+        self.update_genotype_status = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _get_genotype(self):
+        return GenotypeSubmission.objects.get(pk=self.genotype.pk)
+
+    def test_serve_cached_status_within_ttl(self):
+        services.update_submission(self._get_genotype())
+        services.update_submission(self._get_genotype())
+        self.assertEqual(self.update_genotype_status.call_count, 1)
+        GenotypeSubmission.objects.filter(pk=self.genotype.pk).update(refreshed=timezone.now() - timedelta(seconds=61))
+        services.update_submission(self._get_genotype())
+        self.assertEqual(self.update_genotype_status.call_count, 2)
+
+    def test_lock(self):
+        genotype = self._get_genotype()
+        self.assertTrue(services.claim_refresh(genotype))
+        # a slow refresh keeps the lock beyond the TTL
+        GenotypeSubmission.objects.filter(pk=genotype.pk).update(refreshed=timezone.now() - timedelta(seconds=120))
+        self.assertFalse(services.claim_refresh(self._get_genotype()))
+        services.update_submission(self._get_genotype())
+        self.assertFalse(self.update_genotype_status.called)
+        # the lock of a dead process expires
+        GenotypeSubmission.objects.filter(pk=genotype.pk).update(refresh_locked=timezone.now() - timedelta(seconds=601))
+        self.assertTrue(services.claim_refresh(self._get_genotype()))
+
+    def test_release_on_unavailable_cluster(self):
+        self.update_genotype_status.side_effect = hpc.HPCUnavailableError('down')
+        services.update_submission(self._get_genotype())
+        genotype = self._get_genotype()
+        self.assertIsNone(genotype.refresh_locked)
+        self.assertIsNotNone(genotype.refreshed)
+
+
+class StatisticsColumnsTest(TestCase):
+    """The statistics are parsed once per instance and their hot values are copied into columns"""
+
+    def test_parse_once(self):
+        job = IdentifyJob.objects.get(genotype=create_submission(1))
+        with mock.patch('arageno.models.json.loads', wraps=json.loads) as loads:
+            self.assertEqual(job.stats, job.stats)
+            self.assertEqual(job.matches[0][0], '9970')
+            self.assertEqual(loads.call_count, 1)
+            job.statistics = json.dumps({'matches': [['6909', 0.9, 100, 0.1]]})
+            self.assertEqual(job.matches[0][0], '6909')
+            self.assertEqual(loads.call_count, 2)
+
+    def test_columns(self):
+        genotype = create_submission(1)
+        job = IdentifyJob.objects.get(genotype=genotype)
+        self.assertEqual((job.interpretation_case, job.top_hit), (3, '9970'))
+        self.assertAlmostEqual(job.overlap, 73)
+        self.assertEqual(genotype.num_of_markers, 10)
+        self.assertEqual(genotype.interpretation_case, 0)
+        self.assertEqual(job.crossesjob.interpretation_case, 6)
+        job.statistics = json.dumps({'matches': [], 'interpretation': {'case': 1}, 'overlap': 0.5})
+        job.save()
+        job = IdentifyJob.objects.get(pk=job.pk)
+        self.assertEqual((job.interpretation_case, job.top_hit), (1, None))
+        self.assertAlmostEqual(job.overlap, 50)
+        self.assertEqual(IdentifyJob.objects.filter(interpretation_case=1).count(), 1)
+
+
+@override_settings(POLYNOMINAL_CACHE_TTL=300)
+class PolynominalCacheTest(TestCase):
+    """The resource polynominals are cached per process until they are changed"""
+
+    def setUp(self):
+        models._setting_polynominals.clear()
+        models._dataset_polynominals.clear()
+
+    def test_setting_polynominal(self):
+        Setting.objects.create(key='runtime_parsing_vcf', value='[2, 5]')
+        self.assertEqual(list(models.get_setting_polynominal('runtime_parsing_vcf').coeffs), [2, 5])
+        with self.assertNumQueries(0):
+            models.get_setting_polynominal('runtime_parsing_vcf')
+        Setting.objects.filter(pk='runtime_parsing_vcf').update(value='[3, 5]')
+        self.assertEqual(list(models.get_setting_polynominal('runtime_parsing_vcf').coeffs), [2, 5])
+        # saved settings are reloaded at once, changes of other processes after the TTL
+        with override_settings(POLYNOMINAL_CACHE_TTL=0):
+            self.assertEqual(list(models.get_setting_polynominal('runtime_parsing_vcf').coeffs), [3, 5])
+        Setting.objects.update_or_create(key='runtime_parsing_vcf', defaults={'value': '[4, 5]'})
+        self.assertEqual(list(models.get_setting_polynominal('runtime_parsing_vcf').coeffs), [4, 5])
+        self.assertIsNone(models.get_setting_polynominal('runtime_parsing_bed'))
+
+    def test_dataset_polynominal(self):
+        dataset = create_submission(1).identifyjob_set.get().dataset
+        first = models.get_dataset_polynominal(dataset, 'runtime_identify')
+        self.assertIs(models.get_dataset_polynominal(dataset, 'runtime_identify'), first)
+        dataset.runtime_identify = '[2, 0]'
+        self.assertEqual(list(models.get_dataset_polynominal(dataset, 'runtime_identify').coeffs), [2, 0])
+
+    def test_estimated_finish(self):
+        job = IdentifyJob.objects.get(genotype=create_submission(1))
+        job.status = PROCESSING
+        job.started = timezone.now()
+        job.save()
+        # 10 markers with the polynominal [1, 0]
+        self.assertEqual(job.estimated_finish, job.started + timedelta(seconds=10))
+        estimated_finish = job.estimated_finish
+        job.started = timezone.now() + timedelta(seconds=60)
+        job.save()
+        self.assertEqual(IdentifyJob.objects.get(pk=job.pk).estimated_finish, estimated_finish)
+
+
+class MediaRootTestCase(TestCase):
+    """Stores the uploaded and generated files in a temporary MEDIA_ROOT"""
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings_override = override_settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+
+class CrossesPlotTest(MediaRootTestCase):
+    """The crosses plots are rendered once by the task workers and served from the stored files"""
+
+    def setUp(self):
+        super(CrossesPlotTest, self).setUp()
+        self.genotype = create_submission(1)
+        self.crosses_job = CrossesJob.objects.get(identifyjob__genotype=self.genotype)
+        patcher = mock.patch.object(plotting, 'render_crosses_plot_in_pool',
+                                    side_effect=lambda statistics, **kwargs: {'png': b'png', 'pdf': b'pdf'})
+        self.render = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _get_plot(self):
+        return self.client.get(reverse('crosses_plot', args=[self.genotype.id, self.crosses_job.pk]))
+
+    def test_render_once(self):
+        tasks.run_task(tasks.enqueue('render_crosses_plots_task', identifyjob_id=self.crosses_job.pk))
+        crosses_job = CrossesJob.objects.get(pk=self.crosses_job.pk)
+        self.assertTrue(crosses_job.has_current_plots)
+        # the download bundle is built after the plots
+        self.assertTrue(tasks.is_pending('build_download_bundle_task', identifyjob_id=self.crosses_job.pk))
+        services.render_crosses_plots(crosses_job)
+        self.assertEqual(self.render.call_count, 1)
+        # rendered again when the statistics changed
+        crosses_job.statistics = json.dumps(dict(CROSSES_STATISTICS, matches=[['9399', 40]]))
+        crosses_job.save()
+        self.assertFalse(crosses_job.has_current_plots)
+        services.render_crosses_plots(crosses_job)
+        self.assertEqual(self.render.call_count, 2)
+
+    def test_serve_stored_plot(self):
+        services.render_crosses_plots(self.crosses_job)
+        response = self._get_plot()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response['Content-Type'], response.content), ('image/png', b'png'))
+        self.assertEqual(self.client.get(reverse('crosses_plot', args=[self.genotype.id, self.crosses_job.pk]),
+                                         HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+        self.assertEqual(self.render.call_count, 1)
+
+    def test_plot_tasks_outside_pipeline_state(self):
+        services.schedule_result_files(self.genotype)
+        self.assertTrue(tasks.is_pending('render_crosses_plots_task', identifyjob_id=self.crosses_job.pk))
+        response = self.client.get(reverse('genotypesubmission-status', args=[self.genotype.id]),
+                                   HTTP_ACCEPT='application/json')
+        self.assertIsNone(response.json()['pipeline'])
+        # not scheduled twice
+        services.schedule_result_files(self.genotype)
+        self.assertEqual(Task.objects.filter(name='render_crosses_plots_task').count(), 1)
+
+
+WINDOWS_STATISTICS = {'genotype_windows': {'chr_bins': {'Chr1': 4, 'Chr2': 2},
+                                           'coordinates': {'x': [1, 2, 3, 4, 5, 6], 'y': ['A', 'A', 'B', 'A', 'B', 'B']}}}
+
+
+@override_settings(CROSSES_WINDOWS_MAX_BINS=3)
+class CrossesWindowsTest(TestCase):
+    """The windows of the crosses plot are binned per chromosome"""
+
+    def _get_windows(self, genotype_id, job_id, **params):
+        return self.client.get(reverse('crosses_windows', args=[genotype_id, job_id]), params,
+                               HTTP_ACCEPT='application/json')
+
+    def test_bin_windows(self):
+        binned = plotting.bin_crosses_windows(WINDOWS_STATISTICS, 2)
+        self.assertEqual(binned['chromosomes'], ['Chr1', 'Chr2'])
+        self.assertEqual(binned['parents'].tolist(), ['A', 'B'])
+        self.assertEqual(binned['x'].tolist(), [2, 4, 5.5, 6.5])
+        self.assertEqual(binned['counts'].tolist(), [[2, 0], [1, 1], [0, 1], [0, 1]])
+
+    def test_endpoint(self):
+        genotype = create_submission(1)
+        crosses_job = CrossesJob.objects.get(identifyjob__genotype=genotype)
+        crosses_job.statistics = json.dumps(dict(CROSSES_STATISTICS, **WINDOWS_STATISTICS))
+        crosses_job.save()
+        response = self._get_windows(genotype.id, crosses_job.pk, bins=2)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['counts'], [[2, 0], [1, 1], [0, 1], [0, 1]])
+        # the number of bins is capped
+        self.assertEqual(self._get_windows(genotype.id, crosses_job.pk, bins=1000).json()['binsPerChromosome'], 3)
+        self.assertEqual(self._get_windows(genotype.id, crosses_job.pk, bins='many').status_code, 400)
+
+    def test_unknown_or_unfinished_job(self):
+        genotype = create_submission(1)
+        crosses_job = CrossesJob.objects.get(identifyjob__genotype=genotype)
+        self.assertEqual(self._get_windows(genotype.id, crosses_job.pk + 1).status_code, 404)
+        self.assertEqual(self._get_windows(create_submission(1).id, crosses_job.pk).status_code, 404)
+        CrossesJob.objects.filter(pk=crosses_job.pk).update(status=PROCESSING)
+        self.assertEqual(self._get_windows(genotype.id, crosses_job.pk).status_code, 404)
+        self.assertEqual(self.client.get(reverse('crosses_plot', args=[genotype.id, crosses_job.pk])).status_code, 404)
+        job_id = crosses_job.pk
+        crosses_job.delete()
+        self.assertEqual(self.client.get(reverse('crosses_plot', args=[genotype.id, job_id])).status_code, 404)
+
+
+class DownloadBundleTest(MediaRootTestCase):
+    """The download bundles are built by the task workers and served with range support or by nginx"""
+
+    def setUp(self):
+        super(DownloadBundleTest, self).setUp()
+        self.genotype = create_submission(1)
+        self.job = IdentifyJob.objects.get(genotype=self.genotype)
+        self.job.identify_file.save('result.tsv', ContentFile(b'9970\t0.88\n'))
+        patcher = mock.patch.object(plotting, 'render_crosses_plot_in_pool',
+                                    side_effect=lambda statistics, **kwargs: {'png': b'png', 'pdf': b'pdf'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _download(self, **headers):
+        return self.client.get(reverse('download', args=[self.genotype.id, self.job.pk]), **headers)
+
+    def _build_bundle(self):
+        tasks.run_task(tasks.claim_task('worker'))
+        return IdentifyJob.objects.get(pk=self.job.pk)
+
+    def test_build_on_request(self):
+        response = self._download()
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], str(settings.TASK_POLL_INTERVAL))
+        self.assertTrue(tasks.is_pending('build_download_bundle_task', identifyjob_id=self.job.pk))
+        self.assertTrue(self._build_bundle().has_current_download_bundle)
+        response = self._download()
+        self.assertEqual(response.status_code, 200)
+        with zipfile.ZipFile(BytesIO(b''.join(response.streaming_content))) as zip_file:
+            self.assertEqual(sorted(zip_file.namelist()), ['crosses_plot.pdf', 'result.tsv', 'stats.json'])
+            self.assertEqual(zip_file.read('result.tsv'), b'9970\t0.88\n')
+
+    def test_range(self):
+        self._download()
+        size = self._build_bundle().download_file.size
+        etag = self._download()['ETag']
+        response = self._download(HTTP_RANGE='bytes=2-5')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 2-5/%s' % size)
+        self.assertEqual(len(b''.join(response.streaming_content)), 4)
+        response = self._download(HTTP_RANGE='bytes=-3', HTTP_IF_RANGE=etag)
+        self.assertEqual(response['Content-Range'], 'bytes %s-%s/%s' % (size - 3, size - 1, size))
+        # the bundle changed since the first part was downloaded
+        self.assertEqual(self._download(HTTP_RANGE='bytes=2-5', HTTP_IF_RANGE='"other"').status_code, 200)
+        self.assertEqual(self._download(HTTP_RANGE='bytes=%s-' % size).status_code, 416)
+
+    @override_settings(DOWNLOAD_ACCEL_REDIRECT=True, DOWNLOAD_ACCEL_LOCATION='/protected-uploads/')
+    def test_accel_redirect(self):
+        self._download()
+        job = self._build_bundle()
+        response = self._download()
+        self.assertEqual(response['X-Accel-Redirect'], '/protected-uploads/' + job.download_file.name)
+        self.assertEqual(response.content, b'')
+
+    def test_unfinished_job(self):
+        IdentifyJob.objects.filter(pk=self.job.pk).update(status=PROCESSING)
+        self.assertEqual(self._download().status_code, 404)
+        self.assertFalse(Task.objects.exists())
+
+
+SCORES_TSV = b"""9970\t100\t120\t0.83\t1.5\t2.0
+9399\t110\t120\t0.92\t1.0\t1.0
+6909\t50\t120\t0.42\t9.0\t9.0
+6095\t90\t120\t0.75\t2.0\t2.5
+1002\t80\t120\t0.67\t3.0\t3.5
+"""
+
+
+class IdentifyScoresTest(MediaRootTestCase):
+    """The identify scores are queried from the converted columns"""
+
+    def setUp(self):
+        super(IdentifyScoresTest, self).setUp()
+        self.genotype = create_submission(1)
+        self.job = IdentifyJob.objects.get(genotype=self.genotype)
+        self.job.identify_file.save('result.tsv', ContentFile(SCORES_TSV))
+
+    def _get_scores(self, **params):
+        return self.client.get(reverse('identify_scores', args=[self.genotype.id, self.job.pk]), params,
+                               HTTP_ACCEPT='application/json')
+
+    def _get_accessions(self, **params):
+        response = self._get_scores(**params)
+        self.assertEqual(response.status_code, 200)
+        return [row['accession'] for row in response.json()['results']]
+
+    def test_select(self):
+        scores.convert_scores(self.job.identify_file.path, self.job.scores_folder)
+        table = scores.open_scores(self.job.scores_folder)
+        self.assertEqual(len(table), 5)
+        self.assertEqual([row['accession'] for row in table.select(top=2)[:]], ['9399', '9970'])
+        self.assertEqual(table.select(accessions=['6909'])[0], {
+            'accession': '6909', 'matched_snps': 50, 'informative_snps': 120, 'score': 0.42, 'likelihood': 9.0,
+            'likelihood_ratio': 9.0, 'rank': 5})
+        self.assertEqual([row['rank'] for row in table.select(min_score=0.6, max_score=0.8)[:]], [3, 4])
+        self.assertEqual(len(table.select(accessions=['1'])), 0)
+
+    def test_convert_on_request(self):
+        response = self._get_scores()
+        self.assertEqual(response.status_code, 503)
+        self.assertTrue(tasks.is_pending('convert_scores_task', identifyjob_id=self.job.pk))
+        tasks.run_task(tasks.claim_task('worker'))
+        self.assertEqual(self._get_accessions(), ['9399', '9970', '6095', '1002', '6909'])
+
+    def test_query(self):
+        scores.convert_scores(self.job.identify_file.path, self.job.scores_folder)
+        self.assertEqual(self._get_accessions(top=2), ['9399', '9970'])
+        self.assertEqual(self._get_accessions(accession='6909,9970'), ['9970', '6909'])
+        self.assertEqual(self._get_accessions(min_score=0.5, max_score=0.9), ['9970', '6095', '1002'])
+        response = self._get_scores(limit=2, offset=2).json()
+        self.assertEqual(response['count'], 5)
+        self.assertEqual([row['accession'] for row in response['results']], ['6095', '1002'])
+        self.assertEqual(self._get_scores(top=0).status_code, 400)
+        self.assertEqual(self._get_scores(min_score='high').status_code, 400)
+
+
+
+@override_settings(HPC_BACKGROUND_POLLING=True)
+class AccessionBundleTest(TestCase):
+    """Submissions return the accession ids and the infos are served as a fingerprinted bundle"""
+
+    def setUp(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        self.folder = os.path.join(tmp_dir, 'accessions')
+        accessions.write_snapshot([{'pk': 9970, 'name': 'Ll-0'}, {'pk': 9399, 'name': 'Bs-1'}], self.folder, {})
+        accessions._last_check = time.time()
+        settings_override = override_settings(ACCESSION_MAP_SNAPSHOT=self.folder)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        patcher = mock.patch.object(accessions, '_refresh_in_background')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.genotype = create_submission(1)
+
+    def _get_submission(self, **params):
+        return self.client.get(reverse('genotypesubmission-detail', args=[self.genotype.id]), params,
+                               HTTP_ACCEPT='application/json')
+
+    def test_accession_ids(self):
+        data = self._get_submission().json()
+        self.assertEqual(data['accessions'], ['9399', '9970'])
+        fingerprint = accessions.get_accession_map().fingerprint
+        self.assertEqual(data['accessionsUrl'], reverse('accession_bundle', args=[fingerprint]))
+
+    def test_expand_accessions(self):
+        self.assertEqual(sorted(self._get_submission(expand='accessions').json()['accessions']), ['9399', '9970'])
+        accession_infos = self._get_submission(expand='accessions', top=1).json()['accessions']
+        self.assertEqual(list(accession_infos), ['9970'])
+        self.assertEqual(accession_infos['9970']['name'], 'Ll-0')
+        self.assertEqual(self._get_submission(expand='accessions', top='all').status_code, 400)
+
+    def test_etag_changes_with_snapshot(self):
+        etag = self._get_submission()['ETag']
+        self.assertEqual(self.client.get(reverse('genotypesubmission-detail', args=[self.genotype.id]),
+                                         HTTP_ACCEPT='application/json', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertNotEqual(self._get_submission(expand='accessions')['ETag'], etag)
+        accessions.write_snapshot([{'pk': 9970, 'name': 'Ll-0'}], self.folder, {})
+        self.assertNotEqual(self._get_submission()['ETag'], etag)
+
+    def test_bundle(self):
+        fingerprint = accessions.get_accession_map().fingerprint
+        response = self.client.get(reverse('accession_bundle', args=[fingerprint]))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertEqual(json.loads(b''.join(response.streaming_content))['9399']['name'], 'Bs-1')
+        response = self.client.get(reverse('accession_bundle', args=['0' * 16]))
+        self.assertRedirects(response, reverse('accession_bundle', args=[fingerprint]), fetch_redirect_response=False)
+
+
+@override_settings(HPC_RESUBMIT_MAX_ATTEMPTS=3, HPC_RESUBMIT_ESCALATION=2, HPC_MAX_WALLTIME=24 * 3600,
+                   HPC_MAX_MEMORY=64 * 1024 * 1024)
+class ResubmitTest(TestCase):
+    """Jobs killed by the cluster are resubmitted with escalated walltime or memory"""
+
+    def setUp(self):
+        self.executor = hpc.HPCExecutor('test', 'login', 'slurm', 'CBE', '/work', '/datasets')
+        self.executor.submit_crosses_job = mock.Mock()
+        patcher = mock.patch.dict(hpc.EXECUTORS, {'test': self.executor})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        genotype = create_submission(1)
+        CrossesJob.objects.filter(identifyjob__genotype=genotype).update(
+            executor='test', jobid=30, status=PROCESSING, statistics=None, started=timezone.now())
+        self.job_id = CrossesJob.objects.get(identifyjob__genotype=genotype).pk
+
+    def _kill(self, status):
+        job = CrossesJob.objects.select_related('identifyjob__genotype', 'identifyjob__dataset').get(pk=self.job_id)
+        if job.status == QUEUED:
+            CrossesJob.objects.filter(pk=job.pk).update(jobid=31, status=PROCESSING, started=timezone.now())
+            job.refresh_from_db()
+        hpc.update_job_status(job, status)
+        return CrossesJob.objects.get(pk=self.job_id)
+
+    def test_escalate(self):
+        job = self._kill(hpc.RESUBMIT_TIMEOUT)
+        self.assertEqual((job.status, job.walltime_factor, job.memory_factor), (QUEUED, 2, 1))
+        self.assertIsNone(job.jobid)
+        self.assertEqual([(attempt['jobid'], attempt['state']) for attempt in job.previous_attempts],
+                         [('test:30', 'TIMEOUT')])
+        self.assertEqual(self.executor.submit_crosses_job.call_count, 1)
+        job = self._kill(hpc.RESUBMIT_OUT_OF_MEMORY)
+        self.assertEqual((job.status, job.walltime_factor, job.memory_factor), (QUEUED, 2, 2))
+        first, second = job.previous_attempts
+        self.assertEqual((second['walltime'], second['memory']), (2 * first['walltime'], first['memory']))
+        # the third attempt is the last one
+        job = self._kill(hpc.RESUBMIT_TIMEOUT)
+        self.assertEqual(job.status, ERROR)
+        self.assertEqual(self.executor.submit_crosses_job.call_count, 2)
+
+    def test_resources_exhausted(self):
+        walltime = hpc._get_walltime_seconds(CrossesJob.objects.get(pk=self.job_id).walltime)
+        with override_settings(HPC_MAX_WALLTIME=walltime):
+            job = self._kill(hpc.RESUBMIT_TIMEOUT)
+        self.assertEqual(job.status, ERROR)
+        self.assertFalse(self.executor.submit_crosses_job.called)
+
+    def test_escalated_resources(self):
+        self.assertEqual(hpc._get_walltime_seconds(3600, 2), 2 * hpc._get_walltime_seconds(3600))
+        self.assertEqual(hpc._get_walltime_seconds(3600, 1000), settings.HPC_MAX_WALLTIME)
+        self.assertEqual(hpc._get_memory_kb(1024 * 1024, 2), 2 * hpc._get_memory_kb(1024 * 1024))
+
+
+@override_settings(HPC_SENTINELS=False)
+class JobArrayTest(TestCase):
+    """The identify jobs of a submission are submitted as one SLURM job array with an index file"""
+
+    def setUp(self):
+        self.executor = hpc.HPCExecutor('test', 'login', 'slurm', 'CBE', '/work', '/datasets')
+        self.cluster = FakeCluster({'sbatch': 'Submitted batch job 500'})
+        self.executor.call = self.cluster.call
+        self.genotype = create_submission(2)
+        self.genotype.identifyjob_set.update(executor='test')
+        self.jobs = list(self.genotype.identifyjob_set.select_related('dataset', 'genotype').order_by('pk'))
+
+    def test_submit_array(self):
+        job_ids = self.executor.submit_identify_jobs(self.jobs)
+        self.assertEqual(job_ids, ['test:500_0', 'test:500_1'])
+        self.assertEqual(sorted(IdentifyJob.objects.values_list('jobid', 'array_task_id')), [(500, 0), (500, 1)])
+        folder = '/work/%s' % self.genotype.id
+        index_file, script, submit = self.cluster.commands[:3]
+        # the index file and the script are stored in the folder of the submission
+        self.assertTrue(index_file['path'].startswith(folder + '/') and index_file['path'].endswith('.index'))
+        self.assertEqual(index_file['content'].splitlines(), [
+            '%s\t%s\t%s\tdataset%s\t%s' % (ix, self.genotype.id, job.id, ix, folder) for ix, job in enumerate(self.jobs)])
+        self.assertIn('#SBATCH --array=0-1', script['content'])
+        self.assertIn('INDEX_FILE=%s' % index_file['path'], script['content'])
+        self.assertEqual(submit['cmd'].split()[-1], script['path'])
+        self.assertTrue(script['path'].startswith(folder + '/'))
+        # one call for the whole array
+        self.assertEqual(len([command for command in self.cluster.commands if command['op'] == 'run']), 1)
+
+    def test_status_of_array_tasks(self):
+        self.executor.submit_identify_jobs(self.jobs)
+        self.cluster.outputs['squeue'] = '500_0 RUNNING\n500_1 PENDING\n'
+        statuses = self.executor.get_jobs_status([job.hpc_job_id for job in IdentifyJob.objects.all()])
+        self.assertEqual(statuses, {'test:500_0': PROCESSING, 'test:500_1': QUEUED})
+
+
+IDENTIFY_BATCH_DRIVER = os.path.join(os.path.dirname(__file__), 'submit_script_templates', 'CBE', 'identify_batch.py')
+
+
+@override_settings(HPC_SENTINELS=False)
+class IdentifyBatchTest(TestCase):
+    """The samples of a dataset share one batch job and fail on their own with .failed markers"""
+
+    def setUp(self):
+        self.executor = hpc.HPCExecutor('test', 'login', 'slurm', 'CBE', '/work', '/datasets')
+        self.cluster = FakeCluster({'sbatch': 'Submitted batch job 600'})
+        self.executor.call = self.cluster.call
+        patcher = mock.patch.dict(hpc.EXECUTORS, {'test': self.executor})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.genotypes = [create_submission(1), create_submission(1)]
+        IdentifyJob.objects.update(executor='test')
+        self.jobs = list(IdentifyJob.objects.select_related('dataset', 'genotype').order_by('pk'))
+
+    def test_submit_batch(self):
+        self.assertTrue(self.executor.supports_batch)
+        self.assertEqual(self.executor.submit_identify_batch(self.jobs), ['test:600', 'test:600'])
+        self.assertEqual(list(IdentifyJob.objects.values_list('jobid', 'array_task_id')), [(600, None), (600, None)])
+        index_file = [command for command in self.cluster.commands
+                      if command['op'] == 'write' and command['path'].endswith('.index')][0]
+        # the batch files are stored in the folder of the first submission
+        self.assertTrue(index_file['path'].startswith('/work/%s/' % self.genotypes[0].id))
+        self.assertEqual([line.split('\t')[1:3] for line in index_file['content'].splitlines()],
+                         [[str(job.genotype_id), str(job.id)] for job in self.jobs])
+        self.assertEqual(len([command for command in self.cluster.commands if command['op'] == 'run']), 1)
+
+    def test_failed_sample(self):
+        self.executor.submit_identify_batch(self.jobs)
+        failed, succeeded = self.jobs
+        IdentifyJob.objects.update(status=PROCESSING, started=timezone.now(), statistics=None)
+        succeeded_folder = '/work/%s' % succeeded.genotype_id
+        self.cluster.files = {
+            '/work/%s/%s.failed' % (failed.genotype_id, failed.id): 'snpmatch exited with 1',
+            '%s/%s.matches.json' % (succeeded_folder, succeeded.id): json.dumps(IDENTIFY_STATISTICS),
+            '%s/%s.scores.txt' % (succeeded_folder, succeeded.id): SCORES_TSV.decode()}
+        failed = IdentifyJob.objects.select_related('dataset', 'genotype').get(pk=failed.pk)
+        hpc.update_job_status(failed, FINISHED)
+        self.assertEqual(IdentifyJob.objects.get(pk=failed.pk).status, ERROR)
+        matches, output_path = self.executor.stage_out(IdentifyJob.objects.get(pk=succeeded.pk))
+        self.addCleanup(os.remove, output_path)
+        self.assertEqual(matches, IDENTIFY_STATISTICS)
+
+    def test_driver_failure_marker(self):
+        spec = importlib.util.spec_from_file_location('identify_batch', IDENTIFY_BATCH_DRIVER)
+        driver = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(driver)
+        workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, workdir)
+        index_file = os.path.join(workdir, 'batch.index')
+        with open(index_file, 'w') as fh:
+            fh.write('0\tG1\t1\tdataset\t%s\n1\tG2\t2\tdataset\t%s\n' % (workdir, workdir))
+
+        def snpmatch():
+            if '2' in sys.argv:
+                raise SystemExit(1)
+        cwd = os.getcwd()
+        self.addCleanup(os.chdir, cwd)
+        with mock.patch.object(driver, 'load_entry_point', return_value=snpmatch), \
+                mock.patch.object(sys, 'argv', list(sys.argv)), mock.patch('sys.stderr'):
+            driver.main(index_file, 'dataset.hdf5', 'dataset.acc.hdf5')
+        self.assertFalse(os.path.exists(os.path.join(workdir, '1.failed')))
+        with open(os.path.join(workdir, '2.failed')) as fh:
+            self.assertEqual(fh.read(), 'snpmatch exited with 1\n')
+
+
+class LocalExecutorTest(TestCase):
+    """Small submissions run in a local process pool whose job states are stored in files"""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        settings_override = override_settings(LOCAL_EXECUTOR_FOLDER=self.folder)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def test_job_states(self):
+        self.assertEqual([local_jobs.next_job_id(self.folder) for _ in range(3)], [1, 2, 3])
+        self.assertEqual(local_jobs.run_job(self.folder, 1, self.folder, [['true'], ['true']]), 0)
+        self.assertEqual(local_jobs.run_job(self.folder, 2, self.folder, [['false'], ['true']]), 1)
+        # the process of a running job died (pids are below 2 ** 22)
+        local_jobs.write_state(self.folder, 3, local_jobs.RUNNING)
+        with open(local_jobs.get_state_file(self.folder, 3)) as fh:
+            state = dict(json.load(fh), pid=2 ** 22 + 1)
+        with open(local_jobs.get_state_file(self.folder, 3), 'w') as fh:
+            json.dump(state, fh)
+        self.assertEqual(hpc.EXECUTORS[LOCAL].get_jobs_status(['local:1', 'local:2', 'local:3', 'local:4']),
+                         {'local:1': FINISHED, 'local:2': ERROR, 'local:3': ERROR, 'local:4': ERROR})
+        local_jobs.remove_states(self.folder, [1, 2, 3])
+        self.assertIsNone(local_jobs.read_state(self.folder, 1))
+
+    def test_failed_dependency(self):
+        local_jobs.run_job(self.folder, local_jobs.next_job_id(self.folder), self.folder, [['false']])
+        job_id = local_jobs.submit_job(self.folder, self.folder, [['true']], after=1)
+        self.assertEqual(local_jobs.read_state(self.folder, job_id), local_jobs.FAILED)
+
+    def test_crosses_job_submitted_by_task(self):
+        genotype = create_submission(1)
+        CrossesJob.objects.all().delete()
+        genotype.identifyjob_set.update(executor=LOCAL, jobid=1)
+        genotype = GenotypeSubmission.objects.with_jobs().get(pk=genotype.pk)
+        with mock.patch.object(executors.LocalExecutor, 'submit_crosses_job') as submit_crosses_job:
+            hpc.update_genotype_status(genotype, {})
+            # never submitted by a web server process
+            self.assertFalse(submit_crosses_job.called)
+            crosses_job = CrossesJob.objects.get()
+            self.assertEqual(crosses_job.executor, LOCAL)
+            self.assertTrue(tasks.is_pending('submit_crosses_job_task', crossesjob_id=crosses_job.pk))
+            tasks.run_task(tasks.claim_task('worker'))
+        self.assertEqual(submit_crosses_job.call_args[0][0].pk, crosses_job.pk)
+
+
+HPC_AGENT = os.path.join(os.path.dirname(__file__), 'submit_script_templates', 'hpc_agent.py')
+
+
+class HPCAgentTest(SimpleTestCase):
+    """The agent on the login node executes batches of commands sent as one JSON request per line"""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+
+    def _call(self, *requests):
+        process = subprocess.run([sys.executable, HPC_AGENT], input=''.join(json.dumps(request) + '\n' for request in requests),
+                                 stdout=subprocess.PIPE, universal_newlines=True, timeout=30, check=True)
+        return [json.loads(line) for line in process.stdout.splitlines()]
+
+    def test_batch(self):
+        path = os.path.join(self.folder, 'jobs', 'job.sh')
+        first, second = self._call(
+            {'id': 1, 'commands': [{'op': 'ping'}, {'op': 'mkdir', 'path': os.path.dirname(path)},
+                                   {'op': 'write', 'path': path, 'content': 'echo 1\n'}, {'op': 'exists', 'path': path},
+                                   {'op': 'read', 'path': path}, {'op': 'run', 'cmd': 'cat %s' % path},
+                                   {'op': 'list', 'path': os.path.dirname(path)}]},
+            {'id': 2, 'commands': [{'op': 'remove', 'path': os.path.dirname(path)}, {'op': 'exists', 'path': path},
+                                   {'op': 'read', 'path': path}, {'op': 'unknown'}]})
+        self.assertEqual(first['id'], 1)
+        ping, mkdir, write, exists, read, run, listing = first['results']
+        self.assertEqual(ping, {'ok': True, 'value': 1})
+        self.assertTrue(mkdir['ok'] and write['ok'] and exists['value'])
+        self.assertEqual(read['value'], 'echo 1\n')
+        self.assertEqual((run['exited'], run['stdout']), (0, 'echo 1\n'))
+        self.assertEqual(list(listing['value']), ['job.sh'])
+        remove, exists, read, unknown = second['results']
+        self.assertTrue(remove['ok'])
+        self.assertFalse(exists['value'])
+        self.assertFalse(read['ok'])
+        self.assertEqual(unknown, {'ok': False, 'error': 'Unknown operation'})
+
+    def test_stop_on_error(self):
+        response, = self._call({'id': 3, 'stop_on_error': True, 'commands': [
+            {'op': 'run', 'cmd': 'exit 3'}, {'op': 'mkdir', 'path': os.path.join(self.folder, 'skipped')}]})
+        run, mkdir = response['results']
+        self.assertEqual((run['ok'], run['exited']), (False, 3))
+        self.assertEqual(mkdir, {'ok': False, 'error': 'Skipped'})
+        self.assertFalse(os.path.exists(os.path.join(self.folder, 'skipped')))
+
+    def test_invalid_request(self):
+        response, = self._call('not a request')
+        self.assertIn('error', response)
+
+
+class LocalAgentChannel(object):
+    """Stands in for the SSH channel of the agent with a local process"""
+
+    def __init__(self, process):
+        self.process = process
+        self.channel = self
+        self.closed = False
+
+    def readline(self):
+        return self.process.stdout.readline()
+
+    def settimeout(self, timeout):
+        pass
+
+    def exit_status_ready(self):
+        return self.process.poll() is not None
+
+    def close(self):
+        self.closed = True
+        self.process.kill()
+        self.process.wait()
+        self.process.stdin.close()
+        self.process.stdout.close()
+
+
+class LocalAgentConnection(object):
+    """Fabric connection whose commands and uploads run on the local machine"""
+
+    def __init__(self, start_agent=True):
+        self.is_connected = False
+        self.client = self
+        self.start_agent = start_agent
+        self.commands = []
+        self.channels = []
+
+    def open(self):
+        self.is_connected = True
+
+    def close(self):
+        self.is_connected = False
+
+    def run(self, cmd, warn=False, hide=None, **kwargs):
+        self.commands.append(cmd)
+        process = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        return Result(stdout=process.stdout, stderr=process.stderr, command=cmd, exited=process.returncode)
+
+    def put(self, local, remote):
+        shutil.copyfile(local, remote)
+
+    def exec_command(self, cmd):
+        if not self.start_agent:
+            raise IOError('Channel closed')
+        python, _, path = cmd.split()
+        process = subprocess.Popen([sys.executable, '-u', path], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                   universal_newlines=True)
+        channel = LocalAgentChannel(process)
+        self.channels.append(channel)
+        return process.stdin, channel, None
+
+
+class AgentConnectionTest(SimpleTestCase):
+    """A batch of commands costs one round trip to the agent. Without agent every command is run on its own"""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+
+    def test_batch_with_agent(self):
+        connection = LocalAgentConnection()
+        agent = hpc.AgentConnection(connection, os.path.join(self.folder, '.agent'))
+        agent.open()
+        self.addCleanup(agent.close)
+        self.assertTrue(agent.is_connected)
+        path = os.path.join(self.folder, 'file.txt')
+        results = agent.call([{'op': 'write', 'path': path, 'content': 'data'}, {'op': 'read', 'path': path},
+                              {'op': 'run', 'cmd': 'exit 1'}])
+        self.assertEqual([result['ok'] for result in results], [True, True, False])
+        self.assertEqual(results[1]['value'], 'data')
+        self.assertEqual(agent.run('echo hi').stdout, 'hi\n')
+        with self.assertRaises(UnexpectedExit):
+            agent.run('exit 2')
+        # only the deployment ran over SSH
+        self.assertEqual(len(connection.commands), 2)
+        self.assertEqual(len(connection.channels), 1)
+        # the agent is not uploaded again
+        connection.commands = []
+        hpc.AgentConnection(connection, os.path.join(self.folder, '.agent'))._deploy()
+        self.assertEqual(len(connection.commands), 1)
+
+    def test_fallback_without_agent(self):
+        connection = LocalAgentConnection(start_agent=False)
+        agent = hpc.AgentConnection(connection, os.path.join(self.folder, '.agent'))
+        agent.open()
+        connection.commands = []
+        results = agent.call([{'op': 'mkdir', 'path': os.path.join(self.folder, 'a')},
+                              {'op': 'exists', 'path': os.path.join(self.folder, 'a')}])
+        self.assertEqual(results[1], {'ok': True, 'value': True})
+        self.assertEqual(len(connection.commands), 2)
@@ -4,7 +4,8 @@ Views for Genotyper
 import os
 from django.shortcuts import render
 from django.conf import settings
-from django.http import HttpResponseRedirect
+from django.http import HttpResponseRedirect, FileResponse, Http404
+from django.utils.cache import patch_cache_control
 from .forms import UploadFileForm
 from django.urls import reverse, reverse_lazy
 from django.views.generic import DetailView
@@ -13,7 +14,8 @@ from django.views.generic.edit import DeleteView, UpdateView
 from .models import GenotypeSubmission, delete_upload_folder
 from .serializers import GenotypeSubmissionSerializer
 from djangorestframework_camel_case.render import CamelCaseJSONRenderer
-from .services import start_identify_pipeline
+from .services import enqueue_identify_pipeline
+from .accessions import get_accession_map
 import logging,traceback
 
 
@@ -27,6 +29,22 @@ def index(request):
     return render(request, 'index.html')
 
 
+def accession_bundle(request, fingerprint):
+    """
+    Infos of all accessions. The url contains the fingerprint of the content so it can be cached forever
+    """
+    accessions_map = get_accession_map()
+    if accessions_map.fingerprint is None:
+        raise Http404()
+    if fingerprint != accessions_map.fingerprint:
+        response = HttpResponseRedirect(reverse('accession_bundle', args=[accessions_map.fingerprint]))
+        patch_cache_control(response, no_cache=True)
+        return response
+    response = FileResponse(open(accessions_map.bundle_path, 'rb'), content_type='application/json')
+    patch_cache_control(response, public=True, max_age=31536000, immutable=True)
+    return response
+
+
 def faq(request):
     '''
     FAQ View
@@ -48,7 +66,7 @@ def upload_genotype(request):
         if form.is_valid():
             try:
                 submission = form.save()
-                start_identify_pipeline(submission)
+                enqueue_identify_pipeline(submission)
                 return HttpResponseRedirect(submission.get_absolute_url())
             except Exception as err:
                 if submission and submission.genotype_file:
@@ -64,7 +82,7 @@ class GenotypeSubmissionInfo(DetailView):
     """
     Display genotype submission and identify status
     """
-    model = GenotypeSubmission
+    queryset = GenotypeSubmission.objects.with_jobs()
     template_name = 'submission_status.html'
 
     def get_context_data(self, **kwargs):
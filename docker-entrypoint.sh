@@ -6,11 +6,19 @@ if [ "$1" = 'manage.py' ]; then
   python manage.py migrate                  # Apply database migrations
   python manage.py collectstatic --noinput  # Collect static files
   python manage.py loaddata initial
+  python manage.py refresh_accessions || echo "Using the existing accession map snapshot"
+  export HPC_BACKGROUND_POLLING=True
+  # the HPC connection pool of each process (HPC_POOL_SIZE) defaults to the number of gunicorn threads
+  export GUNICORN_THREADS=${GUNICORN_THREADS:-16}
+  python manage.py poll_hpc_jobs &          # Refresh HPC job status in the background
+  for i in $(seq ${TASK_WORKERS:-2}); do
+    python manage.py run_tasks &            # Workers for the submission pipeline
+  done
   exec gunicorn AraGenoSite.wsgi:application \
     --name AraGeno \
     --bind 0.0.0.0:8000 \
     --workers 2 \
-    --threads 4 \
+    --threads $GUNICORN_THREADS \
     --worker-class=gthread \
     --timeout 120 \
     --log-level=info \